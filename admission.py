@@ -0,0 +1,290 @@
+'''
+Admission control for completions.
+
+Every mention takes a ticket as soon as it arrives and only starts its
+OpenAI request once the ticket is admitted.  A ticket is admitted, in
+arrival order, when
+
+- fewer than max_in_flight completions are running,
+- its user has fewer than max_per_user and its channel fewer than
+  max_per_channel running (tickets held back by these are skipped, so one
+  busy user or channel does not hold up everyone else),
+- the tokens it will use fit in what is left of the tokens_per_minute
+  budget over the last 60 seconds.  The estimate is the packed
+  conversation plus max_tokens, which is what OpenAI counts against the
+  limit; a request larger than the whole budget still runs on its own.
+
+Tickets are taken before the thread is read (so the wait message can show
+the queue position) and become ready for admission once the token count is
+known.  At most max_queue tickets wait beyond the free slots; past that a
+mention is turned away at once instead of queueing where nobody sees it.
+'''
+import asyncio
+import os
+import threading
+import time
+import weakref
+from collections import Counter, deque
+
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "4"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "16"))
+ADMISSION_MAX_PER_USER = int(os.getenv("ADMISSION_MAX_PER_USER", "2"))
+ADMISSION_MAX_PER_CHANNEL = int(os.getenv("ADMISSION_MAX_PER_CHANNEL", "4"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "300"))     #seconds in the queue before giving up
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "0"))   #0 is no budget
+
+TOKEN_WINDOW = 60.0
+
+_controllers = weakref.WeakSet()
+_controllers_lock = threading.Lock()
+
+
+def admission_controllers():
+    '''
+    The admission controllers alive in this process (metrics.py exports them).
+    '''
+    with _controllers_lock:
+        return list(_controllers)
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class AdmissionTimeout(Exception):
+    pass
+
+
+class Ticket:
+    def __init__(self, user_id, channel_id, enqueued_at):
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.enqueued_at = enqueued_at
+        self.position = 0
+        self.tokens = None      # set when ready for admission
+        self.ready_at = None
+        self.admitted_at = None
+        self.done = False
+
+    @property
+    def admitted(self):
+        return self.admitted_at is not None
+
+    @property
+    def wait_ms(self):
+        if self.ready_at is None or self.admitted_at is None:
+            return None
+        return round((self.admitted_at - self.ready_at) * 1000, 1)
+
+
+class _AdmissionState:
+    '''
+    Bookkeeping shared by the thread and asyncio controllers; callers hold
+    their own lock.
+    '''
+    def __init__(self, max_in_flight, max_queue, max_per_user, max_per_channel, tokens_per_minute, time_func):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.max_per_channel = max_per_channel
+        self.tokens_per_minute = tokens_per_minute
+        self.time_func = time_func
+        self.waiting = []
+        self.in_flight = 0
+        self.per_user = Counter()
+        self.per_channel = Counter()
+        self.token_window = deque()     # (admitted_at, tokens)
+        self.window_tokens = 0
+        self.counters = {"admitted": 0, "rejected": 0, "timed_out": 0, "max_queue_depth": 0,
+                         "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+
+    def stats(self):
+        self._expire_tokens(self.time_func())
+        return dict(self.counters, queue_depth=len(self.waiting), in_flight=self.in_flight,
+                    tokens_last_minute=self.window_tokens)
+
+    def gauges(self):
+        '''
+        (queue depth, in flight, tokens admitted over the last minute), read
+        without changing the state: metrics are scraped from another thread.
+        '''
+        since = self.time_func() - TOKEN_WINDOW
+        window_tokens = sum(tokens for admitted_at, tokens in list(self.token_window) if admitted_at > since)
+        return len(self.waiting), self.in_flight, window_tokens
+
+    def enqueue(self, user_id, channel_id):
+        #-the tickets ahead that will not get one of the free slots
+        position = max(len(self.waiting) + 1 - (self.max_in_flight - self.in_flight), 0)
+        if position > self.max_queue:
+            self.counters["rejected"] += 1
+            raise AdmissionRejected(f"{len(self.waiting)} requests are already waiting")
+        ticket = Ticket(user_id, channel_id, self.time_func())
+        ticket.position = position
+        self.waiting.append(ticket)
+        self.counters["max_queue_depth"] = max(self.counters["max_queue_depth"], len(self.waiting))
+        return ticket
+
+    def ready(self, ticket, tokens):
+        ticket.tokens = tokens
+        ticket.ready_at = self.time_func()
+
+    def _expire_tokens(self, now):
+        while self.token_window and self.token_window[0][0] <= now - TOKEN_WINDOW:
+            self.window_tokens -= self.token_window.popleft()[1]
+
+    def admit_ready(self):
+        '''
+        Admits what can run now.  Returns (whether any ticket was admitted,
+        seconds until the token budget frees up or None).
+        '''
+        now = self.time_func()
+        self._expire_tokens(now)
+        admitted = False
+        for ticket in list(self.waiting):
+            if self.in_flight >= self.max_in_flight:
+                break
+            if ticket.tokens is None:
+                continue
+            if (self.per_user[ticket.user_id] >= self.max_per_user or
+                    self.per_channel[ticket.channel_id] >= self.max_per_channel):
+                continue
+            if (self.tokens_per_minute and self.token_window and
+                    self.window_tokens + ticket.tokens > self.tokens_per_minute):
+                #-first come first served, smaller requests do not overtake
+                return admitted, self.token_window[0][0] + TOKEN_WINDOW - now
+            self.waiting.remove(ticket)
+            ticket.admitted_at = now
+            self.in_flight += 1
+            self.per_user[ticket.user_id] += 1
+            self.per_channel[ticket.channel_id] += 1
+            self.token_window.append((now, ticket.tokens))
+            self.window_tokens += ticket.tokens
+            self.counters["admitted"] += 1
+            self.counters["wait_ms_total"] += ticket.wait_ms
+            self.counters["wait_ms_max"] = max(self.counters["wait_ms_max"], ticket.wait_ms)
+            admitted = True
+        return admitted, None
+
+    def finish(self, ticket):
+        '''
+        Frees the ticket's slot, or takes it out of the queue.
+        '''
+        if ticket.done:
+            return
+        ticket.done = True
+        if ticket.admitted:
+            self.in_flight -= 1
+            self.per_user[ticket.user_id] -= 1
+            self.per_channel[ticket.channel_id] -= 1
+            #-Counter keeps zero entries
+            if not self.per_user[ticket.user_id]:
+                del self.per_user[ticket.user_id]
+            if not self.per_channel[ticket.channel_id]:
+                del self.per_channel[ticket.channel_id]
+        else:
+            self.waiting.remove(ticket)
+
+    def time_out(self, ticket, max_wait):
+        self.counters["timed_out"] += 1
+        self.finish(ticket)
+        return AdmissionTimeout(f"no free slot after waiting {max_wait:g}s")
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight=ADMISSION_MAX_IN_FLIGHT, max_queue=ADMISSION_MAX_QUEUE,
+                 max_per_user=ADMISSION_MAX_PER_USER, max_per_channel=ADMISSION_MAX_PER_CHANNEL,
+                 tokens_per_minute=OPENAI_TOKENS_PER_MINUTE, max_wait=ADMISSION_MAX_WAIT,
+                 time_func=time.monotonic):
+        self.state = _AdmissionState(max_in_flight, max_queue, max_per_user, max_per_channel,
+                                     tokens_per_minute, time_func)
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        with _controllers_lock:
+            _controllers.add(self)
+
+    @property
+    def stats(self):
+        with self.condition:
+            return self.state.stats()
+
+    def enqueue(self, user_id, channel_id):
+        '''
+        A ticket with its queue position (0 when a slot is free), or
+        AdmissionRejected when the queue is full.
+        '''
+        with self.condition:
+            return self.state.enqueue(user_id, channel_id)
+
+    def admit(self, ticket, tokens):
+        '''
+        Blocks until the ticket is admitted to use tokens; AdmissionTimeout
+        after max_wait seconds.
+        '''
+        with self.condition:
+            self.state.ready(ticket, tokens)
+            deadline = self.state.time_func() + self.max_wait
+            while True:
+                admitted, wake_after = self.state.admit_ready()
+                if admitted:
+                    self.condition.notify_all()
+                if ticket.admitted:
+                    return ticket
+                remaining = deadline - self.state.time_func()
+                if remaining <= 0:
+                    raise self.state.time_out(ticket, self.max_wait)
+                self.condition.wait(min(remaining, wake_after) if wake_after is not None else remaining)
+
+    def finish(self, ticket):
+        with self.condition:
+            self.state.finish(ticket)
+            self.state.admit_ready()
+            self.condition.notify_all()
+
+
+class AsyncAdmissionController(AdmissionController):
+    '''
+    AdmissionController for coroutines on one event loop.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.condition = None
+
+    def _condition(self):
+        #-created on first use so it belongs to the running loop (3.8 binds it at creation)
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        return self.condition
+
+    @property
+    def stats(self):
+        return self.state.stats()
+
+    def enqueue(self, user_id, channel_id):
+        return self.state.enqueue(user_id, channel_id)
+
+    async def admit(self, ticket, tokens):
+        condition = self._condition()
+        async with condition:
+            self.state.ready(ticket, tokens)
+            deadline = self.state.time_func() + self.max_wait
+            while True:
+                admitted, wake_after = self.state.admit_ready()
+                if admitted:
+                    condition.notify_all()
+                if ticket.admitted:
+                    return ticket
+                remaining = deadline - self.state.time_func()
+                if remaining <= 0:
+                    raise self.state.time_out(ticket, self.max_wait)
+                try:
+                    await asyncio.wait_for(condition.wait(),
+                                           min(remaining, wake_after) if wake_after is not None else remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def finish(self, ticket):
+        condition = self._condition()
+        async with condition:
+            self.state.finish(ticket)
+            self.state.admit_ready()
+            condition.notify_all()
@@ -0,0 +1,334 @@
+'''
+Asyncio variant of SlackGPTBot for slack_bolt's AsyncApp.
+
+The synchronous bot holds a thread for the whole streamed completion, so a
+process serves as many mentions at once as it has threads.  Here Slack and
+OpenAI calls are awaited on one event loop and a single process can stream
+dozens of completions concurrently.  Message processing is shared with the
+synchronous bot (utils.py); the blocking parts of it (URL fetching, token
+counting, context packing) run in the default executor so they never stall
+the loop.
+'''
+import asyncio
+import logging
+import time
+from functools import partial
+
+from openai import AsyncOpenAI
+
+from admission import AdmissionRejected, AsyncAdmissionController
+from completion_router import OPENAI_CLIENT_TIMEOUT, AsyncCompletionRouter, close_response
+from metrics import MENTIONS, observe_timings
+from response_cache import RESPONSE_CACHE_EMBEDDING_DIMENSIONS, RESPONSE_CACHE_EMBEDDING_MODEL
+from slack_gpt_bot import (BUSY_MESSAGE, CONTEXT_TOKEN_BUDGET, CONVERSATION_PAGE_SIZE,
+                           OPENAI_MAX_RESPONSE_TOKENS, OPENAI_MODEL_4_OHHHH,
+                           OPENAI_MODEL_4_OHHHH_TOKENS, SlackGPTBot, User)
+from slack_updater import AsyncChatUpdateCoalescer, AsyncSplitMessageWriter
+from structured_logging import reset_log_context, run_in_log_context, set_log_context
+from thread_state import AsyncThreadLocks
+from utils import (OPENAI_API_KEY, StageTimer, num_tokens_from_thread_state,
+                   thread_state_messages)
+
+
+class AsyncSlackGPTBot(SlackGPTBot):
+    def __init__(self, app, model_to_use=OPENAI_MODEL_4_OHHHH, model_tokens=OPENAI_MODEL_4_OHHHH_TOKENS,
+                 thread_state_store=None, max_response_tokens=OPENAI_MAX_RESPONSE_TOKENS,
+                 context_token_budget=CONTEXT_TOKEN_BUDGET, openai_client=None, user_cache=None,
+                 admission=None, completion_router=None, response_cache=None):
+        super().__init__(app, model_to_use, model_tokens, thread_state_store,
+                         max_response_tokens, context_token_budget,
+                         openai_client=openai_client or AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0,
+                                                                    timeout=OPENAI_CLIENT_TIMEOUT),
+                         user_cache=user_cache,
+                         admission=admission if admission is not None else AsyncAdmissionController(),
+                         completion_router=completion_router,
+                         response_cache=response_cache)
+        self.thread_locks = AsyncThreadLocks()
+        self.user_cache_warm_up = None
+
+    async def run_blocking(self, func, *args):
+        # asyncio.to_thread is 3.9+, the Flask image still runs 3.8
+        return await asyncio.get_running_loop().run_in_executor(None, run_in_log_context(func, *args))
+
+    async def get_conversation_history(self, channel_id, thread_ts, oldest=None):
+        messages = []
+        seen_ts = set()
+        cursor = None
+        while True:
+            kwargs = {"channel": channel_id, "ts": thread_ts, "limit": CONVERSATION_PAGE_SIZE}
+            if oldest is None:
+                kwargs["inclusive"] = True
+            else:
+                kwargs["oldest"] = oldest
+                kwargs["inclusive"] = False
+            if cursor:
+                kwargs["cursor"] = cursor
+            response = await self.app.client.conversations_replies(**kwargs)
+            #-every page can start with the thread's parent message again
+            for message in response['messages']:
+                if message['ts'] not in seen_ts:
+                    seen_ts.add(message['ts'])
+                    messages.append(message)
+            cursor = (response.get('response_metadata') or {}).get('next_cursor')
+            if not cursor:
+                return {"messages": messages}
+
+    async def get_thread_state(self, channel_id, thread_ts, bot_user_id, reply_message_ts=None, until_ts=None,
+                               timer=None):
+        timer = timer or StageTimer()
+        async with self.thread_locks.hold(channel_id, thread_ts):
+            with timer.stage("thread_state_load"):
+                state = await self.run_blocking(self.thread_state_store.load, channel_id, thread_ts)
+            with timer.stage("conversation_history"):
+                conversation_history = await self.get_conversation_history(channel_id, thread_ts, state["last_ts"])
+            with timer.stage("thread_processing"):
+                return await self.run_blocking(self.process_thread_history, state, conversation_history,
+                                               channel_id, thread_ts, bot_user_id, reply_message_ts, until_ts)
+
+    async def get_user_information(self, user_id):
+        user_info = await self.user_cache.lookup_async(user_id, self.fetch_user_information)
+        return self.parse_user_information(user_id, user_info)
+
+    async def fetch_user_information(self, user_id):
+        return await self.app.client.users_info(user=user_id)
+
+    async def warm_user_cache(self):
+        started = time.perf_counter()
+        try:
+            pages = await self.user_cache.warm_async(self.app.client.users_list)
+            self.logging_wrapper("UserCacheWarmed", logging.INFO,
+                                 pages=pages,
+                                 duration_ms=round((time.perf_counter() - started) * 1000, 1),
+                                 user_cache=self.user_cache.stats)
+        except Exception as e:
+            self.logging_wrapper("UserCacheWarmFailed", logging.WARNING,
+                                 exception=e,
+                                 user_cache=self.user_cache.stats)
+
+    def start_user_cache_warm_up(self):
+        '''
+        Must be called inside the running event loop.
+        '''
+        self.user_cache_warm_up = asyncio.ensure_future(self.warm_user_cache())
+        return self.user_cache_warm_up
+
+    async def post_wait_message(self, channel_id, thread_ts, user_id, timer, position=0):
+        with timer.stage("users_info"):
+            user = await self.get_user_information(user_id)
+        with timer.stage("wait_message"):
+            slack_resp = await self.app.client.chat_postMessage(
+                channel=channel_id,
+                thread_ts=thread_ts,
+                text=self.build_personalized_wait_message(user.real_name, position)
+            )
+        return user, slack_resp['message']['ts']
+
+    async def reject_mention(self, channel_id, thread_ts, exception):
+        self.logging_wrapper("AdmissionRejected", logging.WARNING,
+                             exception=exception,
+                             admission=self.admission.stats)
+        await self.app.client.chat_postMessage(
+            channel=channel_id,
+            thread_ts=thread_ts,
+            text=BUSY_MESSAGE)
+
+    async def abandon_preparation(self, wait_message, openai_response, user):
+        await close_response(openai_response)
+        if wait_message is not None:
+            try:
+                user, _ = await wait_message
+            except Exception:
+                pass
+        return user
+
+    def build_preparation_pool(self):
+        #-the wait message is posted on the event loop
+        return None
+
+    def build_message_writer(self, channel_id, thread_ts, reply_message_ts):
+        return AsyncSplitMessageWriter(partial(self.update_chat, channel_id),
+                                       partial(self.post_chat, channel_id, thread_ts),
+                                       reply_message_ts)
+
+    def build_chat_updater(self, message_writer):
+        return AsyncChatUpdateCoalescer(message_writer)
+
+    def build_completion_router(self, routes):
+        return AsyncCompletionRouter(self.openai_client, routes)
+
+    async def embed(self, text):
+        response = await self.openai_client.embeddings.create(model=RESPONSE_CACHE_EMBEDDING_MODEL, input=text,
+                                                              dimensions=RESPONSE_CACHE_EMBEDDING_DIMENSIONS)
+        return response.data[0].embedding
+
+    async def stream_openai_response_to_slack(self, openai_response, updater, timer=None):
+        response_text = ""
+        finish_reason = None
+        try:
+            async for chunk in openai_response:
+                if chunk.choices[0].delta.content is not None:
+                    if timer is not None and not response_text:
+                        timer.mark("first_token")
+                    response_text += chunk.choices[0].delta.content
+                    updater.submit(response_text)
+                elif chunk.choices[0].finish_reason is not None:
+                    finish_reason = chunk.choices[0].finish_reason
+                    if finish_reason == 'stop':
+                        break
+        except BaseException:
+            updater.close()
+            raise
+        finally:
+            #-the stream is left at the finish reason, release its connection
+            await close_response(openai_response)
+        await updater.finish(response_text)
+
+        return response_text, finish_reason
+
+    async def update_chat(self, channel_id, reply_message_ts, response_text):
+        await self.app.client.chat_update(
+            channel=channel_id,
+            ts=reply_message_ts,
+            text=response_text
+        )
+
+    async def post_chat(self, channel_id, thread_ts, text):
+        slack_resp = await self.app.client.chat_postMessage(
+            channel=channel_id,
+            thread_ts=thread_ts,
+            text=text
+        )
+        return slack_resp['message']['ts']
+
+    ################################################
+    # @app.event("app_mention")
+    async def handle_app_mentions(self, body, context):
+        num_conversation_tokens = None
+        max_response_tokens = None
+        channel_id = None
+        thread_ts = None
+        user_id = None
+        user = User(None, "", "", "")
+        messages = [None]
+        timer = StageTimer()
+        wait_message = None
+        openai_response = None
+        log_context_token = None
+        turn = None
+        ticket = None
+        cache_lookup = None
+        outcome = "error"
+
+        try:
+            self.logging_wrapper("Arguments", logging.DEBUG, body=body, context=context)
+
+            channel_id = body['event']['channel']
+            thread_ts = body['event'].get('thread_ts', body['event']['ts'])
+            bot_user_id = context['bot_user_id']
+            user_id = context['user_id']
+            log_context_token = set_log_context(channel_id=channel_id, thread_ts=thread_ts, user_id=user_id)
+            #-until it is answered, replies after this mention are not stored in the thread state
+            turn = self.open_turns.open(channel_id, thread_ts, body['event']['ts'])
+
+            try:
+                ticket = self.admission.enqueue(user_id, channel_id)
+            except AdmissionRejected as e:
+                await self.reject_mention(channel_id, thread_ts, e)
+                outcome = "rejected"
+                return
+
+            #-the wait message is posted while the thread is read and processed
+            wait_message = asyncio.ensure_future(self.post_wait_message(channel_id, thread_ts, user_id, timer,
+                                                                        ticket.position))
+            thread_state = await self.get_thread_state(channel_id, thread_ts, bot_user_id,
+                                                       until_ts=body['event']['ts'], timer=timer)
+            messages = thread_state_messages(thread_state)
+            num_conversation_tokens = num_tokens_from_thread_state(thread_state, self.model_to_use)
+            with timer.stage("context_packing"):
+                messages, num_conversation_tokens, max_response_tokens = await self.run_blocking(
+                    self.fit_to_context, messages, num_conversation_tokens, channel_id, thread_ts, user_id)
+
+            self.logging_wrapper("Milestone", logging.DEBUG,
+                            milestone="Forwarding request to OpenAI",
+                            model_used=self.model_to_use,
+                            token_count=self.model_tokens,
+                            token_used_count=num_conversation_tokens,
+                            user_id=user_id,
+                            request=messages[-1])
+
+            if self.response_cache is not None:
+                with timer.stage("response_cache"):
+                    cache_lookup = await self.response_cache.lookup_async(channel_id, self.model_to_use, messages)
+            if cache_lookup is not None and cache_lookup.hit:
+                openai_response = cache_lookup.replay()
+            else:
+                with timer.stage("admission_wait"):
+                    await self.admission.admit(ticket, num_conversation_tokens + max_response_tokens)
+
+                with timer.stage("openai_request"):
+                    openai_response = await self.completion_router.create(
+                        messages, num_conversation_tokens, max_response_tokens)
+
+            with timer.stage("wait_message_pending"):
+                user, reply_message_ts = await wait_message
+
+            message_writer = self.build_message_writer(channel_id, thread_ts, reply_message_ts)
+            updater = self.build_chat_updater(message_writer)
+            response_text, finish_reason = await self.stream_openai_response_to_slack(openai_response, updater,
+                                                                                      timer)
+            timer.mark("total")
+            outcome = "cached" if cache_lookup is not None and cache_lookup.hit else "answered"
+            if cache_lookup is not None and self.is_cacheable(openai_response, finish_reason):
+                await self.run_blocking(self.response_cache.store, cache_lookup, response_text, openai_response.model)
+
+            self.logging_wrapper("RequestResponse", logging.INFO,
+                model_used=openai_response.model,
+                token_used_count=num_conversation_tokens,
+                max_response_tokens=max_response_tokens,
+                channel_id=channel_id,
+                thread_ts=thread_ts,
+                user_id=user_id,
+                user=user.username,
+                email=user.email,
+                request=messages[-1],
+                response=response_text,
+                chat_updates=updater.stats,
+                reply_messages=len(message_writer.message_ts),
+                timings_ms=timer.timings,
+                user_cache=self.user_cache.stats,
+                thread_lock_waits=self.thread_locks.waits,
+                queue_position=ticket.position,
+                admission=self.admission.stats,
+                response_cache=cache_lookup.hit if cache_lookup is not None else None,
+                response_cache_similarity=cache_lookup.similarity if cache_lookup is not None else None
+            )
+
+        except Exception as e:
+            user = await self.abandon_preparation(wait_message, openai_response, user)
+            self.logging_wrapper("Exception", logging.ERROR,
+                model_used=self.model_to_use,
+                token_used_count=num_conversation_tokens,
+                max_response_tokens=max_response_tokens,
+                channel_id=channel_id,
+                thread_ts=thread_ts,
+                user_id=user_id,
+                user=user.username,
+                email=user.email,
+                request=messages[-1],
+                timings_ms=timer.timings,
+                admission=self.admission.stats,
+                exception=e
+            )
+            await self.app.client.chat_postMessage(
+                channel=channel_id,
+                thread_ts=thread_ts,
+                text=f"Sorry, I can't provide a response. Encountered an error:\n`\n{e}\n`")
+        finally:
+            MENTIONS.labels(outcome).inc()
+            observe_timings(timer.timings)
+            if ticket is not None:
+                await self.admission.finish(ticket)
+            if turn is not None:
+                self.open_turns.close(turn)
+            if log_context_token is not None:
+                reset_log_context(log_context_token)
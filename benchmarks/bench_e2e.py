@@ -0,0 +1,378 @@
+'''
+End-to-end benchmark: mentions through the whole bot, offline.
+
+Every scenario starts a fresh bot against local stand-ins (fake_services.py)
+for the Slack Web API, the OpenAI streaming endpoint and the pages the
+threads link to, creates synthetic threads of a given size (the mention at
+the end links to --links pages), and keeps `concurrency` mentions in flight
+until all --mentions are answered.  Scenarios are the product of
+
+    --bots          sync (SlackGPTBot), async (AsyncSlackGPTBot)
+    --entries       bot: handle_app_mentions called directly
+                    bolt: events dispatched through App / AsyncApp set up like
+                    main_flask.py and main_async_http.py (ack first, listener
+                    executor, event deduplication)
+    --thread-sizes  messages per thread
+    --concurrency   mentions in flight at once
+
+and each reports, over its mentions:
+
+    first update   time from the mention to the first chat.update of the answer
+    total          time from the mention until its handler returned
+    slack calls    Web API calls per mention, and per method
+    rss peak       peak resident memory of the bot process (extraction
+                   workers are separate processes and not included)
+
+--save writes the results as JSON (benchmarks/baselines/ has the ones we
+compare against); --compare prints the change from such a file and exits
+with status 1 when a latency, call count or memory figure got worse by more
+than --tolerance.  Baselines are only comparable on the same machine.
+
+Usage (from the repository root):
+
+    python benchmarks/bench_e2e.py [--mentions 8] [--thread-sizes 1,100] [--concurrency 1,8]
+    python benchmarks/bench_e2e.py --save benchmarks/baselines/e2e.json
+    python benchmarks/bench_e2e.py --compare benchmarks/baselines/e2e.json
+'''
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from json_logger_stdout import json_std_logger
+from openai import AsyncOpenAI, OpenAI
+from slack_bolt import App, BoltRequest
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.authorization import AuthorizeResult
+from slack_bolt.request.async_request import AsyncBoltRequest
+from slack_sdk import WebClient
+from slack_sdk.web.async_client import AsyncWebClient
+
+from async_slack_gpt_bot import AsyncSlackGPTBot
+from cache import MemoryCacheBackend
+from event_dedup import EventDeduplicator
+from extraction_pool import process_rss
+from fake_services import FakeContent, FakeOpenAI, FakeSlack, use_offline_tokenizer_if_needed
+from slack_gpt_bot import MENTION_WORKERS, SlackGPTBot
+
+CHANNEL = "CBENCH"
+FILLER = ("Could you explain how the deployment pipeline promotes a build from staging to production, "
+          "and what happens when a health check fails halfway through? ")
+#seconds a mention may take before the run is considered stuck
+MENTION_TIMEOUT = 120
+RSS_SAMPLE_INTERVAL = 0.05
+
+#(metric, smallest absolute change that counts as a regression)
+COMPARED_METRICS = (("first_update_p50_ms", 20.0), ("first_update_p95_ms", 20.0),
+                    ("total_p50_ms", 20.0), ("total_p95_ms", 20.0),
+                    ("slack_calls_per_mention", 0.5), ("rss_peak_mb", 10.0))
+
+Scenario = namedtuple("Scenario", ("bot", "entry", "thread_size", "concurrency"))
+Mention = namedtuple("Mention", ("thread_ts", "ts", "user", "text"))
+
+
+def scenario_name(scenario):
+    return f"{scenario.bot}-{scenario.entry}-t{scenario.thread_size}-c{scenario.concurrency}"
+
+
+def percentile(values, p):
+    '''
+    Nearest-rank percentile, None for no values.
+    '''
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(int(round(p / 100 * len(ordered) + 0.5)) - 1, 0)]
+
+
+def build_thread(slack, content, prefix, index, size, links):
+    '''
+    size messages, alternating between a user and the bot, ending with a
+    mention that links to `links` pages.
+    '''
+    user = f"U{index}"
+    messages = [(user if i % 2 == 0 else slack.bot_user_id, f"Message {i}. {FILLER}") for i in range(size - 1)]
+    urls = " ".join(f"<{content.url(f'{prefix}/{index}/{k}')}>" for k in range(links))
+    text = f"<@{slack.bot_user_id}> please summarize this thread {urls}".strip()
+    messages.append((user, text))
+    thread_ts = slack.add_thread(CHANNEL, messages)
+    with slack.lock:
+        ts = slack.threads[(CHANNEL, thread_ts)][-1]["ts"]
+    return Mention(thread_ts, ts, user, text)
+
+
+def event_body(mention, event_id):
+    return {"type": "event_callback", "team_id": "T1", "api_app_id": "A1", "event_id": event_id,
+            "event": {"type": "app_mention", "channel": CHANNEL, "user": mention.user, "text": mention.text,
+                      "ts": mention.ts, "thread_ts": mention.thread_ts}}
+
+
+def mention_context(slack, mention):
+    return {"bot_user_id": slack.bot_user_id, "user_id": mention.user}
+
+
+def bolt_request(request_class, body):
+    return request_class(body=json.dumps(body), headers={"content-type": ["application/json"]})
+
+
+class RSSSampler:
+    '''
+    Peak resident memory of this process while it runs.
+    '''
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = process_rss(os.getpid()) or 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, process_rss(os.getpid()) or 0)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, process_rss(os.getpid()) or 0)
+
+
+def run_sync(scenario, slack, openai, mentions, warmup):
+    def authorize(**kwargs):
+        return AuthorizeResult(enterprise_id=None, team_id="T1", bot_user_id=slack.bot_user_id,
+                               bot_id="B1", bot_token="xoxb-test")
+
+    app = App(client=WebClient(token="xoxb-test", base_url=slack.base_url), signing_secret="bench",
+              authorize=authorize, request_verification_enabled=False, process_before_response=False,
+              listener_executor=ThreadPoolExecutor(max_workers=MENTION_WORKERS, thread_name_prefix="mention"))
+    bot = SlackGPTBot(app, openai_client=OpenAI(api_key="test", base_url=openai.base_url, max_retries=0))
+    finished = {}
+
+    if scenario.entry == "bolt":
+        app.use(EventDeduplicator(MemoryCacheBackend()).bolt_middleware)
+
+        @app.event("app_mention")
+        def handle_app_mentions(body, context):
+            try:
+                bot.handle_app_mentions(body, context)
+            finally:
+                finished[body["event"]["ts"]].set()
+
+    def run_one(item):
+        index, mention = item
+        started = time.monotonic()
+        if scenario.entry == "bolt":
+            done = finished[mention.ts] = threading.Event()
+            app.dispatch(bolt_request(BoltRequest, event_body(mention, f"Ev{index}")))
+            if not done.wait(MENTION_TIMEOUT):
+                raise TimeoutError(f"mention {mention.ts} was not answered")
+        else:
+            bot.handle_app_mentions(event_body(mention, f"Ev{index}"), mention_context(slack, mention))
+        return started, time.monotonic()
+
+    warmed_up = run_one((-1, warmup))
+    with ThreadPoolExecutor(max_workers=scenario.concurrency) as pool:
+        return warmed_up, list(pool.map(run_one, enumerate(mentions)))
+
+
+def run_async(scenario, slack, openai, mentions, warmup):
+    async def authorize(**kwargs):
+        return AuthorizeResult(enterprise_id=None, team_id="T1", bot_user_id=slack.bot_user_id,
+                               bot_id="B1", bot_token="xoxb-test")
+
+    async def main():
+        app = AsyncApp(client=AsyncWebClient(token="xoxb-test", base_url=slack.base_url), signing_secret="bench",
+                       authorize=authorize, request_verification_enabled=False, process_before_response=False)
+        bot = AsyncSlackGPTBot(app, openai_client=AsyncOpenAI(api_key="test", base_url=openai.base_url,
+                                                              max_retries=0))
+        finished = {}
+        semaphore = asyncio.Semaphore(scenario.concurrency)
+
+        if scenario.entry == "bolt":
+            app.use(EventDeduplicator(MemoryCacheBackend()).async_bolt_middleware)
+
+            @app.event("app_mention")
+            async def handle_app_mentions(body, context):
+                try:
+                    await bot.handle_app_mentions(body, context)
+                finally:
+                    finished[body["event"]["ts"]].set_result(None)
+
+        async def run_one(index, mention):
+            async with semaphore:
+                started = time.monotonic()
+                if scenario.entry == "bolt":
+                    done = finished[mention.ts] = asyncio.get_running_loop().create_future()
+                    await app.async_dispatch(bolt_request(AsyncBoltRequest, event_body(mention, f"Ev{index}")))
+                    await asyncio.wait_for(done, MENTION_TIMEOUT)
+                else:
+                    await bot.handle_app_mentions(event_body(mention, f"Ev{index}"), mention_context(slack, mention))
+                return started, time.monotonic()
+
+        warmed_up = await run_one(-1, warmup)
+        return warmed_up, await asyncio.gather(*(run_one(index, mention) for index, mention in enumerate(mentions)))
+
+    return asyncio.run(main())
+
+
+def run_scenario(scenario, args, openai, content, run_id):
+    slack = FakeSlack(latency=args.slack_latency, rate_limit_every=args.rate_limit_every,
+                      retry_after=args.retry_after).start()
+    try:
+        prefix = f"{run_id}/{scenario_name(scenario)}"
+        warmup = build_thread(slack, content, prefix, "warmup", scenario.thread_size, args.links)
+        mentions = [build_thread(slack, content, prefix, i, scenario.thread_size, args.links)
+                    for i in range(args.mentions)]
+        runner = run_sync if scenario.bot == "sync" else run_async
+        with RSSSampler() as rss:
+            #-the warm-up mention is answered first and left out of the figures
+            (_, warmup_finished), timings = runner(scenario, slack, openai, mentions, warmup)
+        wall = time.monotonic() - warmup_finished
+        with slack.lock:
+            calls = Counter(method for at, method, _ in slack.call_log if at >= warmup_finished)
+    finally:
+        slack.stop()
+
+    first_updates, totals = [], []
+    for mention, (mention_started, mention_finished) in zip(mentions, timings):
+        totals.append((mention_finished - mention_started) * 1000)
+        updates = [at for at, method in slack.calls_by_thread(mention.thread_ts)
+                   if method == "chat.update" and at >= mention_started]
+        if updates:
+            first_updates.append((min(updates) - mention_started) * 1000)
+    calls_per_mention = sum(calls.values()) / len(mentions)
+
+    def rounded(value):
+        return None if value is None else round(value, 1)
+
+    return {
+        "mentions": len(mentions),
+        "answered": len(first_updates),
+        "first_update_p50_ms": rounded(percentile(first_updates, 50)),
+        "first_update_p95_ms": rounded(percentile(first_updates, 95)),
+        "total_p50_ms": rounded(percentile(totals, 50)),
+        "total_p95_ms": rounded(percentile(totals, 95)),
+        "slack_calls_per_mention": round(calls_per_mention, 2),
+        "slack_calls": {method: round(count / len(mentions), 2) for method, count in sorted(calls.items())},
+        "rss_peak_mb": round(rss.peak / 2 ** 20, 1),
+        "wall_s": round(wall, 2),
+        "mentions_per_s": round(len(mentions) / wall, 2),
+    }
+
+
+def print_results(results):
+    print(f"{'scenario':<26}{'first update p50/p95 ms':>26}{'total p50/p95 ms':>22}"
+          f"{'slack calls':>13}{'rss peak MB':>13}{'mentions/s':>12}")
+    for name, result in results["scenarios"].items():
+        print(f"{name:<26}{result['first_update_p50_ms']:>14}/{result['first_update_p95_ms']:<11}"
+              f"{result['total_p50_ms']:>11}/{result['total_p95_ms']:<10}"
+              f"{result['slack_calls_per_mention']:>13}{result['rss_peak_mb']:>13}{result['mentions_per_s']:>12}")
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Prints the change of every compared metric; returns the regressions.
+    '''
+    regressions = []
+    print(f"\ncompared with {baseline.get('created_at')} ({baseline.get('environment', {}).get('python')})")
+    for name, result in results["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(name)
+        if old is None:
+            print(f"{name}: not in the baseline")
+            continue
+        changes = []
+        for metric, min_change in COMPARED_METRICS:
+            before, after = old.get(metric), result.get(metric)
+            if before is None or after is None:
+                continue
+            flag = ""
+            if after - before > min_change and after > before * (1 + tolerance):
+                flag = " REGRESSION"
+                regressions.append((name, metric, before, after))
+            change = f"{(after - before) / before * 100:+.0f}%" if before else "n/a"
+            changes.append(f"{metric} {before} -> {after} ({change}){flag}")
+        print(f"{name}:\n    " + "\n    ".join(changes))
+    return regressions
+
+
+def parse_list(value, convert=str):
+    return [convert(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bots", type=parse_list, default=["sync", "async"])
+    parser.add_argument("--entries", type=parse_list, default=["bot", "bolt"])
+    parser.add_argument("--thread-sizes", type=lambda value: parse_list(value, int), default=[1, 100])
+    parser.add_argument("--concurrency", type=lambda value: parse_list(value, int), default=[1, 8])
+    parser.add_argument("--mentions", type=int, default=8, help="measured mentions per scenario")
+    parser.add_argument("--links", type=int, default=2, help="pages each mention links to")
+    parser.add_argument("--paragraphs", type=int, default=20, help="paragraphs per linked page")
+    parser.add_argument("--chunks", type=int, default=30, help="chunks per streamed answer")
+    parser.add_argument("--chunk-delay", type=float, default=0.01)
+    parser.add_argument("--first-token-delay", type=float, default=0.1)
+    parser.add_argument("--slack-latency", type=float, default=0.02)
+    parser.add_argument("--content-latency", type=float, default=0.02)
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="answer every n-th chat.update with a 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change counted as a regression")
+    args = parser.parse_args()
+    json_std_logger.setLevel(logging.WARNING)
+    for name in ("httpx", "httpx2", "slack_bolt", "slack_sdk"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    if use_offline_tokenizer_if_needed():
+        print("tiktoken encoding unavailable, counting tokens with a whitespace tokenizer")
+
+    openai = FakeOpenAI(chunks=args.chunks, chunk_delay=args.chunk_delay,
+                        first_token_delay=args.first_token_delay).start()
+    content = FakeContent(paragraphs=args.paragraphs, latency=args.content_latency).start()
+    run_id = int(time.time())
+    results = {
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count()},
+        "config": {key: value for key, value in vars(args).items() if key not in ("save", "compare")},
+        "scenarios": {},
+    }
+    try:
+        for values in itertools.product(args.bots, args.entries, args.thread_sizes, args.concurrency):
+            scenario = Scenario(*values)
+            results["scenarios"][scenario_name(scenario)] = run_scenario(scenario, args, openai, content, run_id)
+            print(f"{scenario_name(scenario)} done", file=sys.stderr)
+    finally:
+        openai.stop()
+        content.stop()
+
+    print_results(results)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s)")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
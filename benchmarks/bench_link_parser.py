@@ -0,0 +1,73 @@
+'''
+Micro-benchmark: Slack link extraction, the old regex vs slack_links.
+
+The old pattern backtracks exponentially on an unterminated <url|label
+link (each extra character roughly doubles the time), so it is only run up
+to --old-max characters.  The tokenizer is run on the same input and on
+adversarial inputs up to a megabyte.
+
+Usage (from the repository root):
+
+    python benchmarks/bench_link_parser.py [--old-max 22] [--repeat 5]
+'''
+import argparse
+import os
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from slack_links import extract_urls
+
+OLD_PATTERN = r'<(http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+)>'
+
+ADVERSARIAL = {
+    "long <url|label": lambda n: "<https://" + "A" * n + "|label",
+    "<<<<...>": lambda n: "<" * n + ">",
+    "<a|a|a|...": lambda n: "<" + "a|" * (n // 2),
+    "many links": lambda n: "<https://x.io/a|b> " * (n // 19),
+}
+
+
+def old_extract_url_list(text):
+    url_pattern = re.compile(OLD_PATTERN)
+    return url_pattern.findall(text)
+
+
+def timed(func, text, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(text)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--old-max", type=int, default=22)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print("unterminated <https://AAA...|label")
+    print(f"{'chars':>8} {'old ms':>12} {'new ms':>10}")
+    for n in range(10, args.old_max + 1, 2):
+        text = ADVERSARIAL["long <url|label"](n)
+        old = timed(old_extract_url_list, text, 1)
+        new = timed(extract_urls, text, args.repeat)
+        print(f"{n:>8} {old * 1000:>12.3f} {new * 1000:>10.4f}")
+
+    print()
+    print("tokenizer on adversarial inputs")
+    print(f"{'input':>18} {'chars':>9} {'new ms':>10} {'ns/char':>8}")
+    for name, make in ADVERSARIAL.items():
+        for n in (10000, 100000, 1000000):
+            text = make(n)
+            new = timed(extract_urls, text, args.repeat)
+            print(f"{name:>18} {len(text):>9} {new * 1000:>10.3f} {new * 1e9 / len(text):>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
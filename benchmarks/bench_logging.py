@@ -0,0 +1,113 @@
+'''
+Micro-benchmark: logging cost of processing one mention's thread.
+
+Runs utils.process_message over synthetic threads the way a mention does and
+reports the time spent in logging (total minus a run with logging stubbed
+out), per mention:
+
+    legacy  the json_std_logger._setParams wrapper as it was
+    sync    structured_logging.logging_wrapper, handlers on the request thread
+    queue   structured_logging with LOG_QUEUE (listener thread formats/writes;
+            lines that do not fit in LOG_QUEUE_SIZE are dropped and counted)
+
+at INFO (the DEBUG milestones are off) and at DEBUG.  Log lines go to
+/dev/null.
+
+Usage (from the repository root):
+
+    python benchmarks/bench_logging.py [--repeat 20]
+'''
+import argparse
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from json_logger_stdout import json_std_logger
+
+import structured_logging
+import utils
+
+THREAD_SIZES = (50, 200, 1000)
+
+
+def legacy_logging_wrapper(message, severity=logging.INFO, **kwargs):
+    json_std_logger._setParams(**kwargs)
+
+    log = {
+        logging.DEBUG: json_std_logger.debug,
+        logging.ERROR: json_std_logger.error,
+        logging.CRITICAL: json_std_logger.critical,
+        logging.WARNING: json_std_logger.warning
+    }
+    func = log.get(severity, json_std_logger.info)
+    func(message)
+
+
+def no_logging(message, severity=logging.INFO, **kwargs):
+    pass
+
+
+def synthetic_thread(size):
+    messages = []
+    for i in range(size):
+        user = "UBOT" if i % 2 else "U1"
+        messages.append({"type": "message", "ts": f"1700000000.{i:06d}", "user": user,
+                         "text": f"message {i} " + "lorem ipsum dolor sit amet " * 20})
+    return messages
+
+
+def process_thread(messages):
+    for message in messages:
+        utils.process_message(message, "UBOT", {})
+
+
+def timed(messages, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        process_thread(messages)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def logging_cost(wrapper, messages, repeat):
+    utils.logging_wrapper = no_logging
+    baseline = timed(messages, repeat)
+    utils.logging_wrapper = wrapper
+    return max(timed(messages, repeat) - baseline, 0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, "w")
+    for handler in json_std_logger.logger.handlers:
+        if isinstance(handler, logging.StreamHandler):
+            handler.setStream(devnull)
+    original_wrapper = utils.logging_wrapper
+
+    print(f"{'messages':>8} {'level':>6} {'legacy ms':>10} {'sync ms':>10} {'queue ms':>10} {'dropped':>8}")
+    for level in (logging.INFO, logging.DEBUG):
+        json_std_logger.setLevel(level)
+        for size in THREAD_SIZES:
+            messages = synthetic_thread(size)
+            legacy = logging_cost(legacy_logging_wrapper, messages, args.repeat)
+            sync = logging_cost(original_wrapper, messages, args.repeat)
+            listener = structured_logging.enable_queue_logging()
+            queued = logging_cost(original_wrapper, messages, args.repeat)
+            queue_handler, = json_std_logger.logger.handlers
+            listener.stop()
+            json_std_logger.logger.handlers[:] = listener.handlers
+            print(f"{size:>8} {logging.getLevelName(level):>6} {legacy * 1000:>10.3f} "
+                  f"{sync * 1000:>10.3f} {queued * 1000:>10.3f} {queue_handler.dropped:>8}")
+    utils.logging_wrapper = original_wrapper
+
+
+if __name__ == "__main__":
+    main()
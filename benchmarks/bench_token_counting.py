@@ -0,0 +1,100 @@
+'''
+Micro-benchmark: token counting on synthetic threads, old vs new.
+
+"old" is the counting loop as it was before the encoder and per-message
+counts were cached: the encoding is resolved on every call and every message
+is re-encoded.  "cold" is the new code on a thread it has never seen (batch
+path), "warm" the new code on a thread that grew by one message since the
+previous mention.
+
+Usage (from the repository root; tiktoken downloads the encoding the first
+time it runs):
+
+    python benchmarks/bench_token_counting.py [--repeat 5] [--model gpt-4o]
+'''
+import argparse
+import itertools
+import os
+import random
+import statistics
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tiktoken
+
+import utils
+from cache import MemoryCacheBackend
+
+THREAD_SIZES = (50, 200, 1000)
+
+
+def old_num_tokens_from_messages(messages, model):
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    num_tokens = 0
+    for message in messages:
+        num_tokens += 3
+        for key, value in message.items():
+            num_tokens += len(encoding.encode(value))
+            if key == "name":
+                num_tokens += 1
+    return num_tokens + 3
+
+
+def synthetic_thread(size, rng):
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10))) for _ in range(2000)]
+    messages = [{"role": "system", "content": utils.SYSTEM_PROMPT}]
+    for i in range(size):
+        role = "user" if i % 2 == 0 else "assistant"
+        #-every tenth user message carries a scraped page
+        length = 3000 if role == "user" and i % 10 == 0 else rng.randint(20, 200)
+        messages.append({"role": role, "content": " ".join(rng.choices(words, k=length))})
+    return messages
+
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--model", default="gpt-4o")
+    args = parser.parse_args()
+    rng = random.Random(42)
+
+    print(f"{'messages':>8} {'old ms':>10} {'cold ms':>10} {'warm ms':>10} {'old/warm':>9}")
+    for size in THREAD_SIZES:
+        thread = synthetic_thread(size, rng)
+        follow_up = thread + [{"role": "user", "content": "and one more question"}]
+        assert old_num_tokens_from_messages(thread, args.model) == sum(utils.num_tokens_per_message(thread, args.model)) + 3
+
+        def cold():
+            utils.token_count_cache = MemoryCacheBackend(max_entries=utils.TOKEN_COUNT_CACHE_SIZE)
+            utils.num_tokens_per_message(thread, args.model)
+
+        counter = itertools.count()
+
+        def warm():
+            question = {"role": "user", "content": f"follow up question {next(counter)}"}
+            utils.num_tokens_per_message(thread + [question], args.model)
+
+        old = timed(lambda: old_num_tokens_from_messages(follow_up, args.model), args.repeat)
+        cold_time = timed(cold, args.repeat)
+        utils.num_tokens_per_message(thread, args.model)
+        warm_time = timed(warm, args.repeat)
+        print(f"{size:>8} {old * 1000:>10.2f} {cold_time * 1000:>10.2f} {warm_time * 1000:>10.2f} {old / warm_time:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
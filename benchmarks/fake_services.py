@@ -0,0 +1,350 @@
+'''
+Local stand-ins for the Slack Web API, the OpenAI streaming chat
+completions endpoint and the web pages threads link to, for load tests and
+benchmarks that must not leave the machine.
+
+Each runs a ThreadingHTTPServer on 127.0.0.1 in a daemon thread:
+
+    slack = FakeSlack(latency=0.05).start()
+    client = WebClient(token="xoxb-test", base_url=slack.base_url)
+
+    openai = FakeOpenAI(chunks=100, chunk_delay=0.01).start()
+    client = OpenAI(api_key="test", base_url=openai.base_url)
+
+    content = FakeContent(paragraphs=20).start()
+    url = content.url("docs/onboarding")
+'''
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+class FakeServer:
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = self.protocol_version
+
+            def do_GET(self):
+                server.dispatch(self)
+
+            def do_POST(self):
+                server.dispatch(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True)
+
+    @property
+    def port(self):
+        return self.httpd.server_port
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    @staticmethod
+    def read_params(handler):
+        params = dict(parse_qsl(urlsplit(handler.path).query))
+        length = int(handler.headers.get("Content-Length") or 0)
+        if length:
+            body = handler.rfile.read(length).decode("utf-8")
+            if handler.headers.get("Content-Type", "").startswith("application/json"):
+                params.update(json.loads(body))
+            else:
+                params.update(parse_qsl(body))
+        return params
+
+    @staticmethod
+    def send_json(handler, payload, status=200, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json; charset=utf-8")
+        handler.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def dispatch(self, handler):
+        raise NotImplementedError
+
+
+class FakeSlack(FakeServer):
+    '''
+    users.info, chat.postMessage, chat.update and conversations.replies.
+    Threads live in memory (channel, thread_ts) -> [message], and every call
+    waits latency seconds.  rate_limit_every=n answers every n-th chat.update
+    with HTTP 429 and Retry-After: retry_after.  Every call is logged as
+    (monotonic time, method, thread_ts) in call_log, and message_times has
+    the times each message the bot posted was posted and updated.
+    '''
+    def __init__(self, latency=0.0, rate_limit_every=0, retry_after=1, bot_user_id="UBOT"):
+        super().__init__()
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.bot_user_id = bot_user_id
+        self.threads = {}
+        self.messages = {}   # (channel, ts) -> message
+        self.ts_counter = 0
+        self.updates = 0
+        self.call_log = []
+        self.message_times = {}     # (channel, ts) -> [monotonic time]
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/api/"
+
+    def next_ts(self):
+        with self.lock:
+            self.ts_counter += 1
+            return f"1700000000.{self.ts_counter:06d}"
+
+    def add_thread(self, channel, messages):
+        '''
+        messages: [(user, text)], returns the thread_ts
+        '''
+        thread_ts = None
+        for user, text in messages:
+            ts = self.next_ts()
+            thread_ts = thread_ts or ts
+            self.post(channel, thread_ts, user, text, ts)
+        return thread_ts
+
+    def post(self, channel, thread_ts, user, text, ts=None):
+        ts = ts or self.next_ts()
+        message = {"type": "message", "user": user, "text": text, "ts": ts, "thread_ts": thread_ts}
+        with self.lock:
+            self.threads.setdefault((channel, thread_ts), []).append(message)
+            self.messages[(channel, ts)] = message
+        return message
+
+    def thread_of(self, method, params):
+        if method == "chat.update":
+            message = self.messages.get((params.get("channel"), params.get("ts"))) or {}
+            return message.get("thread_ts")
+        if method == "conversations.replies":
+            return params.get("ts")
+        return params.get("thread_ts")
+
+    def calls_by_thread(self, thread_ts):
+        with self.lock:
+            return [(at, method) for at, method, ts in self.call_log if ts == thread_ts]
+
+    def dispatch(self, handler):
+        method = urlsplit(handler.path).path.rsplit("/", 1)[-1]
+        params = self.read_params(handler)
+        self.count(method)
+        with self.lock:
+            self.call_log.append((time.monotonic(), method, self.thread_of(method, params)))
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == "users.info":
+            user = params.get("user")
+            self.send_json(handler, {"ok": True, "user": {
+                "id": user, "name": f"user-{user}",
+                "profile": {"first_name": "Test", "email": f"{user}@example.com"}}})
+        elif method == "chat.postMessage":
+            message = self.post(params["channel"], params.get("thread_ts"), self.bot_user_id, params.get("text", ""))
+            with self.lock:
+                self.message_times[(params["channel"], message["ts"])] = [time.monotonic()]
+            self.send_json(handler, {"ok": True, "channel": params["channel"], "ts": message["ts"], "message": message})
+        elif method == "chat.update":
+            with self.lock:
+                self.updates += 1
+                limited = self.rate_limit_every and self.updates % self.rate_limit_every == 0
+            if limited:
+                self.count("rate_limited")
+                self.send_json(handler, {"ok": False, "error": "ratelimited"}, status=429,
+                               headers={"Retry-After": str(self.retry_after)})
+                return
+            with self.lock:
+                message = self.messages.get((params["channel"], params["ts"]))
+                if message is not None:
+                    message["text"] = params.get("text", "")
+                    self.message_times.setdefault((params["channel"], params["ts"]), []).append(time.monotonic())
+            self.send_json(handler, {"ok": True, "channel": params["channel"], "ts": params["ts"]})
+        elif method == "conversations.replies":
+            with self.lock:
+                replies = list(self.threads.get((params["channel"], params["ts"]), []))
+            oldest = params.get("oldest")
+            if oldest:
+                replies = [m for m in replies if float(m["ts"]) > float(oldest)]
+            limit = int(params.get("limit") or 1000)
+            start = int(params.get("cursor") or 0)
+            next_cursor = str(start + limit) if start + limit < len(replies) else ""
+            self.send_json(handler, {"ok": True, "messages": replies[start:start + limit],
+                                     "has_more": bool(next_cursor),
+                                     "response_metadata": {"next_cursor": next_cursor}})
+        else:
+            self.send_json(handler, {"ok": False, "error": "unknown_method"}, status=404)
+
+
+class FakeOpenAI(FakeServer):
+    '''
+    POST /v1/chat/completions streaming `chunks` content chunks, the first
+    after first_token_delay seconds and the rest chunk_delay apart.
+
+    script holds one dict per request, overriding those settings for it, or
+    with {"status": 429, "headers": {"Retry-After": "1"}} answering with an
+    error, or {"stall_after": 3, "stall": 5} pausing mid-stream; requests
+    past the end of the script stream normally.
+    '''
+    protocol_version = "HTTP/1.0"
+
+    def __init__(self, chunks=50, chunk_delay=0.01, first_token_delay=0.1, chunk_text="token ", script=None):
+        super().__init__()
+        self.script = list(script or [])
+        self.chunks = chunks
+        self.chunk_delay = chunk_delay
+        self.first_token_delay = first_token_delay
+        self.chunk_text = chunk_text
+        self.requests = []
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    @staticmethod
+    def chunk(content=None, finish_reason=None):
+        delta = {} if content is None else {"content": content}
+        return {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": 0, "model": "gpt-4o",
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+    def dispatch(self, handler):
+        params = self.read_params(handler)
+        self.count("chat.completions")
+        with self.lock:
+            self.requests.append(params)
+            step = self.script.pop(0) if self.script else {}
+        if step.get("status"):
+            self.send_json(handler, {"error": {"message": step.get("message", "scripted failure"),
+                                               "type": "fake", "code": step.get("code")}},
+                           status=step["status"], headers=step.get("headers"))
+            return
+        chunks = step.get("chunks", self.chunks)
+        chunk_delay = step.get("chunk_delay", self.chunk_delay)
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+
+        def send(payload):
+            handler.wfile.write(b"data: " + payload + b"\n\n")
+            handler.wfile.flush()
+
+        time.sleep(step.get("first_token_delay", self.first_token_delay))
+        try:
+            send(json.dumps(self.chunk("")).encode())
+            for i in range(chunks):
+                if i == step.get("stall_after"):
+                    time.sleep(step["stall"])
+                elif i:
+                    time.sleep(chunk_delay)
+                send(json.dumps(self.chunk(self.chunk_text)).encode())
+            send(json.dumps(self.chunk(finish_reason="stop")).encode())
+            send(b"[DONE]")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class FakeContent(FakeServer):
+    '''
+    Static article pages for URL fetching: GET /<any path> returns an HTML
+    article of `paragraphs` paragraphs (the path is in its title, so every
+    URL is a different document) after latency seconds, with an ETag that
+    conditional requests revalidate against (304).
+    '''
+    def __init__(self, paragraphs=20, latency=0.0):
+        super().__init__()
+        self.paragraphs = paragraphs
+        self.latency = latency
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/"
+
+    def url(self, path):
+        return self.base_url + path.lstrip("/")
+
+    def page(self, path):
+        sentence = ("The quick brown fox reads the onboarding guide about {topic} and takes notes on every "
+                    "section before asking the bot a question. ")
+        paragraphs = "".join(f"<p>{sentence.format(topic=path) * 4}</p>\n" for _ in range(self.paragraphs))
+        return (f"<html><head><title>Document {path}</title></head><body><nav>Home | Docs</nav>"
+                f"<article><h1>Document {path}</h1>\n{paragraphs}</article>"
+                f"<footer>Copyright</footer></body></html>").encode("utf-8")
+
+    def dispatch(self, handler):
+        path = urlsplit(handler.path).path
+        self.count("GET")
+        if self.latency:
+            time.sleep(self.latency)
+        etag = f'"{len(path)}-{self.paragraphs}"'
+        if handler.headers.get("If-None-Match") == etag:
+            self.count("not_modified")
+            handler.send_response(304)
+            handler.send_header("ETag", etag)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+        body = self.page(path)
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/html; charset=utf-8")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.send_header("ETag", etag)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+class WhitespaceEncoding:
+    '''
+    Tokenizer stand-in (one token per whitespace separated word) for runs
+    where tiktoken cannot download its encoding.
+    '''
+    name = "whitespace"
+
+    def encode(self, text):
+        return text.split(" ")
+
+    def encode_batch(self, texts, num_threads=8):
+        return [self.encode(text) for text in texts]
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+def use_offline_tokenizer_if_needed(model="gpt-4o"):
+    '''
+    Returns True when tiktoken's encoding could not be loaded and the
+    whitespace stand-in was installed instead.
+    '''
+    import utils
+    try:
+        utils.get_encoding(model)
+        return False
+    except Exception:
+        utils.get_encoding = lambda model: WhitespaceEncoding()
+        utils.get_encoding.cache_clear = lambda: None
+        utils.message_token_parameters.cache_clear()
+        return True
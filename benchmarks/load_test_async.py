@@ -0,0 +1,100 @@
+'''
+Load test: concurrent mentions through the synchronous and the asyncio bot.
+
+Both bots talk to local stand-ins for Slack and OpenAI (fake_services.py).
+The synchronous bot gets a fixed thread pool, like gunicorn's
+`--workers 1 --threads 2`; the async bot runs every mention on one event
+loop.  Each completion streams for roughly chunks * chunk_delay seconds, so
+the wall time shows how many completions each bot can stream at once.
+
+Usage (from the repository root):
+
+    python benchmarks/load_test_async.py [--mentions 20] [--threads 2] [--chunks 50] [--chunk-delay 0.02]
+'''
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from json_logger_stdout import json_std_logger
+from openai import AsyncOpenAI, OpenAI
+from slack_sdk import WebClient
+from slack_sdk.web.async_client import AsyncWebClient
+
+from async_slack_gpt_bot import AsyncSlackGPTBot
+from fake_services import FakeOpenAI, FakeSlack, use_offline_tokenizer_if_needed
+from slack_gpt_bot import SlackGPTBot
+
+CHANNEL = "CLOAD"
+
+
+def mention_events(slack, count):
+    events = []
+    for i in range(count):
+        thread_ts = slack.add_thread(CHANNEL, [(f"U{i}", f"<@{slack.bot_user_id}> question number {i}")])
+        body = {"event": {"channel": CHANNEL, "ts": thread_ts, "thread_ts": thread_ts}}
+        context = {"bot_user_id": slack.bot_user_id, "user_id": f"U{i}"}
+        events.append((body, context))
+    return events
+
+
+def run_sync(slack, openai, mentions, threads):
+    app = SimpleNamespace(client=WebClient(token="xoxb-test", base_url=slack.base_url))
+    bot = SlackGPTBot(app, openai_client=OpenAI(api_key="test", base_url=openai.base_url))
+    events = mention_events(slack, mentions)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda event: bot.handle_app_mentions(*event), events))
+    return time.perf_counter() - started
+
+
+def run_async(slack, openai, mentions):
+    async def main():
+        app = SimpleNamespace(client=AsyncWebClient(token="xoxb-test", base_url=slack.base_url))
+        bot = AsyncSlackGPTBot(app, openai_client=AsyncOpenAI(api_key="test", base_url=openai.base_url))
+        events = mention_events(slack, mentions)
+        started = time.perf_counter()
+        await asyncio.gather(*(bot.handle_app_mentions(*event) for event in events))
+        return time.perf_counter() - started
+    return asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mentions", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=2)
+    parser.add_argument("--chunks", type=int, default=50)
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    parser.add_argument("--slack-latency", type=float, default=0.02)
+    args = parser.parse_args()
+    json_std_logger.setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    if use_offline_tokenizer_if_needed():
+        print("tiktoken encoding unavailable, counting tokens with a whitespace tokenizer")
+
+    slack = FakeSlack(latency=args.slack_latency).start()
+    openai = FakeOpenAI(chunks=args.chunks, chunk_delay=args.chunk_delay).start()
+    try:
+        sync_time = run_sync(slack, openai, args.mentions, args.threads)
+        async_time = run_async(slack, openai, args.mentions)
+    finally:
+        slack.stop()
+        openai.stop()
+
+    single = args.chunks * args.chunk_delay
+    print(f"{args.mentions} mentions, ~{single:.2f}s of streaming each")
+    print(f"sync  ({args.threads} threads): {sync_time:7.2f}s  {args.mentions / sync_time:6.2f} mentions/s")
+    print(f"async (1 event loop): {async_time:7.2f}s  {args.mentions / async_time:6.2f} mentions/s")
+    print(f"speedup: {sync_time / async_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+'''
+Bounded key/value cache backends shared by the bot's caches.
+
+The backends expose the same small interface (get/set/add/delete/clear/len,
+plus extend/discard to compare and update one key atomically) so a
+cache can be moved from process memory to disk or to a shared store without
+touching the code that uses it.  Values stored outside the process must be
+JSON serializable.
+
+SHARED_CACHE_BACKEND is the default url of every store that bot instances
+should share when they run side by side (see mention_worker.py): thread
+state, user profiles, URL extractions, event deduplication and thread
+leases.  Each of them can still be pointed elsewhere with its own setting.
+'''
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+SHARED_CACHE_BACKEND = os.getenv("SHARED_CACHE_BACKEND", "")     #sqlite:///path or redis://host:port/db
+
+
+def _json_size(value):
+    return len(json.dumps(value, default=str))
+
+
+class MemoryCacheBackend:
+    '''
+    In-process LRU cache bounded by entry count and (optionally) total size,
+    with an optional default TTL in seconds.
+    '''
+    def __init__(self, max_entries=1024, max_bytes=None, ttl=None, size_func=_json_size, time_func=time.time):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_func = size_func
+        self.time_func = time_func
+        self.evictions = 0
+        self.current_bytes = 0
+        self._entries = OrderedDict()   # key -> (value, expires_at, size)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at, size = entry
+            if expires_at is not None and expires_at <= self.time_func():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        '''
+        Stores value only when key is absent (or expired); returns whether it
+        was stored.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > self.time_func()):
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def extend(self, key, value, ttl=None):
+        '''
+        Restarts the TTL of key only while it holds value; returns whether it
+        did.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != value or (entry[1] is not None and entry[1] <= self.time_func()):
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def discard(self, key, value):
+        '''
+        Deletes key only while it holds value.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == value:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _set(self, key, value, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = self.time_func() + ttl if ttl else None
+        size = self.size_func(value) if self.max_bytes else 0
+        if key in self._entries:
+            self._remove(key)
+        if self.max_bytes and size > self.max_bytes:
+            #-never cache something that would flush the whole cache
+            return
+        self._entries[key] = (value, expires_at, size)
+        self.current_bytes += size
+        self._evict()
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or
+                                 (self.max_bytes and self.current_bytes > self.max_bytes)):
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+
+class SQLiteCacheBackend:
+    '''
+    On-disk LRU cache backed by SQLite, so cached values survive restarts.
+    The database is memory mapped (mmap_size) so warm reads avoid syscalls.
+    '''
+    def __init__(self, path, max_entries=10000, max_bytes=None, ttl=None,
+                 table="cache", mmap_size=64 * 1024 * 1024, time_func=time.time):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.table = table
+        self.time_func = time_func
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "expires_at REAL, accessed_at REAL NOT NULL)")
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table}(accessed_at)")
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_expires ON {table}(expires_at)")
+        #-entry count and byte total, kept by triggers in the writing transaction
+        #-so bounds are checked without scanning the table
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table}_meta ("
+                "id INTEGER PRIMARY KEY CHECK (id = 0), entries INTEGER NOT NULL, bytes INTEGER NOT NULL)")
+            self._conn.execute(
+                f"INSERT OR IGNORE INTO {table}_meta (id, entries, bytes) "
+                f"SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM {table}")
+            self._conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_inserted AFTER INSERT ON {table} BEGIN "
+                f"UPDATE {table}_meta SET entries = entries + 1, bytes = bytes + new.size; END")
+            self._conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_deleted AFTER DELETE ON {table} BEGIN "
+                f"UPDATE {table}_meta SET entries = entries - 1, bytes = bytes - old.size; END")
+            self._conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_resized AFTER UPDATE OF size ON {table} BEGIN "
+                f"UPDATE {table}_meta SET bytes = bytes - old.size + new.size; END")
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def get(self, key):
+        now = self.time_func()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key=?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at is not None and expires_at <= now:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key=?", (key,))
+                return None
+            self._conn.execute(f"UPDATE {self.table} SET accessed_at=? WHERE key=?", (now, key))
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = self.time_func()
+        expires_at = now + ttl if ttl else None
+        payload = json.dumps(value, default=str)
+        if self.max_bytes and len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            #-an upsert rather than INSERT OR REPLACE, whose implicit delete
+            #-does not fire the delete trigger
+            self._conn.execute(
+                f"INSERT INTO {self.table} (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value=excluded.value, size=excluded.size, "
+                "expires_at=excluded.expires_at, accessed_at=excluded.accessed_at",
+                (key, payload, len(payload), expires_at, now))
+            self._evict(now)
+
+    def add(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = self.time_func()
+        expires_at = now + ttl if ttl else None
+        payload = json.dumps(value, default=str)
+        with self._lock:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key=? AND expires_at IS NOT NULL AND expires_at <= ?", (key, now))
+            cur = self._conn.execute(
+                f"INSERT OR IGNORE INTO {self.table} (key, value, size, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)", (key, payload, len(payload), expires_at, now))
+            if cur.rowcount != 1:
+                return False
+            self._evict(now)
+            return True
+
+    def extend(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = self.time_func()
+        with self._lock:
+            cur = self._conn.execute(
+                f"UPDATE {self.table} SET expires_at=?, accessed_at=? "
+                "WHERE key=? AND value=? AND (expires_at IS NULL OR expires_at > ?)",
+                (now + ttl if ttl else None, now, key, json.dumps(value, default=str), now))
+        return cur.rowcount == 1
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key=?", (key,))
+
+    def discard(self, key, value):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key=? AND value=?",
+                               (key, json.dumps(value, default=str)))
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table}")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(f"SELECT entries FROM {self.table}_meta").fetchone()[0]
+
+    def _evict(self, now):
+        cur = self._conn.execute(
+            f"DELETE FROM {self.table} WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        self.evictions += max(cur.rowcount, 0)
+        count, total = self._conn.execute(f"SELECT entries, bytes FROM {self.table}_meta").fetchone()
+        if count <= self.max_entries and not (self.max_bytes and total > self.max_bytes):
+            return
+        #-walk from least recently used until both bounds hold
+        rows = self._conn.execute(f"SELECT key, size FROM {self.table} ORDER BY accessed_at ASC")
+        doomed = []
+        for key, size in rows:
+            if count <= self.max_entries and not (self.max_bytes and total > self.max_bytes):
+                break
+            doomed.append((key,))
+            count -= 1
+            total -= size
+        rows.close()
+        self._conn.executemany(f"DELETE FROM {self.table} WHERE key=?", doomed)
+        self.evictions += len(doomed)
+
+
+#KEYS: key   ARGV: value, ttl in milliseconds (0 for none)
+_REDIS_EXTEND_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+else
+    redis.call('PERSIST', KEYS[1])
+end
+return 1
+"""
+
+#KEYS: key   ARGV: value
+_REDIS_DISCARD_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return redis.call('DEL', KEYS[1])
+"""
+
+
+class RedisCacheBackend:
+    '''
+    Shared cache on a Redis compatible server, for deployments running more
+    than one bot instance.  Redis enforces the TTL; size bounds are left to
+    the server's maxmemory policy (allkeys-lru).
+    '''
+    def __init__(self, client, prefix="slack-gpt-bot:", ttl=None):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self._extend = client.register_script(_REDIS_EXTEND_SCRIPT)
+        self._discard = client.register_script(_REDIS_DISCARD_SCRIPT)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.client.set(self.prefix + key, json.dumps(value, default=str), ex=int(ttl) if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        return bool(self.client.set(self.prefix + key, json.dumps(value, default=str),
+                                    ex=int(ttl) if ttl else None, nx=True))
+
+    def extend(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        return bool(self._extend(keys=[self.prefix + key],
+                                 args=[json.dumps(value, default=str), int(ttl * 1000) if ttl else 0]))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def discard(self, key, value):
+        self._discard(keys=[self.prefix + key], args=[json.dumps(value, default=str)])
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(match=self.prefix + "*"))
+
+
+def build_cache_backend(url, table, max_entries=1024, max_bytes=None, ttl=None):
+    '''
+    url selects the backend: empty or "memory" keeps it in process,
+    "sqlite:///path/to.db" uses a local file and "redis://host:port/db" a
+    shared server (requires the redis package).
+    '''
+    if not url or url == "memory":
+        return MemoryCacheBackend(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+    if url.startswith("sqlite:///"):
+        return SQLiteCacheBackend(url[len("sqlite:///"):], max_entries=max_entries,
+                                  max_bytes=max_bytes, ttl=ttl, table=table)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        import redis
+        return RedisCacheBackend(redis.Redis.from_url(url), prefix=f"slack-gpt-bot:{table}:", ttl=ttl)
+    raise ValueError(f"Unsupported cache backend url: {url}")
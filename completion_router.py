@@ -0,0 +1,479 @@
+'''
+Routing, retries and stall timeouts for streamed chat completions.
+
+A completion used to be a single chat.completions.create call: a 429 or a
+5xx became the "Sorry, I can't provide a response" message, and a stream
+that stopped sending held the mention's thread until the socket gave up.
+CompletionRouter opens the stream instead, and
+
+- picks the model by the token count of the messages: the configured models
+  are tried in order, skipping those whose window cannot hold the prompt
+  plus max_tokens, so a larger (pricier) model is only used when the
+  conversation does not fit the default one,
+- retries 429s, 5xx, connection errors and stalls with jittered exponential
+  backoff, waiting what Retry-After (or the x-ratelimit-reset-* header of
+  the exhausted limit) asks for,
+- falls back to the next model once a model is out of attempts, or at once
+  when it asks to wait longer than OPENAI_MAX_RETRY_AFTER,
+- gives up on a stream whose first token takes longer than
+  OPENAI_FIRST_TOKEN_TIMEOUT, or that sends nothing for
+  OPENAI_STALL_TIMEOUT once it has started.  Only failures before the first
+  token are retried, after that the answer is already in Slack.
+
+Every routed completion is logged as CompletionRouted with the attempts it
+took (model, outcome, latency) and the time to its first token.
+'''
+import asyncio
+import inspect
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import namedtuple
+
+import openai
+
+from metrics import OPENAI_ATTEMPTS, OPENAI_FIRST_TOKEN_SECONDS, observe_stream
+from structured_logging import logging_wrapper
+
+#models tried after the default one, "model:context_tokens" separated by commas
+OPENAI_FALLBACK_MODELS = os.getenv("OPENAI_FALLBACK_MODELS", "gpt-4o-mini:128000")
+OPENAI_MAX_ATTEMPTS = int(os.getenv("OPENAI_MAX_ATTEMPTS", "3"))       #per model
+OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", "0.5"))
+OPENAI_RETRY_MAX_DELAY = float(os.getenv("OPENAI_RETRY_MAX_DELAY", "8"))
+OPENAI_MAX_RETRY_AFTER = float(os.getenv("OPENAI_MAX_RETRY_AFTER", "20"))
+OPENAI_FIRST_TOKEN_TIMEOUT = float(os.getenv("OPENAI_FIRST_TOKEN_TIMEOUT", "60"))
+OPENAI_STALL_TIMEOUT = float(os.getenv("OPENAI_STALL_TIMEOUT", "30"))
+
+#read timeout of the OpenAI clients; a stalled stream is given up on by the
+#router well before, this only bounds how long its reader lingers
+OPENAI_CLIENT_TIMEOUT = OPENAI_FIRST_TOKEN_TIMEOUT + OPENAI_STALL_TIMEOUT
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+ModelRoute = namedtuple("ModelRoute", ("model", "context_tokens"))
+
+
+class StreamStalled(Exception):
+    pass
+
+
+def parse_model_routes(spec):
+    '''
+    "gpt-4o-mini:128000,gpt-4.1:1047576" -> [ModelRoute]
+    '''
+    routes = []
+    for item in spec.split(","):
+        model, _, context_tokens = item.strip().rpartition(":")
+        if model:
+            routes.append(ModelRoute(model, int(context_tokens)))
+    return routes
+
+
+def build_model_routes(model, context_tokens, fallbacks=OPENAI_FALLBACK_MODELS):
+    routes = [ModelRoute(model, context_tokens)]
+    return routes + [route for route in parse_model_routes(fallbacks) if route.model != model]
+
+
+def parse_duration(value):
+    '''
+    Seconds in a Retry-After ("2", "0.5") or x-ratelimit-reset-* ("1s",
+    "6m0s", "20ms") header; None for anything else (HTTP dates).
+    '''
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts or "".join(number + unit for number, unit in parts) != value:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def retry_after(exception):
+    '''
+    Seconds the API asked us to wait before retrying, or None.
+    '''
+    response = getattr(exception, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms") is not None:
+        milliseconds = parse_duration(headers["retry-after-ms"])
+        if milliseconds is not None:
+            return milliseconds / 1000
+    seconds = parse_duration(headers.get("retry-after"))
+    if seconds is not None:
+        return seconds
+    resets = [parse_duration(headers.get(f"x-ratelimit-reset-{limit}"))
+              for limit in ("requests", "tokens") if headers.get(f"x-ratelimit-remaining-{limit}") == "0"]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+def error_code(exception):
+    return getattr(exception, "code", None)
+
+
+def is_retryable(exception):
+    if isinstance(exception, (StreamStalled, openai.APIConnectionError)):
+        return True
+    status = getattr(exception, "status_code", None)
+    if status is None or error_code(exception) == "insufficient_quota":
+        return False
+    return status in RETRYABLE_STATUS or status >= 500
+
+
+def has_started(chunk):
+    '''
+    True for the first chunk carrying text or a finish_reason; the chunks
+    before it (the assistant role) do not count as the first token.
+    '''
+    if not chunk.choices:
+        return False
+    choice = chunk.choices[0]
+    return bool(choice.delta.content) or choice.finish_reason is not None
+
+
+class _RoutingPolicy:
+    '''
+    Model choice and retry decisions shared by the thread and asyncio
+    routers.
+    '''
+    def __init__(self, routes, max_attempts, base_delay, max_delay, max_retry_after, random_func):
+        self.routes = routes
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.random_func = random_func
+
+    @property
+    def context_tokens(self):
+        return max(route.context_tokens for route in self.routes)
+
+    def route(self, prompt_tokens, max_response_tokens):
+        '''
+        [(model, max_tokens)] to try in order: the models whose window holds
+        the prompt plus max_response_tokens, or the largest one with
+        max_tokens cut to what is left.
+        '''
+        candidates = [(route.model, max_response_tokens) for route in self.routes
+                      if prompt_tokens + max_response_tokens <= route.context_tokens]
+        if candidates:
+            return candidates
+        largest = max(self.routes, key=lambda route: route.context_tokens)
+        return [(largest.model, max(largest.context_tokens - prompt_tokens, 1))]
+
+    def next_step(self, exception, attempt):
+        '''
+        After a failed attempt: ("retry", delay), ("fallback", None) for the
+        next model, or ("raise", None).
+        '''
+        if error_code(exception) == "context_length_exceeded":
+            return "fallback", None
+        if not is_retryable(exception):
+            return "raise", None
+        if attempt >= self.max_attempts:
+            return "fallback", None
+        wait = retry_after(exception)
+        if wait is not None:
+            if wait > self.max_retry_after:
+                return "fallback", None
+            return "retry", wait + self.random_func() * self.base_delay
+        #-full jitter, so mentions that failed together do not retry together
+        return "retry", self.random_func() * min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+
+    @staticmethod
+    def attempt_record(model, attempt, started, outcome, exception=None, delay=None):
+        record = {"model": model, "attempt": attempt, "outcome": outcome,
+                  "latency_ms": round((time.perf_counter() - started) * 1000, 1)}
+        if exception is not None:
+            record["status"] = getattr(exception, "status_code", None)
+            record["error"] = f"{type(exception).__name__}: {exception}"
+        if delay is not None:
+            record["delay_s"] = round(delay, 3)
+        OPENAI_ATTEMPTS.labels(model, outcome).inc()
+        return record
+
+    def log_routed(self, candidates, attempts, prompt_tokens, max_tokens, started):
+        first_token = time.perf_counter() - started
+        OPENAI_FIRST_TOKEN_SECONDS.labels(attempts[-1]["model"]).observe(first_token)
+        logging_wrapper("CompletionRouted", logging.INFO,
+                        model=attempts[-1]["model"],
+                        default_model=self.routes[0].model,
+                        fallback=attempts[-1]["model"] != self.routes[0].model,
+                        candidates=[model for model, _ in candidates],
+                        prompt_tokens=prompt_tokens,
+                        max_tokens=max_tokens,
+                        attempts=attempts,
+                        first_token_ms=round(first_token * 1000, 1))
+
+    def log_failed(self, attempts, prompt_tokens, exception):
+        logging_wrapper("CompletionFailed", logging.WARNING,
+                        default_model=self.routes[0].model,
+                        prompt_tokens=prompt_tokens,
+                        attempts=attempts,
+                        exception=exception)
+
+
+class ChunkReader:
+    '''
+    Opens a stream and reads it on a daemon thread, so its consumer can stop
+    waiting for a chunk after a timeout (a blocked socket read cannot be
+    interrupted from another thread).
+    '''
+    _END = object()
+
+    def __init__(self, open_stream):
+        self.open_stream = open_stream
+        self.response = None
+        self.closed = False
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._read, name="openai-stream", daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        try:
+            self.response = self.open_stream()
+            if self.closed:
+                self.close()
+                return
+            for chunk in self.response:
+                if self.closed:
+                    return
+                self.queue.put(chunk)
+            self.queue.put(self._END)
+        except Exception as e:
+            self.queue.put(e)
+
+    def next(self, timeout):
+        '''
+        The next chunk, None at the end of the stream, or StreamStalled when
+        nothing arrived within timeout seconds.
+        '''
+        try:
+            item = self.queue.get(timeout=max(timeout, 0))
+        except queue.Empty:
+            self.close()
+            raise StreamStalled(f"no response from OpenAI for {timeout:g}s") from None
+        if item is self._END:
+            return None
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self.closed = True
+        close = getattr(self.response, "close", None)
+        if close is not None:
+            close()
+
+
+class CompletionStream:
+    '''
+    The chunks of a routed completion; raises StreamStalled when the next
+    one takes longer than stall_timeout.
+    '''
+    def __init__(self, reader, buffered, model, stall_timeout):
+        self.reader = reader
+        self.buffered = buffered
+        self.model = model
+        self.stall_timeout = stall_timeout
+        self.started = time.perf_counter()    # the first token has arrived
+        self.tokens = 0
+        self.finished = False
+
+    def __iter__(self):
+        while self.buffered:
+            yield self.count(self.buffered.pop(0))
+        while True:
+            try:
+                chunk = self.reader.next(self.stall_timeout)
+            except StreamStalled as e:
+                logging_wrapper("CompletionStalled", logging.WARNING, model=self.model, exception=e)
+                raise
+            if chunk is None:
+                self.finish()
+                return
+            yield self.count(chunk)
+
+    def count(self, chunk):
+        if chunk.choices:
+            if chunk.choices[0].delta.content:
+                self.tokens += 1
+            #-callers usually stop reading at the finish reason, before the end of the stream
+            if chunk.choices[0].finish_reason:
+                self.finish()
+        return chunk
+
+    def finish(self):
+        if not self.finished:
+            self.finished = True
+            observe_stream(self.model, self.tokens, time.perf_counter() - self.started)
+
+    def close(self):
+        self.reader.close()
+
+
+class CompletionRouter:
+    def __init__(self, client, routes, max_attempts=OPENAI_MAX_ATTEMPTS,
+                 first_token_timeout=OPENAI_FIRST_TOKEN_TIMEOUT, stall_timeout=OPENAI_STALL_TIMEOUT,
+                 base_delay=OPENAI_RETRY_BASE_DELAY, max_delay=OPENAI_RETRY_MAX_DELAY,
+                 max_retry_after=OPENAI_MAX_RETRY_AFTER, random_func=random.random):
+        self.client = client
+        self.policy = _RoutingPolicy(routes, max_attempts, base_delay, max_delay, max_retry_after, random_func)
+        self.first_token_timeout = first_token_timeout
+        self.stall_timeout = stall_timeout
+
+    @property
+    def context_tokens(self):
+        return self.policy.context_tokens
+
+    def open(self, model, messages, max_tokens):
+        '''
+        Starts a completion and waits for its first token.
+        '''
+        deadline = time.monotonic() + self.first_token_timeout
+        reader = ChunkReader(lambda: self.client.chat.completions.create(
+            model=model, messages=messages, stream=True, max_tokens=max_tokens))
+        buffered = []
+        try:
+            while True:
+                chunk = reader.next(deadline - time.monotonic())
+                if chunk is None:
+                    break
+                buffered.append(chunk)
+                if has_started(chunk):
+                    break
+        except BaseException:
+            reader.close()
+            raise
+        return CompletionStream(reader, buffered, model, self.stall_timeout)
+
+    def create(self, messages, prompt_tokens, max_response_tokens):
+        '''
+        A CompletionStream from the first model and attempt that produced a
+        token; the last error when none did.
+        '''
+        started = time.perf_counter()
+        candidates = self.policy.route(prompt_tokens, max_response_tokens)
+        attempts = []
+        for index, (model, max_tokens) in enumerate(candidates):
+            attempt = 0
+            while True:
+                attempt += 1
+                attempt_started = time.perf_counter()
+                try:
+                    stream = self.open(model, messages, max_tokens)
+                except Exception as e:
+                    step, delay = self.policy.next_step(e, attempt)
+                    attempts.append(self.policy.attempt_record(model, attempt, attempt_started, step, e, delay))
+                    if step == "raise" or (step == "fallback" and index == len(candidates) - 1):
+                        self.policy.log_failed(attempts, prompt_tokens, e)
+                        raise
+                    if step == "fallback":
+                        break
+                    time.sleep(delay)
+                    continue
+                attempts.append(self.policy.attempt_record(model, attempt, attempt_started, "ok"))
+                self.policy.log_routed(candidates, attempts, prompt_tokens, max_tokens, started)
+                return stream
+
+
+class AsyncCompletionStream(CompletionStream):
+    def __init__(self, response, iterator, buffered, model, stall_timeout):
+        super().__init__(None, buffered, model, stall_timeout)
+        self.response = response
+        self.iterator = iterator
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        while self.buffered:
+            yield self.count(self.buffered.pop(0))
+        while True:
+            try:
+                chunk = await asyncio.wait_for(self.iterator.__anext__(), self.stall_timeout)
+            except StopAsyncIteration:
+                self.finish()
+                return
+            except asyncio.TimeoutError:
+                e = StreamStalled(f"no response from OpenAI for {self.stall_timeout:g}s")
+                logging_wrapper("CompletionStalled", logging.WARNING, model=self.model, exception=e)
+                raise e from None
+            yield self.count(chunk)
+
+    async def close(self):
+        await close_response(self.response)
+
+
+async def close_response(response):
+    close = getattr(response, "close", None)
+    if close is not None:
+        result = close()
+        if inspect.isawaitable(result):
+            await result
+
+
+class AsyncCompletionRouter(CompletionRouter):
+    '''
+    CompletionRouter for an AsyncOpenAI client.
+    '''
+    async def open(self, model, messages, max_tokens):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.first_token_timeout
+        response = None
+        buffered = []
+        try:
+            response = await asyncio.wait_for(self.client.chat.completions.create(
+                model=model, messages=messages, stream=True, max_tokens=max_tokens), self.first_token_timeout)
+            iterator = response.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(iterator.__anext__(), max(deadline - loop.time(), 0))
+                except StopAsyncIteration:
+                    break
+                buffered.append(chunk)
+                if has_started(chunk):
+                    break
+        except asyncio.TimeoutError:
+            await close_response(response)
+            raise StreamStalled(f"no response from OpenAI for {self.first_token_timeout:g}s") from None
+        except BaseException:
+            await close_response(response)
+            raise
+        return AsyncCompletionStream(response, iterator, buffered, model, self.stall_timeout)
+
+    async def create(self, messages, prompt_tokens, max_response_tokens):
+        started = time.perf_counter()
+        candidates = self.policy.route(prompt_tokens, max_response_tokens)
+        attempts = []
+        for index, (model, max_tokens) in enumerate(candidates):
+            attempt = 0
+            while True:
+                attempt += 1
+                attempt_started = time.perf_counter()
+                try:
+                    stream = await self.open(model, messages, max_tokens)
+                except Exception as e:
+                    step, delay = self.policy.next_step(e, attempt)
+                    attempts.append(self.policy.attempt_record(model, attempt, attempt_started, step, e, delay))
+                    if step == "raise" or (step == "fallback" and index == len(candidates) - 1):
+                        self.policy.log_failed(attempts, prompt_tokens, e)
+                        raise
+                    if step == "fallback":
+                        break
+                    await asyncio.sleep(delay)
+                    continue
+                attempts.append(self.policy.attempt_record(model, attempt, attempt_started, "ok"))
+                self.policy.log_routed(candidates, attempts, prompt_tokens, max_tokens, started)
+                return stream
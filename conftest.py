@@ -0,0 +1,288 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import cache
+import work_queue
+
+
+class Clock:
+    '''
+    Stand-in for time.time that tests move forward by hand.
+    '''
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis:
+    '''
+    In-memory stand-in for a redis-py client (decode_responses=True) with
+    the commands the cache backends and the work queue use.  Keys set with
+    ex expire on time_func; like Redis, emptied hashes and sorted sets are
+    deleted.
+    '''
+    def __init__(self, time_func=time.time):
+        self.time_func = time_func
+        self.data = {}
+        self.expires = {}
+
+    def _live(self, key):
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= self.time_func():
+            del self.data[key], self.expires[key]
+        return key in self.data
+
+    def get(self, key):
+        return self.data[key] if self._live(key) else None
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and self._live(key):
+            return None
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if ex:
+            self.expires[key] = self.time_func() + ex
+        return True
+
+    def delete(self, *keys):
+        removed = [key for key in keys if self._live(key)]
+        for key in removed:
+            del self.data[key]
+            self.expires.pop(key, None)
+        return len(removed)
+
+    def scan_iter(self, match):
+        return [key for key in list(self.data) if key.startswith(match.rstrip("*")) and self._live(key)]
+
+    def exists(self, *keys):
+        return sum(1 for key in keys if self._live(key))
+
+    def incr(self, key):
+        value = int(self.get(key) or 0) + 1
+        self.data[key] = str(value)
+        return value
+
+    def hset(self, name, key, value):
+        self.data.setdefault(name, {})[str(key)] = str(value)
+
+    def hget(self, name, key):
+        return self.data.get(name, {}).get(str(key))
+
+    def hincrby(self, name, key, amount=1):
+        value = int(self.hget(name, key) or 0) + amount
+        self.hset(name, key, value)
+        return value
+
+    def hdel(self, name, *keys):
+        return self._remove(name, keys)
+
+    def hlen(self, name):
+        return len(self.data.get(name, {}))
+
+    def zadd(self, name, mapping):
+        self.data.setdefault(name, {}).update((str(member), float(score)) for member, score in mapping.items())
+
+    def zrem(self, name, *members):
+        return self._remove(name, members)
+
+    def zscore(self, name, member):
+        return self.data.get(name, {}).get(str(member))
+
+    def zrangebyscore(self, name, min, max, start=None, num=None):
+        members = sorted((score, member) for member, score in self.data.get(name, {}).items()
+                         if float(min) <= score <= float(max))
+        members = [member for _, member in members]
+        return members if start is None else members[start:start + num]
+
+    def _remove(self, name, fields):
+        items = self.data.get(name, {})
+        removed = [field for field in map(str, fields) if items.pop(field, None) is not None]
+        if name in self.data and not items:
+            del self.data[name]
+        return len(removed)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def register_script(self, source):
+        '''
+        Scripts run their Python emulation from SCRIPTS; like Redis, the
+        arguments arrive as strings.
+        '''
+        emulation = SCRIPTS[source]
+        return lambda keys=(), args=(): emulation(self, list(keys), [str(arg) for arg in args])
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+def cache_extend(redis, keys, args):
+    key, (value, ttl_ms) = keys[0], args
+    if redis.get(key) != value:
+        return 0
+    redis.expires.pop(key, None)
+    if int(ttl_ms) > 0:
+        redis.expires[key] = redis.time_func() + int(ttl_ms) / 1000
+    return 1
+
+
+def cache_discard(redis, keys, args):
+    if redis.get(keys[0]) != args[0]:
+        return 0
+    return redis.delete(keys[0])
+
+
+def queue_lease(redis, keys, args):
+    ready, leased, payloads, attempts, workers = keys
+    now, lease, worker = float(args[0]), float(args[1]), args[2]
+    for job_id in redis.zrangebyscore(leased, "-inf", now):
+        redis.zrem(leased, job_id)
+        redis.zadd(ready, {job_id: now})
+    ids = redis.zrangebyscore(ready, "-inf", now, start=0, num=1)
+    if not ids:
+        return None
+    redis.zrem(ready, ids[0])
+    redis.zadd(leased, {ids[0]: now + lease})
+    redis.hset(workers, ids[0], worker)
+    count = redis.hincrby(attempts, ids[0], 1)
+    return [ids[0], redis.hget(payloads, ids[0]), count]
+
+
+def queue_extend(redis, keys, args):
+    leased, workers = keys
+    job_id, worker, score = args
+    if redis.hget(workers, job_id) != worker or redis.zscore(leased, job_id) is None:
+        return 0
+    redis.zadd(leased, {job_id: score})
+    return 1
+
+
+def queue_release(redis, keys, args):
+    ready, leased, attempts, workers = keys
+    job_id, worker, available_at = args
+    if redis.hget(workers, job_id) != worker or redis.zrem(leased, job_id) == 0:
+        return 0
+    redis.hdel(workers, job_id)
+    redis.hincrby(attempts, job_id, -1)
+    redis.zadd(ready, {job_id: available_at})
+    return 1
+
+
+def queue_ack(redis, keys, args):
+    ready, leased, payloads, attempts, workers = keys
+    job_id, worker = args
+    if redis.hget(workers, job_id) != worker:
+        return 0
+    redis.zrem(ready, job_id)
+    redis.zrem(leased, job_id)
+    for name in (payloads, attempts, workers):
+        redis.hdel(name, job_id)
+    return 1
+
+
+#-Lua source of each script the backends register -> its emulation
+SCRIPTS = {
+    cache._REDIS_EXTEND_SCRIPT: cache_extend,
+    cache._REDIS_DISCARD_SCRIPT: cache_discard,
+    work_queue._REDIS_LEASE_SCRIPT: queue_lease,
+    work_queue._REDIS_EXTEND_SCRIPT: queue_extend,
+    work_queue._REDIS_RELEASE_SCRIPT: queue_release,
+    work_queue._REDIS_ACK_SCRIPT: queue_ack,
+}
+
+
+class StubHTTPServer:
+    '''
+    Local HTTP server serving canned documents.  routes maps a path to a dict
+    with body (bytes), and optional etag, last_modified, status and delay.
+    '''
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub.requests.append((self.path, dict(self.headers)))
+                route = stub.routes.get(self.path.split("?")[0])
+                if route is None:
+                    self._send(404, b"not found", {})
+                    return
+                if route.get("delay"):
+                    time.sleep(route["delay"])
+                if route.get("status", 200) != 200:
+                    self._send(route["status"], route["body"], {})
+                    return
+                headers = {}
+                if route.get("etag"):
+                    headers["ETag"] = route["etag"]
+                if route.get("last_modified"):
+                    headers["Last-Modified"] = route["last_modified"]
+                if route.get("etag") and self.headers.get("If-None-Match") == route["etag"]:
+                    self._send(304, b"", headers)
+                    return
+                if route.get("last_modified") and self.headers.get("If-Modified-Since") == route["last_modified"]:
+                    self._send(304, b"", headers)
+                    return
+                self._send(route.get("status", 200), route["body"], headers)
+
+            def _send(self, status, body, headers):
+                self.send_response(status)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    #-the client gave up on purpose (size cap or deadline)
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server.server_port}{path}"
+
+    def hits(self, path):
+        return sum(1 for requested, _ in self.requests if requested.split("?")[0] == path)
+
+
+@pytest.fixture
+def stub_server():
+    server = StubHTTPServer()
+    server.thread.start()
+    yield server
+    server.server.shutdown()
+    server.server.server_close()
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def fake_redis(clock):
+    return FakeRedis(time_func=clock)
@@ -0,0 +1,115 @@
+'''
+Fits a conversation into an input token budget before it is sent to OpenAI.
+
+The system prompt and the latest question are always kept.  When the thread
+is over budget the largest earlier messages are truncated first (scraped URL
+bodies are appended at the end of a user message, so truncating from the tail
+keeps the question itself), then the oldest turns are dropped, and as a last
+resort the latest question is truncated.
+
+Truncation is token accurate without re-encoding in a loop: the text is
+encoded in chunks only until enough tokens are collected, and the token
+prefix is decoded once.
+'''
+from collections import namedtuple
+
+from utils import count_message_tokens, message_token_parameters, num_tokens_from_texts
+
+TRUNCATION_MARKER = "\n[... truncated to fit the context window]"
+#messages are never truncated below this many tokens while older turns can be dropped
+MIN_TRUNCATED_MESSAGE_TOKENS = 256
+TRUNCATION_CHUNK_CHARS = 16 * 1024
+REPLY_PRIMING_TOKENS = 3
+
+PackReport = namedtuple('PackReport', ('budget', 'tokens_before', 'tokens_after',
+                                       'dropped_messages', 'truncated_messages'))
+
+
+def truncate_text_to_tokens(text, max_tokens, encoding, chunk_chars=TRUNCATION_CHUNK_CHARS):
+    if max_tokens <= 0:
+        return ""
+    tokens = []
+    start = 0
+    while start < len(text) and len(tokens) <= max_tokens:
+        end = min(start + chunk_chars, len(text))
+        if end < len(text):
+            #-cut on whitespace so chunk edges do not split a token
+            space = text.rfind(" ", start, end)
+            if space > start:
+                end = space
+        tokens.extend(encoding.encode(text[start:end]))
+        start = end
+    if len(tokens) <= max_tokens and start >= len(text):
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+class ContextPacker:
+    def __init__(self, model, budget, min_truncated_tokens=MIN_TRUNCATED_MESSAGE_TOKENS):
+        self.model = model
+        self.budget = budget
+        self.min_truncated_tokens = min_truncated_tokens
+        self.encoding, self.tokens_per_message, self.tokens_per_name = message_token_parameters(model)
+        self.marker_tokens = len(self.encoding.encode(TRUNCATION_MARKER))
+
+    def count(self, message):
+        return count_message_tokens(message, self.encoding, self.tokens_per_message, self.tokens_per_name)
+
+    def truncate(self, message, tokens, target_tokens):
+        '''
+        Returns the message cut down so it counts at most target_tokens.
+        '''
+        overhead = tokens - num_tokens_from_texts([message["content"]], self.encoding)[0]
+        budget = max(target_tokens - overhead - self.marker_tokens, 0)
+        for _ in range(2):
+            content = truncate_text_to_tokens(message["content"], budget, self.encoding) + TRUNCATION_MARKER
+            truncated = dict(message, content=content)
+            count = self.count(truncated)
+            if count <= target_tokens or budget == 0:
+                break
+            #-decoding a token prefix can re-encode a token or two longer
+            budget = max(budget - (count - target_tokens), 0)
+        return truncated, count
+
+    def pack(self, messages):
+        '''
+        Returns (packed messages, PackReport).  Raises ValueError when even the
+        system prompt alone does not fit.
+        '''
+        messages = list(messages)
+        counts = [self.count(message) for message in messages]
+        total = sum(counts) + REPLY_PRIMING_TOKENS
+        tokens_before = total
+        dropped = 0
+        truncated = 0
+        if total <= self.budget:
+            return messages, PackReport(self.budget, tokens_before, total, dropped, truncated)
+
+        #-1. the largest earlier messages first
+        for index in sorted(range(1, len(messages) - 1), key=lambda i: counts[i], reverse=True):
+            excess = total - self.budget
+            if excess <= 0 or counts[index] <= self.min_truncated_tokens:
+                break
+            target = max(counts[index] - excess, self.min_truncated_tokens)
+            messages[index], new_count = self.truncate(messages[index], counts[index], target)
+            total += new_count - counts[index]
+            counts[index] = new_count
+            truncated += 1
+
+        #-2. the oldest turns, keeping the system prompt and the latest question
+        while total > self.budget and len(messages) > 2:
+            total -= counts.pop(1)
+            messages.pop(1)
+            dropped += 1
+
+        #-3. the latest question itself
+        if total > self.budget and len(messages) > 1:
+            target = counts[-1] - (total - self.budget)
+            messages[-1], new_count = self.truncate(messages[-1], counts[-1], target)
+            total += new_count - counts[-1]
+            counts[-1] = new_count
+            truncated += 1
+
+        if total > self.budget:
+            raise ValueError(f"The conversation needs {total} tokens, which does not fit the {self.budget} token budget")
+        return messages, PackReport(self.budget, tokens_before, total, dropped, truncated)
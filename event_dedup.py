@@ -0,0 +1,103 @@
+'''
+Deduplication of Slack event deliveries.
+
+Slack delivers an event again when it has not seen a 2xx for it within three
+seconds (up to three retries, each with the same event_id and an
+X-Slack-Retry-Num header).  Bolt acknowledges events before running their
+listener, but a cold start or a busy worker can still delay the ack, and
+without deduplication every retry would run the whole mention again: a
+second wait message, the same pages fetched and a second paid completion.
+
+EventDeduplicator remembers the event_id of every event it let through in a
+bounded TTL set (any cache backend; a shared one dedupes across instances)
+and acknowledges repeats without passing them on.
+'''
+import asyncio
+import logging
+import os
+import threading
+
+from slack_bolt import BoltResponse
+
+from cache import SHARED_CACHE_BACKEND, build_cache_backend
+from structured_logging import logging_wrapper
+
+EVENT_DEDUP_BACKEND = os.getenv("EVENT_DEDUP_BACKEND", SHARED_CACHE_BACKEND or "memory")
+EVENT_DEDUP_TTL = int(os.getenv("EVENT_DEDUP_TTL", "3600"))     #Slack retries for up to ~5 minutes
+EVENT_DEDUP_MAX_EVENTS = int(os.getenv("EVENT_DEDUP_MAX_EVENTS", "10000"))
+
+
+def event_key(body):
+    '''
+    event_id, or the channel and ts of the event for payloads without one.
+    '''
+    if body.get("event_id"):
+        return body["event_id"]
+    event = body.get("event") or {}
+    return f"{event.get('channel')}:{event.get('event_ts') or event.get('ts')}"
+
+
+def header(headers, name):
+    '''
+    A header of a BoltRequest (lower cased names, lists of values).
+    '''
+    values = (headers or {}).get(name) or [None]
+    return values[0]
+
+
+class EventDeduplicator:
+    def __init__(self, backend=None, ttl=EVENT_DEDUP_TTL):
+        if backend is None:
+            backend = build_cache_backend(EVENT_DEDUP_BACKEND, "slack_events",
+                                          max_entries=EVENT_DEDUP_MAX_EVENTS, ttl=ttl)
+        self.backend = backend
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {"events": 0, "duplicates": 0, "retries": 0}
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def first_delivery(self, body, retry_num=None, retry_reason=None):
+        '''
+        True the first time an event is seen, False for its redeliveries.
+        '''
+        key = event_key(body)
+        self._count("events")
+        if retry_num is not None:
+            self._count("retries")
+        if self.backend.add(key, retry_num or "0", ttl=self.ttl):
+            return True
+        self._count("duplicates")
+        logging_wrapper("DuplicateEvent", logging.INFO,
+                        event_id=key,
+                        retry_num=retry_num,
+                        retry_reason=retry_reason)
+        return False
+
+    def bolt_middleware(self, body, request, next):
+        '''
+        Global Bolt middleware (app.use): event callbacks seen before are
+        acknowledged with a 200 and go no further.
+        '''
+        if body.get("type") != "event_callback" or self.first_delivery(
+                body, header(request.headers, "x-slack-retry-num"), header(request.headers, "x-slack-retry-reason")):
+            return next()
+        return BoltResponse(status=200, body="")
+
+    async def async_bolt_middleware(self, body, request, next):
+        if body.get("type") != "event_callback":
+            return await next()
+        #-the backend may be a file or a server, keep its round trip off the event loop
+        first = await asyncio.get_running_loop().run_in_executor(
+            None, self.first_delivery,
+            body, header(request.headers, "x-slack-retry-num"), header(request.headers, "x-slack-retry-reason"))
+        if first:
+            return await next()
+        return BoltResponse(status=200, body="")
@@ -0,0 +1,300 @@
+'''
+Process pool for document extraction.
+
+trafilatura is pure CPU work that holds the GIL, so extracting on a thread
+of the bot process starves the other request threads and the socket mode
+receiver, and one pathological page can grow the process by hundreds of
+megabytes.  ExtractionProcessPool runs every job in a worker process
+instead, one dispatcher thread per worker waiting on its pipe:
+
+- a worker is replaced after max_jobs jobs, or after a job that left it
+  more than max_rss bytes larger than when it started,
+- a job that runs for longer than timeout seconds, or whose worker grows
+  past max_rss while it runs, has its worker killed and fails with
+  ExtractionTimeout or ExtractionMemoryError,
+- cancelling the future of a job that is already running kills its worker
+  and the future fails with ExtractionCancelled.
+
+It is a concurrent.futures.Executor, so URLFetcher takes it in place of its
+extraction thread pool; the function and arguments of a job must pickle.
+Memory is read from /proc, so on systems without it only the job count and
+wall-clock limits apply.
+
+Workers are forked by default: they start in milliseconds and, unlike with
+spawn or forkserver, the entry point module is not imported again in them.
+Both of those run the parent's __main__ again as __mp_main__ in every
+worker, and the entry points wire the Slack app at import time (an
+auth.test call, a second bot, its queue and database connections), so
+URL_EXTRACTION_START_METHOD=forkserver or spawn is only for entry points
+that keep that wiring under if __name__ == "__main__".
+'''
+import functools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Executor, Future
+
+URL_EXTRACTION_EXECUTOR = os.getenv("URL_EXTRACTION_EXECUTOR", "process")    #process or thread
+URL_EXTRACTION_MAX_JOBS = int(os.getenv("URL_EXTRACTION_MAX_JOBS", "100"))
+URL_EXTRACTION_MAX_RSS_MB = int(os.getenv("URL_EXTRACTION_MAX_RSS_MB", "512"))
+URL_EXTRACTION_TIMEOUT = float(os.getenv("URL_EXTRACTION_TIMEOUT", "15"))    #per job, seconds
+URL_EXTRACTION_START_METHOD = os.getenv("URL_EXTRACTION_START_METHOD", "fork")    #fork, forkserver or spawn
+FORKSERVER_PRELOAD = ["trafilatura"]
+
+POLL_INTERVAL = 0.05
+WORKER_START_TIMEOUT = 30
+WORKER_STOP_TIMEOUT = 1
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class ExtractionError(Exception):
+    pass
+
+
+class ExtractionTimeout(ExtractionError):
+    pass
+
+
+class ExtractionMemoryError(ExtractionError):
+    pass
+
+
+class ExtractionCancelled(ExtractionError):
+    pass
+
+
+def process_rss(pid):
+    '''
+    Resident set size of a process in bytes, None where /proc is missing.
+    '''
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def worker_main(connection):
+    '''
+    Worker process loop: reports its size once started, then runs the jobs
+    it is sent and answers each with (succeeded, value, size after the job).
+    '''
+    connection.send(process_rss(os.getpid()))
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        try:
+            reply = (True, job())
+        except Exception as e:
+            reply = (False, e)
+        try:
+            connection.send(reply + (process_rss(os.getpid()),))
+        except Exception as e:
+            #-a result or exception that does not pickle
+            connection.send((False, ExtractionError(f"{type(e).__name__}: {e}"), process_rss(os.getpid())))
+
+
+class ExtractionWorker:
+    def __init__(self, context):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_connection,),
+                                       name="url-extract-worker", daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.jobs = 0
+        if not self.connection.poll(WORKER_START_TIMEOUT):
+            self.kill()
+            raise ExtractionError("extraction worker did not start")
+        self.baseline_rss = self.connection.recv()
+
+    def growth(self, rss):
+        if rss is None or self.baseline_rss is None:
+            return 0
+        return rss - self.baseline_rss
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(WORKER_STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self.connection.close()
+
+
+class ExtractionFuture(Future):
+    def __init__(self):
+        super().__init__()
+        self.abandoned = threading.Event()
+
+    def cancel(self):
+        '''
+        A job that is already running cannot be marked cancelled, so its
+        worker is killed and the future fails with ExtractionCancelled.
+        '''
+        if super().cancel():
+            return True
+        if self.running():
+            self.abandoned.set()
+        return False
+
+
+class ExtractionProcessPool(Executor):
+    def __init__(self, max_workers=2, max_jobs=URL_EXTRACTION_MAX_JOBS,
+                 max_rss=URL_EXTRACTION_MAX_RSS_MB * 1024 * 1024,
+                 timeout=URL_EXTRACTION_TIMEOUT,
+                 start_method=URL_EXTRACTION_START_METHOD):
+        self.max_workers = max_workers
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.timeout = timeout
+        self.context = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            self.context.set_forkserver_preload(FORKSERVER_PRELOAD)
+        self.jobs = queue.SimpleQueue()
+        self.dispatchers = []
+        self.shutting_down = False
+        self.lock = threading.Lock()
+        self._stats = {"jobs": 0, "errors": 0, "workers_started": 0, "recycled": 0,
+                       "timeouts": 0, "memory_kills": 0, "cancelled": 0}
+
+    @property
+    def stats(self):
+        with self.lock:
+            return dict(self._stats)
+
+    def _count(self, name):
+        with self.lock:
+            self._stats[name] += 1
+
+    def submit(self, fn, *args, **kwargs):
+        with self.lock:
+            if self.shutting_down:
+                raise RuntimeError("cannot schedule new extractions after shutdown")
+            #-workers start with the first job, so importing this costs nothing
+            while len(self.dispatchers) < self.max_workers:
+                dispatcher = threading.Thread(target=self._dispatch, daemon=True,
+                                              name=f"url-extract-{len(self.dispatchers)}")
+                dispatcher.start()
+                self.dispatchers.append(dispatcher)
+            future = ExtractionFuture()
+            self.jobs.put((future, functools.partial(fn, *args, **kwargs)))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        with self.lock:
+            self.shutting_down = True
+            dispatchers = list(self.dispatchers)
+        if cancel_futures:
+            while True:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is not None:
+                    job[0].cancel()
+        for _ in dispatchers:
+            self.jobs.put(None)
+        if wait:
+            for dispatcher in dispatchers:
+                dispatcher.join()
+
+    def _dispatch(self):
+        worker = None
+        try:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    return
+                future, call = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if worker is None:
+                    try:
+                        worker = ExtractionWorker(self.context)
+                    except Exception as e:
+                        future.set_exception(e)
+                        continue
+                    self._count("workers_started")
+                worker = self._run(worker, future, call)
+        finally:
+            if worker is not None:
+                worker.stop()
+
+    def _run(self, worker, future, call):
+        '''
+        Runs one job on worker and settles its future.  Returns the worker,
+        or None when it was killed or retired and a new one is needed.
+        '''
+        self._count("jobs")
+        try:
+            worker.connection.send(call)
+        except OSError:
+            worker.kill()
+            self._count("errors")
+            future.set_exception(ExtractionError("extraction worker exited"))
+            return None
+        except Exception as e:
+            #-the job did not pickle, nothing reached the worker
+            self._count("errors")
+            future.set_exception(e)
+            return worker
+
+        deadline = time.monotonic() + self.timeout
+        error = None
+        while error is None and not worker.connection.poll(POLL_INTERVAL):
+            if future.abandoned.is_set():
+                self._count("cancelled")
+                error = ExtractionCancelled("extraction cancelled while running")
+            elif time.monotonic() > deadline:
+                self._count("timeouts")
+                error = ExtractionTimeout(f"extraction took longer than {self.timeout}s")
+            elif worker.growth(process_rss(worker.process.pid)) > self.max_rss:
+                self._count("memory_kills")
+                error = ExtractionMemoryError(f"extraction used more than {self.max_rss // (1024 * 1024)}MB")
+        if error is None:
+            try:
+                succeeded, value, rss = worker.connection.recv()
+            except (EOFError, OSError):
+                self._count("errors")
+                error = ExtractionError(f"extraction worker exited with code {worker.process.exitcode}")
+        if error is not None:
+            worker.kill()
+            future.set_exception(error)
+            return None
+
+        worker.jobs += 1
+        if succeeded:
+            future.set_result(value)
+        else:
+            self._count("errors")
+            future.set_exception(value)
+        if worker.jobs >= self.max_jobs or worker.growth(rss) > self.max_rss:
+            self._count("recycled")
+            worker.stop()
+            return None
+        return worker
+
+
+def build_extraction_executor(kind=URL_EXTRACTION_EXECUTOR, max_workers=2):
+    '''
+    The executor URLFetcher extracts on; None keeps its thread pool.
+    '''
+    if kind == "process":
+        return ExtractionProcessPool(max_workers=max_workers)
+    if kind == "thread":
+        return None
+    raise ValueError(f"Unknown URL_EXTRACTION_EXECUTOR {kind!r}")
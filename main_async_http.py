@@ -0,0 +1,53 @@
+'''
+Slack GPT Chat Bot
+Powered by a Slack Request URL, /slack/events, on asyncio (AsyncApp + AsyncOpenAI)
+and AsyncApp's built-in aiohttp server
+'''
+import os
+
+from aiohttp import web
+from slack_bolt.async_app import AsyncApp
+
+from async_slack_gpt_bot import (AsyncSlackGPTBot)
+from event_dedup import EventDeduplicator
+from metrics import metrics_response
+from profiler import install_profiler_signal
+from user_cache import USER_CACHE_WARM
+from work_queue import build_work_queue, enqueue_mention
+
+#-listeners run as tasks after the ack (process_before_response=False)
+app = AsyncApp(process_before_response=False)
+app.use(EventDeduplicator().async_bolt_middleware)
+slack_gpt_bot = AsyncSlackGPTBot(app)
+
+################################################
+
+#-distributed mode (WORK_QUEUE_BACKEND): mentions are only queued here and
+#-answered by the workers, main_worker.py
+work_queue = build_work_queue()
+
+@app.event("app_mention")
+async def handle_app_mentions(body, context):
+    if work_queue is not None:
+        await slack_gpt_bot.run_blocking(enqueue_mention, work_queue, body, context)
+    else:
+        await slack_gpt_bot.handle_app_mentions(body, context)
+
+################################################
+async def warm_user_cache(web_app):
+    slack_gpt_bot.start_user_cache_warm_up()
+
+async def metrics(request):
+    body, content_type = metrics_response()
+    response = web.Response(body=body)
+    #-aiohttp rejects a charset in content_type=
+    response.headers["Content-Type"] = content_type
+    return response
+
+if __name__ == "__main__":
+    server = app.server(port=int(os.getenv("PORT", "3000")), path="/slack/events")
+    if USER_CACHE_WARM:
+        server.web_app.on_startup.append(warm_user_cache)
+    server.web_app.router.add_get("/metrics", metrics)
+    install_profiler_signal()
+    server.start()
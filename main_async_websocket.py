@@ -0,0 +1,45 @@
+'''
+Slack GPT Chat Bot
+Powered by Slack Websockets, on asyncio (AsyncApp + AsyncOpenAI)
+'''
+import asyncio
+
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+
+from async_slack_gpt_bot import (AsyncSlackGPTBot)
+from event_dedup import EventDeduplicator
+from metrics import start_metrics_server
+from profiler import install_profiler_signal
+from user_cache import USER_CACHE_WARM
+from work_queue import build_work_queue, enqueue_mention
+from utils import (SLACK_BOT_TOKEN, SLACK_APP_TOKEN)
+
+app = AsyncApp(token=SLACK_BOT_TOKEN, process_before_response=False)
+app.use(EventDeduplicator().async_bolt_middleware)
+slack_gpt_bot = AsyncSlackGPTBot(app)
+
+################################################
+
+#-distributed mode (WORK_QUEUE_BACKEND): mentions are only queued here and
+#-answered by the workers, main_worker.py
+work_queue = build_work_queue()
+
+@app.event("app_mention")
+async def handle_app_mentions(body, context):
+    if work_queue is not None:
+        await slack_gpt_bot.run_blocking(enqueue_mention, work_queue, body, context)
+    else:
+        await slack_gpt_bot.handle_app_mentions(body, context)
+
+################################################
+async def main():
+    if USER_CACHE_WARM:
+        slack_gpt_bot.start_user_cache_warm_up()
+    handler = AsyncSocketModeHandler(app, SLACK_APP_TOKEN)
+    await handler.start_async()
+
+if __name__ == "__main__":
+    start_metrics_server()
+    install_profiler_signal()
+    asyncio.run(main())
@@ -2,20 +2,43 @@
 Slack GPT Chat Bot
 Powered by a Slack Request URL, /slack/events, and the Python Flask framework
 '''
+from concurrent.futures import ThreadPoolExecutor
 
-from slack_gpt_bot import (SlackGPTBot)
+from event_dedup import EventDeduplicator
+from metrics import metrics_response
+from profiler import install_profiler_signal
+from slack_gpt_bot import (MENTION_WORKERS, SlackGPTBot)
 from slack_bolt import App
+from user_cache import USER_CACHE_WARM
+from work_queue import build_work_queue, enqueue_mention
 
-app = App()
+#-ack first: Bolt answers Slack as soon as the event is dispatched and runs
+#-the listener afterwards on listener_executor (process_before_response=False),
+#-so a slow mention never makes Slack retry it
+app = App(process_before_response=False,
+          listener_executor=ThreadPoolExecutor(max_workers=MENTION_WORKERS, thread_name_prefix="mention"))
+#-retries of an event that was already dispatched are acked and dropped
+app.use(EventDeduplicator().bolt_middleware)
 slack_gpt_bot = SlackGPTBot(app)
+if USER_CACHE_WARM:
+    slack_gpt_bot.start_user_cache_warm_up()
+#-kill -USR2 <worker pid> writes a sampling profile (profiler.py)
+install_profiler_signal()
 
 ################################################
 
+#-distributed mode (WORK_QUEUE_BACKEND): mentions are only queued here and
+#-answered by the workers, main_worker.py
+work_queue = build_work_queue()
+
 @app.event("app_mention")
 def handle_app_mentions(body, context):
-    slack_gpt_bot.handle_app_mentions(body, context)
+    if work_queue is not None:
+        enqueue_mention(work_queue, body, context)
+    else:
+        slack_gpt_bot.handle_app_mentions(body, context)
 
-from flask import Flask, request
+from flask import Flask, Response, request
 from slack_bolt.adapter.flask import SlackRequestHandler
 
 flask_app = Flask(__name__)
@@ -24,3 +47,8 @@ handler = SlackRequestHandler(app)
 @flask_app.route("/slack/events", methods=["POST"])
 def slack_events():
     return handler.handle(request)
+
+@flask_app.route("/metrics", methods=["GET"])
+def metrics():
+    body, content_type = metrics_response()
+    return Response(body, content_type=content_type)
@@ -2,22 +2,43 @@
 Slack GPT Chat Bot
 Powered by a Slack Websockets
 '''
+from concurrent.futures import ThreadPoolExecutor
+
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 
-from slack_gpt_bot import (SlackGPTBot)
+from event_dedup import EventDeduplicator
+from metrics import start_metrics_server
+from profiler import install_profiler_signal
+from slack_gpt_bot import (MENTION_WORKERS, SlackGPTBot)
+from user_cache import USER_CACHE_WARM
+from work_queue import build_work_queue, enqueue_mention
 from utils import (SLACK_BOT_TOKEN, SLACK_APP_TOKEN)
 
-app = App(token=SLACK_BOT_TOKEN)
+app = App(token=SLACK_BOT_TOKEN, process_before_response=False,
+          listener_executor=ThreadPoolExecutor(max_workers=MENTION_WORKERS, thread_name_prefix="mention"))
+app.use(EventDeduplicator().bolt_middleware)
 slack_gpt_bot = SlackGPTBot(app)
 
 ################################################
 
+#-distributed mode (WORK_QUEUE_BACKEND): mentions are only queued here and
+#-answered by the workers, main_worker.py
+work_queue = build_work_queue()
+
 @app.event("app_mention")
 def handle_app_mentions(body, context):
-    slack_gpt_bot.handle_app_mentions(body, context)
+    if work_queue is not None:
+        enqueue_mention(work_queue, body, context)
+    else:
+        slack_gpt_bot.handle_app_mentions(body, context)
 
 ################################################
 if __name__ == "__main__":
+    if USER_CACHE_WARM:
+        slack_gpt_bot.start_user_cache_warm_up()
+    #-socket mode has no HTTP server, /metrics is served on METRICS_PORT
+    start_metrics_server()
+    install_profiler_signal()
     handler = SocketModeHandler(app, SLACK_APP_TOKEN)
     handler.start()
@@ -0,0 +1,37 @@
+'''
+Slack GPT Chat Bot
+Completion worker of the distributed mode: answers the mentions an intake
+(any of the other entry points, with WORK_QUEUE_BACKEND set) puts on the
+work queue.  Run as many as needed, with the same WORK_QUEUE_BACKEND and
+SHARED_CACHE_BACKEND.
+'''
+from slack_bolt import App
+
+from mention_worker import MentionWorker
+from metrics import start_metrics_server
+from profiler import install_profiler_signal
+from slack_gpt_bot import SlackGPTBot
+from thread_state import THREAD_LEASE_BACKEND, build_thread_leases
+from user_cache import USER_CACHE_WARM
+from utils import SLACK_BOT_TOKEN
+from work_queue import WORK_QUEUE_BACKEND, build_work_queue
+
+#-no listeners: the app only provides the Web API client
+app = App(token=SLACK_BOT_TOKEN)
+slack_gpt_bot = SlackGPTBot(app)
+
+################################################
+if __name__ == "__main__":
+    if not WORK_QUEUE_BACKEND:
+        raise SystemExit("WORK_QUEUE_BACKEND is not set, there is no queue to work on")
+    if USER_CACHE_WARM:
+        slack_gpt_bot.start_user_cache_warm_up()
+    start_metrics_server()
+    install_profiler_signal()
+    #-leases live next to the queue unless they have a store of their own
+    worker = MentionWorker(slack_gpt_bot, build_work_queue(),
+                           build_thread_leases(THREAD_LEASE_BACKEND or WORK_QUEUE_BACKEND)).start()
+    try:
+        worker.wait()
+    except KeyboardInterrupt:
+        worker.stop()
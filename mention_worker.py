@@ -0,0 +1,164 @@
+'''
+Completion worker of the distributed mode.
+
+MentionWorker takes the mentions the intake queued (work_queue.py) and
+answers them with a SlackGPTBot, `concurrency` at a time.  Before answering
+it leases the mention's thread (thread_state.ThreadLeases): a mention of a
+thread another worker is still answering goes back on the queue for
+THREAD_BUSY_DELAY seconds, so replies in a thread are written one after the
+other and its shared state is never updated by two workers at once.
+
+While a mention is answered a heartbeat keeps extending the job and thread
+leases; when the worker dies both run out and another worker picks the
+mention up again (it may then be answered twice).  A mention that failed
+inside the bot has already been answered with the error and is not retried.
+
+Workers share everything else through SHARED_CACHE_BACKEND (cache.py):
+thread state, user profiles and URL extractions.  Admission limits
+(admission.py) and the response cache's similarity index stay per worker.
+'''
+import logging
+import os
+import socket
+import threading
+
+from structured_logging import logging_wrapper
+from work_queue import JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS
+
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "8"))
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "0.2"))    #seconds between polls of an empty queue
+THREAD_BUSY_DELAY = float(os.getenv("THREAD_BUSY_DELAY", "1"))
+
+
+def mention_thread(body):
+    event = body["event"]
+    return event["channel"], event.get("thread_ts", event["ts"])
+
+
+class MentionWorker:
+    def __init__(self, bot, queue, leases, worker_id=None, concurrency=WORKER_CONCURRENCY,
+                 job_lease=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS, busy_delay=THREAD_BUSY_DELAY,
+                 poll_interval=WORKER_POLL_INTERVAL):
+        self.bot = bot
+        self.queue = queue
+        self.leases = leases
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.concurrency = concurrency
+        self.job_lease = job_lease
+        self.max_attempts = max_attempts
+        self.busy_delay = busy_delay
+        self.poll_interval = poll_interval
+        #-renewed three times per lease, so one slow heartbeat does not lose it
+        self.heartbeat_interval = min(job_lease, leases.ttl) / 3
+        self._lock = threading.Lock()
+        self._active = {}   # job id -> (job, channel_id, thread_ts)
+        self._stop = threading.Event()
+        self._threads = []
+        self.counters = {"answered": 0, "deferred": 0, "dropped": 0, "lost_leases": 0}
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    @property
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["active"] = len(self._active)
+        return stats
+
+    def process(self, job):
+        '''
+        Answers one leased job; returns "answered", "deferred" or "dropped".
+        '''
+        if job.attempts > self.max_attempts:
+            #-its workers died answering it every time
+            self.queue.ack(job, self.worker_id)
+            logging_wrapper("MentionDropped", logging.ERROR,
+                            job_id=job.id,
+                            attempts=job.attempts,
+                            event_id=job.payload["body"].get("event_id"))
+            return "dropped"
+        channel_id, thread_ts = mention_thread(job.payload["body"])
+        if not self.leases.acquire(channel_id, thread_ts, self.worker_id):
+            self.queue.release(job, self.worker_id, self.busy_delay)
+            return "deferred"
+        with self._lock:
+            self._active[job.id] = (job, channel_id, thread_ts)
+        try:
+            self.bot.handle_app_mentions(job.payload["body"], job.payload["context"])
+        finally:
+            with self._lock:
+                del self._active[job.id]
+            self.leases.release(channel_id, thread_ts, self.worker_id)
+            self.queue.ack(job, self.worker_id)
+        return "answered"
+
+    def run_once(self):
+        '''
+        Processes the next job; returns its outcome, None when the queue was empty.
+        '''
+        job = self.queue.get(self.worker_id, self.job_lease)
+        if job is None:
+            return None
+        outcome = self.process(job)
+        self.count(outcome)
+        return outcome
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                if self.run_once() is None:
+                    self._stop.wait(self.poll_interval)
+            except Exception as e:
+                #-the queue or the lease store is unreachable, try again later
+                logging_wrapper("WorkerError", logging.ERROR, worker=self.worker_id, exception=e)
+                self._stop.wait(self.poll_interval)
+
+    def heartbeat(self):
+        '''
+        Extends the leases of the jobs being answered.
+        '''
+        with self._lock:
+            active = list(self._active.values())
+        for job, channel_id, thread_ts in active:
+            if not (self.queue.extend(job, self.worker_id, self.job_lease) and
+                    self.leases.renew(channel_id, thread_ts, self.worker_id)):
+                self.count("lost_leases")
+                logging_wrapper("LeaseLost", logging.WARNING,
+                                worker=self.worker_id,
+                                job_id=job.id,
+                                channel_id=channel_id,
+                                thread_ts=thread_ts)
+
+    def run_heartbeat(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logging_wrapper("WorkerError", logging.ERROR, worker=self.worker_id, exception=e)
+
+    def start(self):
+        self._threads = [threading.Thread(target=self.run, name=f"mention-worker-{i}", daemon=True)
+                         for i in range(self.concurrency)]
+        self._threads.append(threading.Thread(target=self.run_heartbeat, name="lease-heartbeat", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        logging_wrapper("WorkerStarted", logging.INFO,
+                        worker=self.worker_id,
+                        concurrency=self.concurrency)
+        return self
+
+    def stop(self, timeout=None):
+        '''
+        Stops taking jobs and waits for the mentions being answered.
+        '''
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        logging_wrapper("WorkerStopped", logging.INFO, worker=self.worker_id, stats=self.stats)
+
+    def wait(self):
+        #-wakes up regularly so KeyboardInterrupt gets through
+        while not self._stop.wait(1):
+            pass
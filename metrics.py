@@ -0,0 +1,174 @@
+'''
+Prometheus metrics for the hot path of a mention.
+
+The RequestResponse log line has the stage timings of one mention; these
+histograms aggregate them across mentions so latency percentiles and
+throughput can be graphed and alerted on:
+
+- slack_gpt_bot_stage_seconds{stage}: every StageTimer stage (users_info,
+  conversation_history, thread_processing, context_packing, admission_wait,
+  openai_request, first_token, total, ...)
+- slack_gpt_bot_slack_api_seconds{method,outcome}: each Slack Web API call,
+  chat.update included (its count is the number of updates sent)
+- slack_gpt_bot_url_fetch_seconds{outcome}, slack_gpt_bot_url_extract_seconds
+- slack_gpt_bot_token_count_seconds: counting the tokens of new messages
+- slack_gpt_bot_openai_first_token_seconds{model} and
+  slack_gpt_bot_openai_tokens_per_second{model} (content chunks, about one
+  token each, after the first)
+- counters for mentions, OpenAI attempts and the chat.update coalescer
+- gauges of admission control (admission.py), summed over the process's
+  bots: slack_gpt_bot_admission_queue_depth, slack_gpt_bot_admission_in_flight,
+  slack_gpt_bot_tokens_last_minute and slack_gpt_bot_tokens_per_minute_budget
+  (OPENAI_TOKENS_PER_MINUTE, 0 is no budget)
+
+main_flask.py serves them on /metrics.  The socket mode entry points have
+no HTTP server of their own and start a sidecar on METRICS_PORT instead.
+Each process exports its own metrics.
+'''
+import inspect
+import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from admission import admission_controllers
+from slack_updater import chat_update_metrics
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))      #sidecar /metrics port in socket mode, 0 disables it
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (5, 10, 20, 30, 40, 60, 80, 100, 150, 200, 300)
+
+STAGE_SECONDS = Histogram("slack_gpt_bot_stage_seconds", "Time spent in each stage of handling a mention",
+                          ["stage"], buckets=LATENCY_BUCKETS)
+SLACK_API_SECONDS = Histogram("slack_gpt_bot_slack_api_seconds", "Slack Web API call latency",
+                              ["method", "outcome"], buckets=LATENCY_BUCKETS)
+URL_FETCH_SECONDS = Histogram("slack_gpt_bot_url_fetch_seconds", "Time to download a linked document",
+                              ["outcome"], buckets=LATENCY_BUCKETS)
+URL_EXTRACT_SECONDS = Histogram("slack_gpt_bot_url_extract_seconds",
+                                "Time from handing a document to the extraction pool to its text",
+                                buckets=LATENCY_BUCKETS)
+TOKEN_COUNT_SECONDS = Histogram("slack_gpt_bot_token_count_seconds",
+                                "Time counting the tokens of the new messages of a thread", buckets=LATENCY_BUCKETS)
+OPENAI_FIRST_TOKEN_SECONDS = Histogram("slack_gpt_bot_openai_first_token_seconds",
+                                       "Time from the first request of a completion to its first token, retries included",
+                                       ["model"], buckets=LATENCY_BUCKETS)
+OPENAI_TOKENS_PER_SECOND = Histogram("slack_gpt_bot_openai_tokens_per_second",
+                                     "Streaming rate of a completion after its first token", ["model"],
+                                     buckets=RATE_BUCKETS)
+OPENAI_ATTEMPTS = Counter("slack_gpt_bot_openai_attempts", "Completion attempts by model and outcome",
+                          ["model", "outcome"])
+MENTIONS = Counter("slack_gpt_bot_mentions", "Mentions handled by outcome", ["outcome"])
+
+
+def observe_timings(timings_ms):
+    '''
+    Records the stages of a StageTimer (milliseconds).
+    '''
+    for stage, milliseconds in timings_ms.items():
+        STAGE_SECONDS.labels(stage).observe(milliseconds / 1000)
+
+
+def observe_stream(model, tokens, seconds):
+    if tokens > 1 and seconds > 0:
+        OPENAI_TOKENS_PER_SECOND.labels(model).observe((tokens - 1) / seconds)
+
+
+def slack_call_outcome(exception):
+    response = getattr(exception, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return "ratelimited"
+    return "error"
+
+
+def instrument_slack_client(client):
+    '''
+    Times every Web API call of a slack_sdk WebClient or AsyncWebClient
+    (they all go through api_call).  Other clients are left alone.
+    '''
+    api_call = getattr(client, "api_call", None)
+    if api_call is None or getattr(api_call, "instrumented", False):
+        return client
+
+    if inspect.iscoroutinefunction(api_call):
+        async def timed_api_call(api_method, *args, **kwargs):
+            started = time.perf_counter()
+            outcome = "ok"
+            try:
+                return await api_call(api_method, *args, **kwargs)
+            except Exception as e:
+                outcome = slack_call_outcome(e)
+                raise
+            finally:
+                SLACK_API_SECONDS.labels(api_method, outcome).observe(time.perf_counter() - started)
+    else:
+        def timed_api_call(api_method, *args, **kwargs):
+            started = time.perf_counter()
+            outcome = "ok"
+            try:
+                return api_call(api_method, *args, **kwargs)
+            except Exception as e:
+                outcome = slack_call_outcome(e)
+                raise
+            finally:
+                SLACK_API_SECONDS.labels(api_method, outcome).observe(time.perf_counter() - started)
+
+    timed_api_call.instrumented = True
+    client.api_call = timed_api_call
+    return client
+
+
+class ChatUpdateCollector:
+    '''
+    Exports the process wide chat.update coalescer counters.
+    '''
+    def collect(self):
+        family = CounterMetricFamily("slack_gpt_bot_chat_updates", "chat.update coalescer events", labels=["event"])
+        for event, value in chat_update_metrics.snapshot().items():
+            family.add_metric([event], value)
+        yield family
+
+
+class AdmissionCollector:
+    '''
+    Exports the admission queues of the process's bots, read at scrape time.
+    '''
+    def collect(self):
+        queue_depth = in_flight = window_tokens = budget = 0
+        for controller in admission_controllers():
+            depth, running, tokens = controller.state.gauges()
+            queue_depth += depth
+            in_flight += running
+            window_tokens += tokens
+            budget += controller.state.tokens_per_minute
+        yield GaugeMetricFamily("slack_gpt_bot_admission_queue_depth", "Mentions waiting for admission",
+                                value=queue_depth)
+        yield GaugeMetricFamily("slack_gpt_bot_admission_in_flight", "Completions admitted and still running",
+                                value=in_flight)
+        yield GaugeMetricFamily("slack_gpt_bot_tokens_last_minute",
+                                "Tokens admitted over the last 60 seconds, counted against the budget",
+                                value=window_tokens)
+        yield GaugeMetricFamily("slack_gpt_bot_tokens_per_minute_budget", "Tokens per minute budget, 0 is none",
+                                value=budget)
+
+
+REGISTRY.register(ChatUpdateCollector())
+REGISTRY.register(AdmissionCollector())
+
+
+def metrics_response():
+    '''
+    (body, content type) of the metrics in the Prometheus text format.
+    '''
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def start_metrics_server(port=METRICS_PORT):
+    '''
+    Serves /metrics on port from a daemon thread; returns whether it started.
+    '''
+    if not port:
+        return False
+    start_http_server(port)
+    return True
@@ -0,0 +1,141 @@
+'''
+Sampling profiler for production hot spots.
+
+Sending PROFILE_SIGNAL (SIGUSR2 by default) to a bot process samples the
+stacks of all its threads every PROFILE_INTERVAL seconds for
+PROFILE_SECONDS, from a background thread, and writes them in the folded
+format flame graph tools read (flamegraph.pl, speedscope, inferno):
+
+    kill -USR2 <pid>
+    # PROFILE_DIR/profile-<pid>-<time>.folded, and a ProfileWritten log line
+    # with the functions most often on top of the stack
+
+Nothing runs until the signal arrives, and sampling only reads the
+interpreter's frames (sys._current_frames), so it is safe to leave
+installed.  Stacks are rooted at the thread's name with its number dropped
+("mention", "url-fetch", ...).
+'''
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+from structured_logging import logging_wrapper
+
+PROFILE_SIGNAL = os.getenv("PROFILE_SIGNAL", "SIGUSR2")     #empty disables the signal handler
+PROFILE_SECONDS = float(os.getenv("PROFILE_SECONDS", "30"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp")
+
+#functions listed in the ProfileWritten log line
+TOP_FUNCTIONS = 15
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def thread_group(name):
+    return re.sub(r"[-_ ]?\d+(?: \(.*\))?$", "", name) or name
+
+
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_INTERVAL, duration=PROFILE_SECONDS, directory=PROFILE_DIR):
+        self.interval = interval
+        self.duration = duration
+        self.directory = directory
+        self.stacks = Counter()
+        self.samples = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def sample(self):
+        '''
+        Adds one sample of every other thread's stack.
+        '''
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.append(thread_group(names.get(ident, "thread")))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self):
+        '''
+        Samples for duration seconds, then writes the profile; returns its path.
+        '''
+        deadline = time.monotonic() + self.duration
+        while time.monotonic() < deadline:
+            self.sample()
+            time.sleep(self.interval)
+        return self.write()
+
+    def top_functions(self, count=TOP_FUNCTIONS):
+        leaves = Counter()
+        for stack, samples in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += samples
+        return leaves.most_common(count)
+
+    def write(self):
+        path = os.path.join(self.directory, f"profile-{os.getpid()}-{int(time.time())}.folded")
+        with open(path, "w") as f:
+            for stack, samples in self.stacks.most_common():
+                f.write(f"{stack} {samples}\n")
+        logging_wrapper("ProfileWritten", logging.INFO,
+                        path=path,
+                        samples=self.samples,
+                        interval_s=self.interval,
+                        top_functions=self.top_functions())
+        return path
+
+    def start(self):
+        '''
+        Starts a profiling run on a daemon thread, unless one is running.
+        '''
+        with self._lock:
+            if self.running:
+                return False
+            self.stacks.clear()
+            self.samples = 0
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def _run(self):
+        try:
+            self.run()
+        except Exception as e:
+            logging_wrapper("ProfileFailed", logging.WARNING, exception=e)
+
+
+def install_profiler_signal(signal_name=PROFILE_SIGNAL, profiler=None):
+    '''
+    Starts a profiling run whenever the process receives signal_name.  Must
+    be called from the main thread; returns the profiler, or None when
+    disabled or unavailable (no such signal on this platform).
+    '''
+    signum = getattr(signal, signal_name, None) if signal_name else None
+    if signum is None:
+        return None
+    profiler = profiler or SamplingProfiler()
+    try:
+        signal.signal(signum, lambda received, frame: profiler.start())
+    except ValueError:
+        #-not the main thread
+        return None
+    return profiler
@@ -0,0 +1,285 @@
+'''
+Cache of answers to repeated questions.
+
+The same questions ("summarize <this popular doc>", onboarding questions) are
+asked over and over in different threads, and each one used to be a full
+completion.  ResponseCache keys the answer by a hash of the model and the
+packed messages (system prompt, context and question), with whitespace and
+case normalized, and a later mention with the same messages gets the stored
+answer replayed through the usual streaming path instead.
+
+It is opt-in (RESPONSE_CACHE_BACKEND, any cache backend: a sqlite:// file
+keeps answers across restarts, redis:// shares them between instances),
+bounded by RESPONSE_CACHE_MAX_ENTRIES (LRU) and RESPONSE_CACHE_TTL, and
+channels listed in RESPONSE_CACHE_EXCLUDED_CHANNELS neither read nor
+populate it.
+
+With RESPONSE_CACHE_SIMILARITY set (e.g. 0.95), questions that are worded
+differently can hit too: the last question is embedded and compared with
+the questions answered before that had exactly the same earlier messages,
+in an in-process index of unit vectors.  The index is not persisted; it
+refills as questions are answered.
+'''
+import asyncio
+import hashlib
+import json
+import logging
+import operator
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+
+from cache import build_cache_backend
+from structured_logging import logging_wrapper
+
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "")      #empty disables the cache
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_EXCLUDED_CHANNELS = os.getenv("RESPONSE_CACHE_EXCLUDED_CHANNELS", "")
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0"))    #0 disables the embedding tier
+RESPONSE_CACHE_EMBEDDING_MODEL = os.getenv("RESPONSE_CACHE_EMBEDDING_MODEL", "text-embedding-3-small")
+#shortened embeddings keep the exhaustive search in the index cheap
+RESPONSE_CACHE_EMBEDDING_DIMENSIONS = int(os.getenv("RESPONSE_CACHE_EMBEDDING_DIMENSIONS", "256"))
+RESPONSE_CACHE_MAX_VECTORS = int(os.getenv("RESPONSE_CACHE_MAX_VECTORS", "1000"))
+
+#characters per chunk when a cached answer is replayed
+REPLAY_CHUNK_CHARS = 400
+#characters of the question that are embedded
+EMBEDDING_MAX_CHARS = 8000
+
+_Delta = namedtuple("_Delta", ("content",))
+_Choice = namedtuple("_Choice", ("delta", "finish_reason"))
+_Chunk = namedtuple("_Chunk", ("choices",))
+
+
+def normalize_text(text):
+    return " ".join((text or "").split()).casefold()
+
+
+def digest(*parts):
+    payload = json.dumps(parts, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def messages_key(model, messages):
+    return digest(model, [[message["role"], normalize_text(message["content"])] for message in messages])
+
+
+def unit_vector(vector):
+    norm = sum(x * x for x in vector) ** 0.5
+    return array("d", (x / norm for x in vector)) if norm else array("d", vector)
+
+
+class CachedResponse:
+    '''
+    A stored answer replayed as completion chunks, iterable like the
+    synchronous and the asyncio OpenAI streams.
+    '''
+    def __init__(self, text, model, chunk_chars=REPLAY_CHUNK_CHARS):
+        self.text = text
+        self.model = model
+        self.chunk_chars = chunk_chars
+
+    def chunks(self):
+        for start in range(0, len(self.text), self.chunk_chars):
+            yield _Chunk([_Choice(_Delta(self.text[start:start + self.chunk_chars]), None)])
+        yield _Chunk([_Choice(_Delta(None), "stop")])
+
+    def __iter__(self):
+        return self.chunks()
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self.chunks():
+            yield chunk
+
+
+class VectorIndex:
+    '''
+    Nearest neighbour search over unit vectors by exhaustive dot products,
+    grouped so only questions asked after the same messages are compared.
+    Keeps the max_vectors most recently added.
+    '''
+    def __init__(self, max_vectors=RESPONSE_CACHE_MAX_VECTORS):
+        self.max_vectors = max_vectors
+        self._entries = OrderedDict()   # key -> (group, unit vector)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, group, vector):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (group, unit_vector(vector))
+            while len(self._entries) > self.max_vectors:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def search(self, group, vector):
+        '''
+        (key, cosine similarity) of the closest vector in group, or (None, 0.0).
+        '''
+        query = unit_vector(vector)
+        with self._lock:
+            candidates = [(key, entry[1]) for key, entry in self._entries.items() if entry[0] == group]
+        best_key, best_similarity = None, 0.0
+        for key, candidate in candidates:
+            similarity = sum(map(operator.mul, query, candidate))
+            if similarity > best_similarity:
+                best_key, best_similarity = key, similarity
+        return best_key, best_similarity
+
+
+class CacheLookup:
+    '''
+    What a lookup found: hit is "exact", "similar" or None, and response the
+    stored {"text", "model", "created_at"}.  A miss keeps the key, group and
+    embedding so store() does not compute them again.
+    '''
+    def __init__(self, key, group=None, embedding=None):
+        self.key = key
+        self.group = group
+        self.embedding = embedding
+        self.hit = None
+        self.response = None
+        self.similarity = None
+
+    def replay(self):
+        return CachedResponse(self.response["text"], self.response["model"])
+
+
+class ResponseCache:
+    def __init__(self, backend, ttl=RESPONSE_CACHE_TTL, excluded_channels=RESPONSE_CACHE_EXCLUDED_CHANNELS,
+                 similarity=RESPONSE_CACHE_SIMILARITY, embed_func=None, index=None, time_func=time.time):
+        self.backend = backend
+        self.ttl = ttl
+        if isinstance(excluded_channels, str):
+            excluded_channels = [channel.strip() for channel in excluded_channels.split(",") if channel.strip()]
+        self.excluded_channels = set(excluded_channels)
+        self.similarity = similarity
+        #-the embedding tier needs a function to embed with and a threshold
+        self.embed_func = embed_func if similarity else None
+        self.index = (index if index is not None else VectorIndex()) if self.embed_func else None
+        self.time_func = time_func
+        self._lock = threading.Lock()
+        self.counters = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "stored": 0, "excluded": 0,
+                         "embedding_errors": 0}
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    @property
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats["entries"] = len(self.backend)
+        stats["vectors"] = len(self.index) if self.index is not None else None
+        return stats
+
+    def enabled_for(self, channel_id):
+        return channel_id not in self.excluded_channels
+
+    @staticmethod
+    def question(messages):
+        '''
+        The text the embedding tier compares, None when the conversation does
+        not end with a question.
+        '''
+        if not messages or messages[-1]["role"] != "user":
+            return None
+        return normalize_text(messages[-1]["content"])[:EMBEDDING_MAX_CHARS] or None
+
+    def _exact(self, channel_id, model, messages):
+        if not self.enabled_for(channel_id):
+            self.count("excluded")
+            return None
+        lookup = CacheLookup(messages_key(model, messages), messages_key(model, messages[:-1]))
+        lookup.response = self.backend.get(lookup.key)
+        if lookup.response is not None:
+            lookup.hit = "exact"
+            self.count("exact_hits")
+        return lookup
+
+    def _similar(self, lookup, embedding):
+        lookup.embedding = embedding
+        key, similarity = self.index.search(lookup.group, embedding)
+        if key is None or similarity < self.similarity:
+            return
+        response = self.backend.get(key)
+        if response is None:
+            #-the answer expired or was evicted, its vector goes too
+            self.index.discard(key)
+            return
+        lookup.hit, lookup.response, lookup.similarity = "similar", response, round(similarity, 4)
+        self.count("similar_hits")
+
+    def _embedding_failed(self, e):
+        self.count("embedding_errors")
+        logging_wrapper("ResponseCacheEmbeddingFailed", logging.WARNING, exception=e)
+
+    def lookup(self, channel_id, model, messages):
+        '''
+        A CacheLookup for the packed messages, None when the channel opted
+        out.  On a miss the result is passed to store() with the answer.
+        '''
+        lookup = self._exact(channel_id, model, messages)
+        if lookup is None or lookup.hit:
+            return lookup
+        question = self.question(messages)
+        if self.index is not None and question is not None:
+            try:
+                self._similar(lookup, self.embed_func(question))
+            except Exception as e:
+                self._embedding_failed(e)
+        if not lookup.hit:
+            self.count("misses")
+        return lookup
+
+    async def lookup_async(self, channel_id, model, messages):
+        '''
+        lookup() with a coroutine embed_func.  The backend may be a file or a
+        server, so its reads run on the default executor; only the embedding
+        is awaited on the event loop.
+        '''
+        loop = asyncio.get_running_loop()
+        lookup = await loop.run_in_executor(None, self._exact, channel_id, model, messages)
+        if lookup is None or lookup.hit:
+            return lookup
+        question = self.question(messages)
+        if self.index is not None and question is not None:
+            try:
+                embedding = await self.embed_func(question)
+                await loop.run_in_executor(None, self._similar, lookup, embedding)
+            except Exception as e:
+                self._embedding_failed(e)
+        if not lookup.hit:
+            self.count("misses")
+        return lookup
+
+    def store(self, lookup, text, model):
+        if lookup is None or lookup.hit or not text:
+            return
+        self.backend.set(lookup.key, {"text": text, "model": model, "created_at": self.time_func()}, ttl=self.ttl)
+        if self.index is not None and lookup.embedding is not None:
+            self.index.add(lookup.key, lookup.group, lookup.embedding)
+        self.count("stored")
+
+
+def build_response_cache(embed_func=None, url=RESPONSE_CACHE_BACKEND):
+    '''
+    The configured ResponseCache, or None when RESPONSE_CACHE_BACKEND is unset.
+    '''
+    if not url:
+        return None
+    return ResponseCache(build_cache_backend(url, "responses", max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                                             ttl=RESPONSE_CACHE_TTL),
+                         embed_func=embed_func)
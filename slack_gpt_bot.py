@@ -1,11 +1,26 @@
 import logging
+import os
+import threading
+import time
 from json_logger_stdout import json_std_logger
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
-from utils import (N_CHUNKS_TO_CONCAT_BEFORE_UPDATING, OPENAI_API_KEY,
-                   num_tokens_from_messages, process_conversation_history,
-                   update_chat)
+from admission import AdmissionController, AdmissionRejected
+from completion_router import OPENAI_CLIENT_TIMEOUT, CompletionRouter, build_model_routes
+from context_packer import ContextPacker
+from metrics import MENTIONS, instrument_slack_client, observe_timings
+from response_cache import (RESPONSE_CACHE_EMBEDDING_DIMENSIONS, RESPONSE_CACHE_EMBEDDING_MODEL,
+                            build_response_cache)
+from slack_updater import ChatUpdateCoalescer, SplitMessageWriter
+from structured_logging import (LOG_QUEUE, enable_queue_logging, logging_wrapper,
+                                reset_log_context, run_in_log_context, set_log_context)
+from thread_state import OpenTurns, ThreadLocks, build_thread_state_store
+from user_cache import UserProfileCache
+from utils import (OPENAI_API_KEY,
+                   StageTimer, num_tokens_from_thread_state, num_tokens_per_message, post_chat,
+                   thread_state_messages, update_chat, update_thread_state)
 
 from openai import OpenAI
 
@@ -17,6 +32,8 @@ if DEBUG:
 else:
     logging.basicConfig(level=logging.INFO)
     json_std_logger.setLevel (logging.INFO)
+if LOG_QUEUE:
+    enable_queue_logging()
 
 ################################################
 #-----------------------------------------------
@@ -24,41 +41,151 @@ else:
 OPENAI_MODEL_4_OHHHH = "gpt-4o"
 OPENAI_MODEL_4_OHHHH_TOKENS = 128000
 
-#based on the way tokens are counted for other models, this 
-#is roughly the max length of a single Slack message in tokens
-#(4000) characters
-OPENAI_MODEL_4_OHHHH_MAX_TOKENS = 730
+#default max_tokens of an answer; long answers are split across
+#several Slack messages, so this is no longer tied to the
+#~4000 characters one message holds
+OPENAI_MODEL_4_OHHHH_MAX_TOKENS = 4096
 
 #-----------------------------------------------
 # Model to use
 OPENAI_MODEL_IN_USE = OPENAI_MODEL_4_OHHHH
 ################################################
 
+#max_tokens sent with each completion request
+OPENAI_MAX_RESPONSE_TOKENS = int(os.getenv("OPENAI_MAX_RESPONSE_TOKENS", str(OPENAI_MODEL_4_OHHHH_MAX_TOKENS)))
+#input tokens the conversation is packed into, defaults to the model window minus the response
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "0")) or None
+
+#conversations.replies page size when reading a thread
+CONVERSATION_PAGE_SIZE = 200
+#threads posting wait messages while the thread history is processed
+PREPARATION_WORKERS = int(os.getenv("PREPARATION_WORKERS", "16"))
+#mentions handled at once; Bolt acks each event first and then runs the
+#listener on a pool of this many threads.  Mentions waiting for admission
+#hold a thread, so this covers the in-flight completions and the queue
+MENTION_WORKERS = int(os.getenv("MENTION_WORKERS", "20"))
+
+BUSY_MESSAGE = "Sorry, I'm answering too many questions right now. Please ask again in a few minutes."
+
 User = namedtuple('User', ('user_id','username','real_name','email'))
 class SlackGPTBot:
-    def __init__(self, app, model_to_use=OPENAI_MODEL_4_OHHHH, model_tokens=OPENAI_MODEL_4_OHHHH_TOKENS):
+    def __init__(self, app, model_to_use=OPENAI_MODEL_4_OHHHH, model_tokens=OPENAI_MODEL_4_OHHHH_TOKENS,
+                 thread_state_store=None, max_response_tokens=OPENAI_MAX_RESPONSE_TOKENS,
+                 context_token_budget=CONTEXT_TOKEN_BUDGET, openai_client=None, user_cache=None,
+                 admission=None, completion_router=None, response_cache=None):
         self.app = app
+        #-Slack API latency per method, for the /metrics histograms
+        instrument_slack_client(app.client)
         self.model_to_use = model_to_use
-        self.model_tokens = model_tokens
-        self.openai_client = OpenAI(
-            api_key=OPENAI_API_KEY
+        self.max_response_tokens = max_response_tokens
+        #-retries are the completion router's, the client makes one attempt per call
+        self.openai_client = openai_client or OpenAI(
+            api_key=OPENAI_API_KEY,
+            max_retries=0,
+            timeout=OPENAI_CLIENT_TIMEOUT
         )
+        self.completion_router = completion_router or self.build_completion_router(
+            build_model_routes(model_to_use, model_tokens))
+        #-the conversation is packed for the largest window; the router only
+        #-picks a larger model than model_to_use when it does not fit
+        self.model_tokens = max(model_tokens, self.completion_router.context_tokens)
+        self.context_token_budget = min(context_token_budget or self.model_tokens,
+                                        self.model_tokens - max_response_tokens)
+        self.response_cache = response_cache if response_cache is not None else build_response_cache(self.embed)
+        self.thread_state_store = thread_state_store or build_thread_state_store()
+        self.user_cache = user_cache or UserProfileCache()
+        self.thread_locks = ThreadLocks()
+        self.open_turns = OpenTurns()
+        self.admission = admission if admission is not None else AdmissionController()
+        self.preparation_pool = self.build_preparation_pool()
 
-    def get_conversation_history(self, channel_id, thread_ts):
-        return self.app.client.conversations_replies(
-            channel=channel_id,
-            ts=thread_ts,
-            inclusive=True
-        )
+    '''
+    Returns the replies of a thread (only those after oldest, when given),
+    following the pagination cursor.
+    '''
+    def get_conversation_history(self, channel_id, thread_ts, oldest=None):
+        messages = []
+        seen_ts = set()
+        cursor = None
+        while True:
+            kwargs = {"channel": channel_id, "ts": thread_ts, "limit": CONVERSATION_PAGE_SIZE}
+            if oldest is None:
+                kwargs["inclusive"] = True
+            else:
+                kwargs["oldest"] = oldest
+                kwargs["inclusive"] = False
+            if cursor:
+                kwargs["cursor"] = cursor
+            response = self.app.client.conversations_replies(**kwargs)
+            #-every page can start with the thread's parent message again
+            for message in response['messages']:
+                if message['ts'] not in seen_ts:
+                    seen_ts.add(message['ts'])
+                    messages.append(message)
+            cursor = (response.get('response_metadata') or {}).get('next_cursor')
+            if not cursor:
+                return {"messages": messages}
+
+    '''
+    Brings the stored state of the thread up to date, fetching and processing
+    only the replies posted since the last mention.  Mentions of one thread
+    take turns, so a second one only reads what the first did not.
+    '''
+    def get_thread_state(self, channel_id, thread_ts, bot_user_id, reply_message_ts=None, until_ts=None, timer=None):
+        timer = timer or StageTimer()
+        with self.thread_locks.hold(channel_id, thread_ts):
+            with timer.stage("thread_state_load"):
+                state = self.thread_state_store.load(channel_id, thread_ts)
+            with timer.stage("conversation_history"):
+                conversation_history = self.get_conversation_history(channel_id, thread_ts, state["last_ts"])
+            with timer.stage("thread_processing"):
+                return self.process_thread_history(state, conversation_history, channel_id, thread_ts,
+                                                   bot_user_id, reply_message_ts, until_ts)
+
+    def process_thread_history(self, state, conversation_history, channel_id, thread_ts, bot_user_id,
+                               reply_message_ts=None, until_ts=None):
+        count_tokens = partial(num_tokens_per_message, model=self.model_to_use)
+        state = update_thread_state(state, conversation_history, bot_user_id, count_tokens,
+                                    reply_message_ts, until_ts, self.open_turns.oldest(channel_id, thread_ts))
+        self.thread_state_store.save(channel_id, thread_ts, state)
+        return state
 
     '''
-    This uses https://api.slack.com/methods/users.profile.get
+    This uses https://api.slack.com/methods/users.info, through the user
+    profile cache
     '''
     def get_user_information(self, user_id):
-            user_info = self.app.client.users_info(
+            user_info = self.user_cache.lookup(user_id, self.fetch_user_information)
+            return self.parse_user_information(user_id, user_info)
+
+    def fetch_user_information(self, user_id):
+            return self.app.client.users_info(
                 user=user_id
             )
 
+    '''
+    Fills the user profile cache from users.list, for large workspaces
+    where the first mention of every user would otherwise miss.
+    '''
+    def warm_user_cache(self):
+        started = time.perf_counter()
+        try:
+            pages = self.user_cache.warm(self.app.client.users_list)
+            self.logging_wrapper("UserCacheWarmed", logging.INFO,
+                                 pages=pages,
+                                 duration_ms=round((time.perf_counter() - started) * 1000, 1),
+                                 user_cache=self.user_cache.stats)
+        except Exception as e:
+            self.logging_wrapper("UserCacheWarmFailed", logging.WARNING,
+                                 exception=e,
+                                 user_cache=self.user_cache.stats)
+
+    def start_user_cache_warm_up(self):
+        thread = threading.Thread(target=self.warm_user_cache, name="user-cache-warm", daemon=True)
+        thread.start()
+        return thread
+
+    def parse_user_information(self, user_id, user_info):
             user = None
             try:
                 # user_info['user]['profile']['first_name'] - not guaranteed
@@ -77,8 +204,11 @@ class SlackGPTBot:
             finally:
                 return user
 
-    def build_personalized_wait_message(self, real_name):
+    def build_personalized_wait_message(self, real_name, position=0):
         first_name = self.extract_first_name(real_name)
+        if position:
+            return ("Hi " + first_name +"! " + f"I got your request, you are number {position} in the queue, "
+                    "please wait while I ask the wizard...")
         return "Hi " + first_name +"! " + "I got your request, please wait while I ask the wizard..."
 
     # Write a method that takes a user's real name, a string in the format of "first last", and extract the first part 
@@ -93,31 +223,155 @@ class SlackGPTBot:
     This method is used to log messages to the console and to the json_logger_stdout
     '''
     def logging_wrapper(self, message, severity=logging.INFO, **kwargs):
-        json_std_logger._setParams(**kwargs)
-
-        log = {
-            logging.DEBUG: json_std_logger.debug,
-            logging.ERROR: json_std_logger.error,
-            logging.CRITICAL: json_std_logger.critical,
-            logging.WARNING: json_std_logger.warning
-        }
-        func = log.get(severity, json_std_logger.info)
-        func(message)
-
-    def stream_openai_response_to_slack(self, openai_response, slack_update_func):
+        logging_wrapper(message, severity, **kwargs)
+
+    '''
+    After a failure, waits for the wait message (so the error is posted
+    after it) and closes an OpenAI stream nobody will read.  Returns the
+    user when the lookup succeeded.
+    '''
+    def abandon_preparation(self, wait_message, openai_response, user):
+        self.close_openai_response(openai_response)
+        if wait_message is not None:
+            try:
+                user, _ = wait_message.result()
+            except Exception:
+                pass
+        return user
+
+    def build_message_writer(self, channel_id, thread_ts, reply_message_ts):
+        return SplitMessageWriter(partial(update_chat, self.app, channel_id),
+                                  partial(post_chat, self.app, channel_id, thread_ts),
+                                  reply_message_ts)
+
+    '''
+    Threads posting wait messages while thread history is processed.
+    '''
+    def build_preparation_pool(self):
+        return ThreadPoolExecutor(max_workers=PREPARATION_WORKERS, thread_name_prefix="mention-prep")
+
+    def build_chat_updater(self, message_writer):
+        return ChatUpdateCoalescer(message_writer)
+
+    def build_completion_router(self, routes):
+        return CompletionRouter(self.openai_client, routes)
+
+    '''
+    Embeds a question for the similarity tier of the response cache.
+    '''
+    def embed(self, text):
+        response = self.openai_client.embeddings.create(model=RESPONSE_CACHE_EMBEDDING_MODEL, input=text,
+                                                        dimensions=RESPONSE_CACHE_EMBEDDING_DIMENSIONS)
+        return response.data[0].embedding
+
+    '''
+    Releases the connection of a streamed response; replayed answers have none.
+    '''
+    @staticmethod
+    def close_openai_response(openai_response):
+        close = getattr(openai_response, "close", None)
+        if close is not None:
+            close()
+
+    '''
+    Only complete answers of the model the question was asked to are
+    reused: not a fallback model's, nor one cut off at the token limit.
+    '''
+    def is_cacheable(self, openai_response, finish_reason):
+        return openai_response.model == self.model_to_use and finish_reason == 'stop'
+
+    '''
+    Hands every version of the text to the updater, which decides when
+    chat.update is actually called; the final text is always delivered.
+    Returns the text and the stream's finish reason (None when it ended
+    without one).
+    '''
+    def stream_openai_response_to_slack(self, openai_response, updater, timer=None):
         response_text = ""
-        ii = 0
-        for chunk in openai_response:
-            if chunk.choices[0].delta.content is not None:
-                ii = ii + 1
-                response_text += chunk.choices[0].delta.content
-                if ii > N_CHUNKS_TO_CONCAT_BEFORE_UPDATING:
-                    slack_update_func(response_text)
-                    ii = 0
-            elif chunk.choices[0].finish_reason == 'stop':
-                slack_update_func(response_text)
-        
-        return response_text
+        finish_reason = None
+        try:
+            for chunk in openai_response:
+                if chunk.choices[0].delta.content is not None:
+                    if timer is not None and not response_text:
+                        timer.mark("first_token")
+                    response_text += chunk.choices[0].delta.content
+                    updater.submit(response_text)
+                elif chunk.choices[0].finish_reason is not None:
+                    finish_reason = chunk.choices[0].finish_reason
+                    if finish_reason == 'stop':
+                        break
+        except Exception:
+            updater.close()
+            raise
+        finally:
+            #-the stream is left at the finish reason, release its connection
+            self.close_openai_response(openai_response)
+        updater.finish(response_text)
+
+        return response_text, finish_reason
+
+    '''
+    Packs the conversation into the input budget when it does not fit and
+    returns (messages, num_conversation_tokens, max_response_tokens).
+    '''
+    def fit_to_context(self, messages, num_conversation_tokens, channel_id, thread_ts, user_id):
+        if num_conversation_tokens > self.context_token_budget:
+            packer = ContextPacker(self.model_to_use, self.context_token_budget)
+            messages, pack_report = packer.pack(messages)
+            num_conversation_tokens = pack_report.tokens_after
+            self.logging_wrapper("ContextPacked", logging.INFO,
+                    channel_id=channel_id,
+                    thread_ts=thread_ts,
+                    user_id=user_id,
+                    **pack_report._asdict())
+
+        max_response_tokens = min(self.max_response_tokens, self.model_tokens-num_conversation_tokens)
+        return messages, num_conversation_tokens, max_response_tokens
+
+    '''
+    Looks up the user and posts the personalized wait message (with the
+    queue position when the mention has to wait), returns (user, ts of the
+    wait message).
+    '''
+    def post_wait_message(self, channel_id, thread_ts, user_id, timer, position=0):
+        self.logging_wrapper("Milestone", logging.DEBUG, 
+                milestone="Fetching user information from slack",
+                user_id=user_id)
+        with timer.stage("users_info"):
+            user = self.get_user_information(user_id)
+
+        '''
+        How to lock the bot to a particular channel
+        -------------------------------------------
+        In this case, for the beta testing we created the channel,
+        beta-slack-chatgpt-bot (channel_id: C057NBLL2G4). If the message
+        didn't originate from this channel, you got a polite message and 
+        were denied access.
+            
+        if channel_id != 'C057NBLL2G4': #lock to test channel for beta
+            slack_resp = app.client.chat_postMessage( 
+                channel=channel_id,
+                thread_ts=thread_ts,
+                text="Our apologies, however the Beta ChatGPT bot is not allowed outside of the beta-slack-chatgpt-bot channel"
+            )
+            return
+        '''
+        with timer.stage("wait_message"):
+            slack_resp = self.app.client.chat_postMessage(
+                channel=channel_id,
+                thread_ts=thread_ts,
+                text=self.build_personalized_wait_message(user.real_name, position)
+            )
+        return user, slack_resp['message']['ts']
+
+    def reject_mention(self, channel_id, thread_ts, exception):
+        self.logging_wrapper("AdmissionRejected", logging.WARNING,
+                             exception=exception,
+                             admission=self.admission.stats)
+        self.app.client.chat_postMessage(
+            channel=channel_id,
+            thread_ts=thread_ts,
+            text=BUSY_MESSAGE)
 
     ################################################
     # @app.event("app_mention")
@@ -127,6 +381,18 @@ class SlackGPTBot:
         channel_id = None
         thread_ts = None
         token_count = None
+        user_id = None
+        #-so the exception log below works whichever step failed
+        user = User(None, "", "", "")
+        messages = [None]
+        timer = StageTimer()
+        wait_message = None
+        openai_response = None
+        log_context_token = None
+        turn = None
+        ticket = None
+        cache_lookup = None
+        outcome = "error"
 
         try:
             self.logging_wrapper("Arguments", logging.DEBUG, body=body, context=context)
@@ -135,58 +401,40 @@ class SlackGPTBot:
             thread_ts = body['event'].get('thread_ts', body['event']['ts'])
             bot_user_id = context['bot_user_id']
             user_id = context['user_id']
+            #-every line logged while handling this mention carries these
+            log_context_token = set_log_context(channel_id=channel_id, thread_ts=thread_ts, user_id=user_id)
+            #-until it is answered, replies after this mention are not stored in the thread state
+            turn = self.open_turns.open(channel_id, thread_ts, body['event']['ts'])
 
             #Impersonate A User Here
 
-            self.logging_wrapper("Milestone", logging.DEBUG, 
-                    milestone="Fetching user information from slack",
-                    user_id=user_id)
-            user = self.get_user_information(user_id)
-
-            '''
-            How to lock the bot to a particular channel
-            -------------------------------------------
-            In this case, for the beta testing we created the channel,
-            beta-slack-chatgpt-bot (channel_id: C057NBLL2G4). If the message
-            didn't originate from this channel, you got a polite message and 
-            were denied access.
-            
-            if channel_id != 'C057NBLL2G4': #lock to test channel for beta
-                slack_resp = app.client.chat_postMessage( 
-                    channel=channel_id,
-                    thread_ts=thread_ts,
-                    text="Our apologies, however the Beta ChatGPT bot is not allowed outside of the beta-slack-chatgpt-bot channel"
-                )
+            #-a full queue turns the mention away before any work is done
+            try:
+                ticket = self.admission.enqueue(user_id, channel_id)
+            except AdmissionRejected as e:
+                self.reject_mention(channel_id, thread_ts, e)
+                outcome = "rejected"
                 return
-            '''
-            slack_resp = self.app.client.chat_postMessage(
-                channel=channel_id,
-                thread_ts=thread_ts,
-                text=self.build_personalized_wait_message(user.real_name)
-            )
+
+            #-the wait message (users_info, then chat.postMessage) is posted while
+            #-the thread is read and processed; neither waits for the other
+            wait_message = self.preparation_pool.submit(
+                run_in_log_context(self.post_wait_message, channel_id, thread_ts, user_id, timer, ticket.position))
 
             self.logging_wrapper("Milestone", logging.DEBUG, 
                     milestone="Fetching conversation history from slack",
                     user_id=user_id,
-                    email=user.email,
                     channel=channel_id,
                     thread_ts=thread_ts)
 
-            reply_message_ts = slack_resp['message']['ts']
-            conversation_history = self.get_conversation_history(channel_id, thread_ts)
-
-            self.logging_wrapper("Milestone", logging.DEBUG, 
-                    milestone="Processing conversation history from slack",
-                    user_id=user_id,
-                    email=user.email,
-                    channel=channel_id,
-                    thread_ts=thread_ts)
-            messages = process_conversation_history(conversation_history, bot_user_id)
+            thread_state = self.get_thread_state(channel_id, thread_ts, bot_user_id,
+                                                 until_ts=body['event']['ts'], timer=timer)
+            messages = thread_state_messages(thread_state)
 
             self.logging_wrapper("Milestone", logging.DEBUG, 
                     milestone="Counting tokens",
                     messages=messages)
-            num_conversation_tokens = num_tokens_from_messages(messages, self.model_to_use)
+            num_conversation_tokens = num_tokens_from_thread_state(thread_state, self.model_to_use)
             
             '''
             print(openai.Model.list())
@@ -222,33 +470,51 @@ class SlackGPTBot:
                     milestone="Determining OpenAI Model to use",
                     num_conversation_tokens=num_conversation_tokens)
 
-            #Pick the model to use based on the number of tokens used thus far
-            #picking the extended model, means spending more, so only select that when 
-            #necessary
-            # model, token_count = OPENAI_MODEL_4_OHHHH, OPENAI_MODEL_4_OHHHH_TOKENS)
+            #The model is picked by the completion router from the number of tokens
+            #used thus far; picking the extended model means spending more, so it
+            #only selects that when necessary
 
-            max_response_tokens = self.model_tokens-num_conversation_tokens
+            with timer.stage("context_packing"):
+                messages, num_conversation_tokens, max_response_tokens = self.fit_to_context(
+                    messages, num_conversation_tokens, channel_id, thread_ts, user_id)
             self.logging_wrapper("Milestone", logging.DEBUG, 
                             milestone="Forwarding request to OpenAI",
                             model_used=self.model_to_use,
                             token_count=self.model_tokens,
                             token_used_count=num_conversation_tokens,
                             user_id=user_id,
-                            email=user.email,
                             request=messages[-1])
-    
-            openai_response = self.openai_client.chat.completions.create(
-                model=self.model_to_use,
-                messages=messages,
-                stream=True,
-                max_tokens=OPENAI_MODEL_4_OHHHH_MAX_TOKENS
-            )
 
-            slack_update_func = partial(update_chat, self.app, channel_id, reply_message_ts)
-            response_text = self.stream_openai_response_to_slack(openai_response, slack_update_func)
+            #-a question asked before is answered from the response cache,
+            #-without waiting for admission or calling OpenAI
+            if self.response_cache is not None:
+                with timer.stage("response_cache"):
+                    cache_lookup = self.response_cache.lookup(channel_id, self.model_to_use, messages)
+            if cache_lookup is not None and cache_lookup.hit:
+                openai_response = cache_lookup.replay()
+            else:
+                #-waits for a free slot and room in the tokens per minute budget
+                with timer.stage("admission_wait"):
+                    self.admission.admit(ticket, num_conversation_tokens + max_response_tokens)
+
+                #-retries, falls back to another model and waits for the first token
+                with timer.stage("openai_request"):
+                    openai_response = self.completion_router.create(
+                        messages, num_conversation_tokens, max_response_tokens)
+
+            with timer.stage("wait_message_pending"):
+                user, reply_message_ts = wait_message.result()
+
+            message_writer = self.build_message_writer(channel_id, thread_ts, reply_message_ts)
+            updater = self.build_chat_updater(message_writer)
+            response_text, finish_reason = self.stream_openai_response_to_slack(openai_response, updater, timer)
+            timer.mark("total")
+            outcome = "cached" if cache_lookup is not None and cache_lookup.hit else "answered"
+            if cache_lookup is not None and self.is_cacheable(openai_response, finish_reason):
+                self.response_cache.store(cache_lookup, response_text, openai_response.model)
 
             self.logging_wrapper("RequestResponse", logging.INFO,
-                model_used=self.model_to_use,
+                model_used=openai_response.model,
                 token_used_count=num_conversation_tokens,
                 max_response_tokens=max_response_tokens,
                 channel_id=channel_id,
@@ -257,10 +523,20 @@ class SlackGPTBot:
                 user=user.username, 
                 email=user.email,
                 request=messages[-1],   #Get the last request from the messages array
-                response=response_text
+                response=response_text,
+                chat_updates=updater.stats,
+                reply_messages=len(message_writer.message_ts),
+                timings_ms=timer.timings,
+                user_cache=self.user_cache.stats,
+                thread_lock_waits=self.thread_locks.waits,
+                queue_position=ticket.position,
+                admission=self.admission.stats,
+                response_cache=cache_lookup.hit if cache_lookup is not None else None,
+                response_cache_similarity=cache_lookup.similarity if cache_lookup is not None else None
             )
         
         except Exception as e:
+            user = self.abandon_preparation(wait_message, openai_response, user)
             self.logging_wrapper("Exception", logging.ERROR, 
                 model_used=self.model_to_use,
                 token_used_count=num_conversation_tokens,
@@ -271,9 +547,20 @@ class SlackGPTBot:
                 user=user.username, 
                 email=user.email,
                 request=messages[-1],
+                timings_ms=timer.timings,
+                admission=self.admission.stats,
                 exception=e
             )
             self.app.client.chat_postMessage(
                 channel=channel_id,
                 thread_ts=thread_ts,
                 text=f"Sorry, I can't provide a response. Encountered an error:\n`\n{e}\n`")
+        finally:
+            MENTIONS.labels(outcome).inc()
+            observe_timings(timer.timings)
+            if ticket is not None:
+                self.admission.finish(ticket)
+            if turn is not None:
+                self.open_turns.close(turn)
+            if log_context_token is not None:
+                reset_log_context(log_context_token)
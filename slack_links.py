@@ -0,0 +1,88 @@
+'''
+Single pass tokenizer for the links in Slack message text.
+
+Slack sends links, mentions and channel references as angle bracket markup,
+with &, < and > in the text escaped as &amp;, &lt; and &gt;:
+
+    <https://example.com/a?b=1&amp;c=2>       a URL
+    <https://example.com|label>              a URL with a label
+    <@U123> <@U123|jdoe>                     a user mention
+    <#C123> <#C123|general>                  a channel
+    <!here> <!subteam^S123|@team>            special mentions
+
+The regex this replaces backtracked exponentially on long <url|label>
+links.  tokenize_links() only uses str.find/rfind and never looks at a
+character more than a constant number of times, so it is linear in the
+length of the text whatever the input.
+'''
+from collections import namedtuple
+
+SlackLink = namedtuple('SlackLink', ('kind', 'target', 'label', 'start', 'end'))
+
+URL_SCHEMES = ("http://", "https://")
+WHITESPACE = (" ", "\t", "\n", "\r")
+
+
+def unescape(text):
+    '''
+    Undoes Slack's escaping (only &amp;, &lt; and &gt; are escaped).
+    '''
+    if "&" not in text:
+        return text
+    return text.replace("&lt;", "<").replace("&gt;", ">").replace("&amp;", "&")
+
+
+def parse_link(body, start, end):
+    '''
+    SlackLink for the markup between < and >, or None when it isn't one.
+    '''
+    target, _, label = body.partition("|")
+    label = unescape(label) if label else None
+    if target.startswith("@"):
+        return SlackLink("user", target[1:], label, start, end)
+    if target.startswith("#"):
+        return SlackLink("channel", target[1:], label, start, end)
+    if target.startswith("!"):
+        return SlackLink("special", target[1:], label, start, end)
+    if not target or any(space in target for space in WHITESPACE):
+        return None
+    kind = "url" if target.lower().startswith(URL_SCHEMES) else "link"
+    return SlackLink(kind, unescape(target), label, start, end)
+
+
+def tokenize_links(text):
+    '''
+    Yields a SlackLink for every <...> in text, in order; start and end are
+    the offsets of the < and one past the >.  Markup does not nest, so of
+    several < before a > the last one opens the link.
+    '''
+    position = 0
+    while True:
+        start = text.find("<", position)
+        if start == -1:
+            return
+        end = text.find(">", start + 1)
+        if end == -1:
+            return
+        #-each character of text[position:end + 1] is scanned at most three
+        #-times, and position moves past end
+        inner_start = text.rfind("<", start + 1, end)
+        if inner_start != -1:
+            start = inner_start
+        link = parse_link(text[start + 1:end], start, end + 1)
+        if link is not None:
+            yield link
+        position = end + 1
+
+
+def extract_urls(text):
+    '''
+    The distinct http(s) URLs linked from text, unescaped, in order.
+    '''
+    urls = []
+    seen = set()
+    for link in tokenize_links(text):
+        if link.kind == "url" and link.target not in seen:
+            seen.add(link.target)
+            urls.append(link.target)
+    return urls
@@ -0,0 +1,380 @@
+'''
+Coalesces the chat.update calls made while an answer is streaming.
+
+The streaming loop hands every new version of the text to submit() and never
+waits on Slack.  A background worker sends at most one chat.update per
+min_interval; versions submitted while an update is in flight (or while
+waiting) are merged so only the latest text is sent.  A 429 backs off for
+the Retry-After Slack asked for, and finish() delivers the final text exactly
+once.
+
+SplitMessageWriter sits between the coalescer and Slack: answers longer
+than one Slack message roll over into new thread replies, and only the tail
+reply is updated.
+'''
+import asyncio
+import logging
+import os
+import threading
+import time
+
+SLACK_UPDATE_MIN_INTERVAL = float(os.getenv("SLACK_UPDATE_MIN_INTERVAL", "1.0"))
+DEFAULT_RETRY_AFTER = 1.0
+MAX_FINAL_ATTEMPTS = 5
+
+
+class UpdateMetrics:
+    '''
+    Process wide chat.update counters.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {"updates_sent": 0, "updates_coalesced": 0, "rate_limited": 0, "update_errors": 0}
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+chat_update_metrics = UpdateMetrics()
+
+
+def rate_limit_delay(exception):
+    '''
+    Seconds to back off when exception is a Slack 429, otherwise None.
+    '''
+    response = getattr(exception, "response", None)
+    if getattr(response, "status_code", None) != 429:
+        return None
+    headers = getattr(response, "headers", None) or {}
+    retry_after = headers.get("Retry-After") or headers.get("retry-after")
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+class _CoalescerState:
+    '''
+    Bookkeeping shared by the thread and asyncio coalescers; callers hold
+    their own lock.
+    '''
+    def __init__(self, min_interval, metrics, time_func):
+        self.min_interval = min_interval
+        self.metrics = metrics
+        self.time_func = time_func
+        self.pending = None
+        self.final = False
+        self.closed = False
+        self.last_sent_at = None
+        self.backoff_until = 0.0
+        self.final_attempts = 0
+        self.error = None
+        self.stats = {"updates_sent": 0, "updates_coalesced": 0, "rate_limited": 0, "update_errors": 0}
+
+    def count(self, name):
+        self.stats[name] += 1
+        self.metrics.count(name)
+
+    def submit(self, text, final=False):
+        if self.final:
+            return
+        if self.pending is not None:
+            self.count("updates_coalesced")
+        self.pending = text
+        self.final = final
+
+    def next_send_at(self):
+        not_before = self.backoff_until
+        if self.last_sent_at is not None:
+            not_before = max(not_before, self.last_sent_at + self.min_interval)
+        return not_before
+
+    def take(self):
+        '''
+        Returns (text, final, delay): what to send now, or how long to wait.
+        '''
+        delay = self.next_send_at() - self.time_func()
+        if delay > 0:
+            return None, False, delay
+        text, final = self.pending, self.final
+        self.pending = None
+        return text, final, 0
+
+    def sent(self, final):
+        self.last_sent_at = self.time_func()
+        self.count("updates_sent")
+        return final
+
+    def failed(self, text, final, exception):
+        '''
+        Returns True when the worker should stop.
+        '''
+        delay = rate_limit_delay(exception)
+        if delay is not None:
+            self.count("rate_limited")
+            self.backoff_until = self.time_func() + delay
+        else:
+            self.count("update_errors")
+        if final:
+            self.final_attempts += 1
+            if self.final_attempts >= MAX_FINAL_ATTEMPTS:
+                self.error = exception
+                return True
+        #-retry rate limited or final texts, unless a newer one is already waiting
+        if (final or delay is not None) and self.pending is None:
+            self.pending = text
+            self.final = final
+        return False
+
+
+class ChatUpdateCoalescer:
+    '''
+    update_func(text) sends one chat.update, e.g.
+    partial(update_chat, app, channel_id, reply_message_ts).
+    '''
+    def __init__(self, update_func, min_interval=SLACK_UPDATE_MIN_INTERVAL,
+                 metrics=chat_update_metrics, time_func=time.monotonic):
+        self.update_func = update_func
+        self._state = _CoalescerState(min_interval, metrics, time_func)
+        self._cond = threading.Condition()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="chat-update", daemon=True)
+        self._thread.start()
+
+    @property
+    def stats(self):
+        return dict(self._state.stats)
+
+    def submit(self, text):
+        with self._cond:
+            self._state.submit(text)
+            self._cond.notify()
+
+    def finish(self, text, timeout=None):
+        '''
+        Sends text as the final version and waits until it is delivered.
+        '''
+        with self._cond:
+            self._state.submit(text, final=True)
+            self._cond.notify()
+        self._done.wait(timeout)
+        if self._state.error is not None:
+            raise self._state.error
+
+    def close(self):
+        '''
+        Stops without sending what is still pending, e.g. when the stream failed.
+        '''
+        with self._cond:
+            self._state.closed = True
+            self._cond.notify()
+
+    def _run(self):
+        state = self._state
+        try:
+            while True:
+                with self._cond:
+                    while state.pending is None and not state.closed:
+                        self._cond.wait()
+                    if state.closed:
+                        return
+                    text, final, delay = state.take()
+                    if text is None:
+                        self._cond.wait(delay)
+                        continue
+                try:
+                    self.update_func(text)
+                    if state.sent(final):
+                        return
+                except Exception as e:
+                    logging.getLogger(__name__).warning("chat.update failed: %s", e)
+                    with self._cond:
+                        if state.failed(text, final, e):
+                            return
+        finally:
+            self._done.set()
+
+
+class AsyncChatUpdateCoalescer:
+    '''
+    asyncio counterpart of ChatUpdateCoalescer; update_func is a coroutine
+    function.  Must be created inside a running event loop.
+    '''
+    def __init__(self, update_func, min_interval=SLACK_UPDATE_MIN_INTERVAL,
+                 metrics=chat_update_metrics, time_func=time.monotonic):
+        self.update_func = update_func
+        self._state = _CoalescerState(min_interval, metrics, time_func)
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    @property
+    def stats(self):
+        return dict(self._state.stats)
+
+    def submit(self, text):
+        self._state.submit(text)
+        self._wakeup.set()
+
+    async def finish(self, text):
+        self._state.submit(text, final=True)
+        self._wakeup.set()
+        await self._task
+        if self._state.error is not None:
+            raise self._state.error
+
+    def close(self):
+        self._state.closed = True
+        self._wakeup.set()
+
+    async def _run(self):
+        state = self._state
+        while True:
+            while state.pending is None and not state.closed:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            if state.closed:
+                return
+            text, final, delay = state.take()
+            if text is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self.update_func(text)
+                if state.sent(final):
+                    return
+            except Exception as e:
+                logging.getLogger(__name__).warning("chat.update failed: %s", e)
+                if state.failed(text, final, e):
+                    return
+
+
+SLACK_MESSAGE_MAX_CHARS = int(os.getenv("SLACK_MESSAGE_MAX_CHARS", "3900"))
+CODE_FENCE = "```"
+
+
+def split_point(text, max_chars):
+    '''
+    Where to cut text so the first part holds at most max_chars: after the
+    last paragraph break, else the last line break, else the last space, as
+    long as that keeps at least half of the message.
+    '''
+    if len(text) <= max_chars:
+        return len(text)
+    for separator in ("\n\n", "\n", " "):
+        position = text.rfind(separator, max_chars // 2, max_chars)
+        if position != -1:
+            return position + len(separator)
+    return max_chars
+
+
+def open_code_fence(text):
+    '''
+    The fence line ("```python") of a code block left open at the end of
+    text, otherwise None.
+    '''
+    if text.count(CODE_FENCE) % 2 == 0:
+        return None
+    start = text.rfind(CODE_FENCE)
+    end = text.find("\n", start)
+    return text[start:end if end != -1 else len(text)].strip()
+
+
+class SplitMessageWriter:
+    '''
+    Streams an answer into as many thread replies as it needs.  Called with
+    the full text so far; once the tail message would pass max_chars it is
+    sealed at a paragraph or line break (closing and reopening a code block
+    cut in two) and the rest continues in a new reply, so every chat.update
+    carries at most max_chars.
+
+    update_func(ts, text) edits a message, post_func(text) posts a new reply
+    in the thread and returns its ts.  A failed call changes nothing, so the
+    next call (e.g. the coalescer retrying after a 429) picks up where it
+    stopped.
+    '''
+    def __init__(self, update_func, post_func, ts, max_chars=SLACK_MESSAGE_MAX_CHARS):
+        self.update_func = update_func
+        self.post_func = post_func
+        self.max_chars = max_chars
+        self.message_ts = [ts]
+        self.offset = 0         # start of the tail message in the full text
+        self.prefix = ""        # reopened code fence the tail message starts with
+        self.tail_text = None   # what the tail message shows right now
+        self.tail_sealed = False
+
+    @property
+    def ts(self):
+        return self.message_ts[-1]
+
+    def steps(self, text):
+        '''
+        Yields ("update", ts, text) and ("post", text) calls; the ts a post
+        returns is sent back in.
+        '''
+        while True:
+            body = self.prefix + text[self.offset:]
+            if len(body) <= self.max_chars:
+                break
+            #-leave room to close a code block
+            cut = max(split_point(body, self.max_chars - len(CODE_FENCE) - 1), len(self.prefix) + 1)
+            sealed = body[:cut].rstrip()
+            fence = open_code_fence(sealed)
+            if fence is not None:
+                sealed += "\n" + CODE_FENCE
+            if not self.tail_sealed:
+                yield ("update", self.ts, sealed)
+                self.tail_sealed = True
+
+            start = len(body) - len(body[cut:].lstrip("\n"))
+            next_prefix = fence + "\n" if fence is not None else ""
+            continued = (next_prefix + body[start:])[:self.max_chars]
+            ts = yield ("post", continued)
+            self.message_ts.append(ts)
+            self.offset += start - len(self.prefix)
+            self.prefix = next_prefix
+            self.tail_text = continued
+            self.tail_sealed = False
+
+        if body != self.tail_text:
+            yield ("update", self.ts, body)
+            self.tail_text = body
+
+    def __call__(self, text):
+        steps = self.steps(text)
+        result = None
+        while True:
+            try:
+                step = steps.send(result)
+            except StopIteration:
+                return
+            if step[0] == "update":
+                result = self.update_func(*step[1:])
+            else:
+                result = self.post_func(*step[1:])
+
+
+class AsyncSplitMessageWriter(SplitMessageWriter):
+    '''
+    SplitMessageWriter for coroutine update_func and post_func.
+    '''
+    async def __call__(self, text):
+        steps = self.steps(text)
+        result = None
+        while True:
+            try:
+                step = steps.send(result)
+            except StopIteration:
+                return
+            if step[0] == "update":
+                result = await self.update_func(*step[1:])
+            else:
+                result = await self.post_func(*step[1:])
@@ -0,0 +1,132 @@
+'''
+Structured JSON logging for the bot.
+
+logging_wrapper() used to hand its fields to json_std_logger._setParams(),
+which built the log payload before the level was checked and kept it in
+state shared by every handler thread, so concurrent mentions could leak
+fields into each other's lines.  Here the level is checked first, fields
+wrapped in lazy() are only computed for lines that are emitted, and
+per-request fields (channel, thread, user) live in a contextvar that every
+line logged while handling that request picks up.
+
+With LOG_QUEUE set, records are handed to a listener thread unformatted, so
+JSON serialization and the stdout write happen off the request thread.
+'''
+import atexit
+import contextvars
+import logging
+import logging.handlers
+import os
+import queue
+
+from json_logger_stdout import json_std_logger
+
+LOG_QUEUE = os.getenv("LOG_QUEUE", "").lower() in ("1", "true", "yes")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+SEVERITIES = (logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL)
+
+_log_context = contextvars.ContextVar("log_context", default={})
+
+
+class lazy:
+    '''
+    A log field computed only when the line is emitted:
+
+        logging_wrapper("Milestone", logging.DEBUG, url_cache=lazy(lambda: cache.stats))
+    '''
+    __slots__ = ("func",)
+
+    def __init__(self, func):
+        self.func = func
+
+
+def logging_wrapper(message, severity=logging.INFO, **kwargs):
+    logger = json_std_logger.logger
+    if severity not in SEVERITIES:
+        severity = logging.INFO
+    if not logger.isEnabledFor(severity):
+        return
+    fields = dict(_log_context.get())
+    for key, value in kwargs.items():
+        fields[key] = value.func() if isinstance(value, lazy) else value
+    fields["message"] = message
+    logger.log(severity, fields)
+
+
+def set_log_context(**fields):
+    '''
+    Adds fields to every line logged from this thread / task until the
+    returned token is passed to reset_log_context().
+    '''
+    return _log_context.set(dict(_log_context.get(), **fields))
+
+
+def reset_log_context(token):
+    _log_context.reset(token)
+
+
+def log_context():
+    return dict(_log_context.get())
+
+
+def run_in_log_context(func, *args):
+    '''
+    Wraps func so it runs with the caller's log context on another thread
+    (executors do not carry contextvars over).
+    '''
+    context = contextvars.copy_context()
+    return lambda: context.run(func, *args)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler that leaves formatting to the listener; the stock one
+    formats the record on the calling thread.  Records that do not fit in
+    the queue are dropped and counted rather than blocking the request.
+    '''
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class DeferredQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        #-the stock listener uses put_nowait, which fails on a full queue
+        self.queue.put(self._sentinel)
+
+
+def enable_queue_logging(logger=None, maxsize=LOG_QUEUE_SIZE):
+    '''
+    Moves the logger's handlers behind a DeferredQueueHandler served by a
+    QueueListener thread.  Logged values are serialized on that thread, so
+    they must not be mutated after logging.  Returns the listener (None if
+    already enabled).
+    '''
+    logger = logger or json_std_logger.logger
+    if any(isinstance(handler, DeferredQueueHandler) for handler in logger.handlers):
+        return None
+    handlers = list(logger.handlers)
+    log_queue = queue.Queue(maxsize)
+    listener = DeferredQueueListener(log_queue, *handlers, respect_handler_level=True)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    listener.start()
+    atexit.register(_stop_listener, listener)
+    return listener
+
+
+def _stop_listener(listener):
+    #-flushes what is queued; QueueListener.stop() fails when called twice
+    if listener._thread is not None:
+        listener.stop()
@@ -0,0 +1,131 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import admission
+from admission import AdmissionController, AdmissionRejected, AdmissionTimeout, AsyncAdmissionController
+
+
+def admit_in_thread(controller, ticket, tokens, admitted):
+    def run():
+        controller.admit(ticket, tokens)
+        admitted.append(ticket)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_in_flight_cap_admits_in_arrival_order():
+    controller = AdmissionController(max_in_flight=2, max_queue=10)
+    tickets = [controller.enqueue(f"U{i}", f"C{i}") for i in range(4)]
+    admitted = []
+
+    assert [ticket.position for ticket in tickets] == [0, 0, 1, 2]
+    controller.admit(tickets[0], 100)
+    controller.admit(tickets[1], 100)
+    admit_in_thread(controller, tickets[3], 100, admitted)
+    admit_in_thread(controller, tickets[2], 100, admitted)
+    assert wait_for(lambda: controller.state.waiting[0].tokens is not None)
+    assert controller.stats["queue_depth"] == 2 and controller.stats["in_flight"] == 2
+
+    controller.finish(tickets[0])
+    #-3 was ready before 2, but 2 arrived first
+    assert wait_for(lambda: admitted == [tickets[2]])
+
+    for ticket in tickets:
+        controller.finish(ticket)
+    assert wait_for(lambda: admitted == [tickets[2], tickets[3]])
+    stats = controller.stats
+    assert (stats["admitted"], stats["in_flight"], stats["queue_depth"]) == (4, 0, 0)
+    assert stats["max_queue_depth"] == 4 and stats["wait_ms_max"] > 0
+
+
+def test_busy_users_and_channels_do_not_hold_up_others():
+    controller = AdmissionController(max_in_flight=10, max_per_user=1, max_per_channel=2)
+    admitted = []
+    first = controller.admit(controller.enqueue("U1", "C1"), 10)
+    second_of_user = controller.enqueue("U1", "C2")
+    other_user = controller.enqueue("U2", "C1")
+    third_in_channel = controller.enqueue("U3", "C1")
+
+    admit_in_thread(controller, second_of_user, 10, admitted)
+    admit_in_thread(controller, other_user, 10, admitted)
+    admit_in_thread(controller, third_in_channel, 10, admitted)
+
+    assert wait_for(lambda: admitted == [other_user])
+    controller.finish(first)
+    assert wait_for(lambda: len(admitted) == 3)
+    assert set(admitted) == {other_user, second_of_user, third_in_channel}
+
+
+def test_tokens_per_minute_budget(monkeypatch):
+    monkeypatch.setattr(admission, "TOKEN_WINDOW", 0.5)
+    controller = AdmissionController(max_in_flight=10, tokens_per_minute=1000)
+    admitted = []
+
+    controller.admit(controller.enqueue("U1", "C1"), 600)
+    waiting = controller.enqueue("U2", "C2")
+    started = time.monotonic()
+    admit_in_thread(controller, waiting, 600, admitted).join(5)
+
+    assert admitted == [waiting]
+    assert time.monotonic() - started >= 0.4
+    #-larger than the whole budget, it runs once the window is empty
+    time.sleep(0.5)
+    controller.admit(controller.enqueue("U3", "C3"), 5000)
+    assert controller.stats["tokens_last_minute"] == 5000
+
+
+def test_full_queue_rejects_at_once():
+    controller = AdmissionController(max_in_flight=1, max_queue=1)
+    controller.enqueue("U1", "C1")
+    assert controller.enqueue("U2", "C2").position == 1
+
+    with pytest.raises(AdmissionRejected):
+        controller.enqueue("U3", "C3")
+    assert controller.stats["rejected"] == 1
+
+
+def test_waiting_too_long_gives_up():
+    controller = AdmissionController(max_in_flight=1, max_wait=0.2)
+    controller.admit(controller.enqueue("U1", "C1"), 10)
+    ticket = controller.enqueue("U2", "C2")
+
+    with pytest.raises(AdmissionTimeout):
+        controller.admit(ticket, 10)
+
+    controller.finish(ticket)
+    stats = controller.stats
+    assert (stats["timed_out"], stats["queue_depth"], stats["in_flight"]) == (1, 0, 1)
+
+
+def test_async_controller():
+    controller = AsyncAdmissionController(max_in_flight=1)
+    order = []
+
+    async def complete(name):
+        ticket = controller.enqueue(name, "C1")
+        await asyncio.sleep(0)
+        await controller.admit(ticket, 10)
+        order.append(f"{name} start")
+        await asyncio.sleep(0.05)
+        order.append(f"{name} end")
+        await controller.finish(ticket)
+
+    async def main():
+        await asyncio.gather(complete("U1"), complete("U2"), complete("U3"))
+
+    asyncio.run(main())
+
+    assert order == ["U1 start", "U1 end", "U2 start", "U2 end", "U3 start", "U3 end"]
+    assert controller.stats["admitted"] == 3
@@ -0,0 +1,143 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import async_slack_gpt_bot
+import slack_gpt_bot
+from admission import AsyncAdmissionController
+from async_slack_gpt_bot import AsyncSlackGPTBot
+from cache import MemoryCacheBackend
+from thread_state import ThreadStateStore
+
+
+class FakeAsyncSlackClient:
+    def __init__(self, thread):
+        self.thread = thread
+        self.updates = []
+        self.posted = []
+
+    async def users_info(self, user):
+        return {"user": {"name": "jdoe", "profile": {"first_name": "Jane", "email": "jdoe@example.com"}}}
+
+    async def chat_postMessage(self, channel, thread_ts, text):
+        ts = f"1700000000.{len(self.thread):06d}"
+        self.posted.append(text)
+        self.thread.append({"ts": ts, "user": "BOT", "text": text})
+        return {"message": {"ts": ts}}
+
+    async def conversations_replies(self, channel, ts, limit, inclusive, oldest=None, cursor=None):
+        return {"messages": list(self.thread), "response_metadata": {"next_cursor": ""}}
+
+    async def chat_update(self, channel, ts, text):
+        self.updates.append(text)
+
+
+class FakeAsyncStream:
+    def __init__(self, pieces, delay):
+        self.chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece), finish_reason=None)])
+                       for piece in pieces]
+        self.chunks.append(SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=None), finish_reason="stop")]))
+        self.delay = delay
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(self.delay)
+            yield chunk
+
+
+class FakeAsyncOpenAI:
+    def __init__(self, pieces, delay=0.0):
+        self.requests = []
+        self.pieces = pieces
+        self.delay = delay
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **kwargs):
+        self.requests.append(kwargs)
+        return FakeAsyncStream(self.pieces, self.delay)
+
+
+@pytest.fixture(autouse=True)
+def no_tokenizer(monkeypatch):
+    monkeypatch.setattr(slack_gpt_bot, "num_tokens_per_message",
+                        lambda messages, model: [len(m["content"]) for m in messages])
+    monkeypatch.setattr(async_slack_gpt_bot, "num_tokens_from_thread_state",
+                        lambda state, model: sum(m["tokens"] for m in state["messages"]))
+
+
+def build_bot(thread, openai_client, admission=None):
+    app = SimpleNamespace(client=FakeAsyncSlackClient(thread))
+    return AsyncSlackGPTBot(app, openai_client=openai_client,
+                            thread_state_store=ThreadStateStore(MemoryCacheBackend()),
+                            admission=admission)
+
+
+def mention(thread_ts="1700000000.000000", user_id="U1"):
+    return ({"event": {"channel": "C1", "ts": thread_ts, "thread_ts": thread_ts}},
+            {"bot_user_id": "BOT", "user_id": user_id})
+
+
+def test_mention_is_answered_through_the_async_clients():
+    thread = [{"ts": "1700000000.000000", "user": "U1", "text": "<@BOT> why is the sky blue?"}]
+    openai_client = FakeAsyncOpenAI(["Rayleigh ", "scattering."])
+    bot = build_bot(thread, openai_client)
+
+    asyncio.run(bot.handle_app_mentions(*mention()))
+
+    assert bot.app.client.posted == ["Hi Jane! I got your request, please wait while I ask the wizard..."]
+    request = openai_client.requests[0]
+    assert request["stream"] is True
+    assert request["messages"][-1] == {"role": "user", "content": "why is the sky blue?"}
+    assert bot.app.client.updates[-1] == "Rayleigh scattering."
+    #-no threads are started for work the event loop does
+    assert bot.preparation_pool is None
+
+
+
+def test_history_pages_keep_the_repeated_parent_once():
+    parent = {"ts": "1700000000.000000", "user": "U1", "text": "<@BOT> question"}
+    replies = [{"ts": f"1700000000.{i:06d}", "user": "U2", "text": f"reply {i}"} for i in range(1, 5)]
+    pages = {None: ([parent] + replies[:2], "page2"), "page2": ([parent] + replies[2:], "")}
+    bot = build_bot([], FakeAsyncOpenAI([]))
+
+    async def conversations_replies(channel, ts, limit, inclusive, oldest=None, cursor=None):
+        messages, next_cursor = pages[cursor]
+        return {"messages": messages, "response_metadata": {"next_cursor": next_cursor}}
+
+    bot.app.client.conversations_replies = conversations_replies
+    history = asyncio.run(bot.get_conversation_history("C1", parent["ts"]))
+
+    assert history["messages"] == [parent] + replies
+
+def test_errors_are_reported_in_the_thread():
+    thread = [{"ts": "1700000000.000000", "user": "U1", "text": "<@BOT> hello"}]
+
+    class FailingOpenAI(FakeAsyncOpenAI):
+        async def create(self, **kwargs):
+            raise RuntimeError("boom")
+
+    bot = build_bot(thread, FailingOpenAI([]))
+    asyncio.run(bot.handle_app_mentions(*mention()))
+
+    assert bot.app.client.posted[-1].startswith("Sorry, I can't provide a response.")
+    assert "boom" in bot.app.client.posted[-1]
+
+
+def test_concurrent_mentions_stream_at_the_same_time():
+    thread = [{"ts": "1700000000.000000", "user": "U1", "text": "<@BOT> hello"}]
+    bot = build_bot(thread, FakeAsyncOpenAI(["x"] * 10, delay=0.02),
+                    AsyncAdmissionController(max_in_flight=20, max_per_channel=20))
+
+    async def run():
+        started = time.monotonic()
+        await asyncio.gather(*(bot.handle_app_mentions(*mention(f"1700000001.{i:06d}", f"U{i}"))
+                               for i in range(20)))
+        return time.monotonic() - started
+
+    #-20 streams of ~0.22s each, well under the 4.4s they take one after another
+    assert asyncio.run(run()) < 2
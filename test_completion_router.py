@@ -0,0 +1,180 @@
+import asyncio
+import time
+
+import openai
+import pytest
+from openai import AsyncOpenAI, OpenAI
+from prometheus_client import REGISTRY
+
+import completion_router
+from benchmarks.fake_services import FakeOpenAI
+from completion_router import (AsyncCompletionRouter, CompletionRouter, ModelRoute, StreamStalled,
+                               parse_duration)
+
+MESSAGES = [{"role": "user", "content": "why is the sky blue?"}]
+ROUTES = [ModelRoute("gpt-4o", 128000), ModelRoute("gpt-4o-mini", 128000), ModelRoute("gpt-4.1", 1000000)]
+
+
+@pytest.fixture
+def fake_openai():
+    servers = []
+
+    def start(script=None, **kwargs):
+        kwargs.setdefault("chunks", 5)
+        kwargs.setdefault("first_token_delay", 0.0)
+        server = FakeOpenAI(script=script, **kwargs).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def logs(monkeypatch):
+    records = []
+    monkeypatch.setattr(completion_router, "logging_wrapper",
+                        lambda message, severity=None, **kwargs: records.append((message, kwargs)))
+    return records
+
+
+def build_router(server, client_class=OpenAI, router_class=CompletionRouter, **kwargs):
+    client = client_class(api_key="test", base_url=server.base_url, max_retries=0)
+    kwargs.setdefault("base_delay", 0.01)
+    return router_class(client, ROUTES, **kwargs)
+
+
+def read(stream):
+    return "".join(chunk.choices[0].delta.content or "" for chunk in stream)
+
+
+def test_rate_limit_waits_for_retry_after(fake_openai, logs):
+    server = fake_openai([{"status": 429, "headers": {"Retry-After": "0.3"}}])
+    router = build_router(server)
+
+    started = time.monotonic()
+    stream = router.create(MESSAGES, 10, 100)
+
+    assert read(stream) == "token " * 5
+    assert time.monotonic() - started >= 0.3
+    assert [request["model"] for request in server.requests] == ["gpt-4o", "gpt-4o"]
+    message, routed = logs[-1]
+    assert message == "CompletionRouted" and not routed["fallback"]
+    assert [(a["outcome"], a.get("status")) for a in routed["attempts"]] == [("retry", 429), ("ok", None)]
+
+
+def test_server_errors_fall_back_to_the_next_model(fake_openai, logs):
+    server = fake_openai([{"status": 500}, {"status": 503}])
+    stream = build_router(server, max_attempts=2).create(MESSAGES, 10, 100)
+
+    assert stream.model == "gpt-4o-mini"
+    assert [request["model"] for request in server.requests] == ["gpt-4o", "gpt-4o", "gpt-4o-mini"]
+    assert logs[-1][1]["fallback"] is True
+
+
+def test_long_retry_after_falls_back_at_once(fake_openai, logs):
+    server = fake_openai([{"status": 429, "headers": {"Retry-After": "120"}}])
+    stream = build_router(server).create(MESSAGES, 10, 100)
+
+    assert stream.model == "gpt-4o-mini"
+    assert len(server.requests) == 2
+
+
+def test_client_errors_are_not_retried(fake_openai, logs):
+    server = fake_openai([{"status": 401}])
+
+    with pytest.raises(openai.AuthenticationError):
+        build_router(server).create(MESSAGES, 10, 100)
+    assert len(server.requests) == 1
+    assert logs[-1][0] == "CompletionFailed"
+
+
+def test_context_overflow_moves_to_a_larger_model(fake_openai, logs):
+    server = fake_openai([{"status": 400, "code": "context_length_exceeded"}] * 2)
+    stream = build_router(server).create(MESSAGES, 10, 100)
+
+    assert stream.model == "gpt-4.1"
+
+
+def test_model_is_picked_by_token_count(fake_openai, logs):
+    server = fake_openai()
+    router = build_router(server)
+
+    assert router.create(MESSAGES, 200000, 4096).model == "gpt-4.1"
+    assert server.requests[-1]["max_tokens"] == 4096
+    assert router.policy.route(127000, 4096) == [("gpt-4.1", 4096)]
+    assert router.policy.route(999000, 4096) == [("gpt-4.1", 1000)]
+    assert router.context_tokens == 1000000
+
+
+def test_slow_first_token_is_retried(fake_openai, logs):
+    server = fake_openai([{"first_token_delay": 3}])
+    router = build_router(server, first_token_timeout=0.3)
+
+    started = time.monotonic()
+    assert read(router.create(MESSAGES, 10, 100)) == "token " * 5
+    assert time.monotonic() - started < 2
+    assert logs[-1][1]["attempts"][0]["error"].startswith("StreamStalled")
+
+
+def test_stalled_stream_raises_instead_of_hanging(fake_openai, logs):
+    server = fake_openai([{"stall_after": 2, "stall": 3}])
+    stream = build_router(server, stall_timeout=0.3).create(MESSAGES, 10, 100)
+
+    received = []
+    started = time.monotonic()
+    with pytest.raises(StreamStalled):
+        for chunk in stream:
+            received.append(chunk.choices[0].delta.content)
+    assert time.monotonic() - started < 2
+    assert received == ["", "token ", "token "]
+    assert logs[-1][0] == "CompletionStalled"
+
+
+def test_async_router(fake_openai, logs):
+    server = fake_openai([{"status": 502}, {"first_token_delay": 3}, {"stall_after": 1, "stall": 3}])
+    router = build_router(server, AsyncOpenAI, AsyncCompletionRouter, max_attempts=2,
+                          first_token_timeout=0.3, stall_timeout=0.3)
+
+    async def run():
+        stream = await router.create(MESSAGES, 10, 100)
+        received = []
+        with pytest.raises(StreamStalled):
+            async for chunk in stream:
+                received.append(chunk.choices[0].delta.content)
+        await stream.close()
+        return stream.model, received
+
+    started = time.monotonic()
+    assert asyncio.run(run()) == ("gpt-4o-mini", ["", "token "])
+    assert time.monotonic() - started < 3
+    assert [request["model"] for request in server.requests] == ["gpt-4o", "gpt-4o", "gpt-4o-mini"]
+
+
+def test_first_token_and_streaming_rate_are_exported(fake_openai, logs):
+    server = fake_openai(chunks=20, chunk_delay=0.01)
+    names = ("slack_gpt_bot_openai_first_token_seconds_count", "slack_gpt_bot_openai_tokens_per_second_count",
+             "slack_gpt_bot_openai_tokens_per_second_sum")
+
+    def samples():
+        return [REGISTRY.get_sample_value(name, {"model": "gpt-4o"}) or 0 for name in names]
+
+    before = samples()
+    #-read like the bots do, stopping at the finish reason
+    for chunk in build_router(server).create(MESSAGES, 10, 100):
+        if chunk.choices[0].finish_reason:
+            break
+    first_tokens, rates, rate = [after - earlier for after, earlier in zip(samples(), before)]
+
+    assert first_tokens == 1 and rates == 1
+    #-19 chunks after the first, 10ms apart
+    assert 10 < rate < 110
+
+
+def test_parse_duration():
+    assert parse_duration("2") == 2
+    assert parse_duration("20ms") == 0.02
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("1m30.5s") == 90.5
+    assert parse_duration("Wed, 21 Oct 2015 07:28:00 GMT") is None
@@ -0,0 +1,109 @@
+import pytest
+
+import utils
+from cache import MemoryCacheBackend
+from context_packer import REPLY_PRIMING_TOKENS, TRUNCATION_MARKER, ContextPacker, truncate_text_to_tokens
+
+
+class CharEncoding:
+    '''
+    One token per character, so token budgets are easy to reason about.
+    '''
+    name = "chars"
+
+    def __init__(self):
+        self.encoded_chars = 0
+
+    def encode(self, text):
+        self.encoded_chars += len(text)
+        return list(text)
+
+    def encode_batch(self, texts, num_threads=8):
+        return [self.encode(text) for text in texts]
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+
+@pytest.fixture
+def encoding(monkeypatch):
+    encoding = CharEncoding()
+    monkeypatch.setattr(utils, "get_encoding", lambda model: encoding)
+    monkeypatch.setattr(utils, "token_count_cache", MemoryCacheBackend(max_entries=1000))
+    utils.message_token_parameters.cache_clear()
+    yield encoding
+    utils.message_token_parameters.cache_clear()
+
+
+def conversation(*contents):
+    messages = [{"role": "system", "content": "S" * 10}]
+    for i, content in enumerate(contents):
+        messages.append({"role": "user" if i % 2 == 0 else "assistant", "content": content})
+    return messages
+
+
+def request_tokens(messages):
+    return sum(utils.num_tokens_per_message(messages, "gpt-4o")) + REPLY_PRIMING_TOKENS
+
+
+def test_conversation_within_budget_is_untouched(encoding):
+    messages = conversation("hello", "hi there", "question?")
+
+    packed, report = ContextPacker("gpt-4o", 1000).pack(messages)
+
+    assert packed == messages
+    assert report.tokens_before == report.tokens_after == request_tokens(messages)
+    assert report.dropped_messages == report.truncated_messages == 0
+
+
+def test_largest_earlier_message_is_truncated_first(encoding):
+    messages = conversation("summarize this " + "x" * 2000, "summary", "and what about y?")
+    packer = ContextPacker("gpt-4o", 1000, min_truncated_tokens=100)
+
+    packed, report = packer.pack(messages)
+
+    assert report.truncated_messages == 1 and report.dropped_messages == 0
+    assert packed[1]["content"].startswith("summarize this xxx")
+    assert packed[1]["content"].endswith(TRUNCATION_MARKER)
+    assert packed[-1] == messages[-1]
+    assert report.tokens_after == request_tokens(packed) <= 1000
+
+
+def test_oldest_turns_are_dropped_after_truncation(encoding):
+    turns = [f"turn {i} " + "y" * 200 for i in range(20)] + ["latest question"]
+    messages = conversation(*turns)
+    packer = ContextPacker("gpt-4o", 1000, min_truncated_tokens=150)
+
+    packed, report = packer.pack(messages)
+
+    assert packed[0] == messages[0] and packed[-1] == messages[-1]
+    assert report.dropped_messages > 0
+    kept = [m["content"].split()[1] for m in packed[1:-1]]
+    assert kept == sorted(kept, key=int) and kept[-1] == "19"
+    assert request_tokens(packed) <= 1000
+
+
+def test_oversized_latest_question_is_truncated(encoding):
+    messages = conversation("old question", "old answer", "what does this say? " + "z" * 5000)
+
+    packed, report = ContextPacker("gpt-4o", 500).pack(messages)
+
+    assert len(packed) == 2
+    assert packed[-1]["content"].startswith("what does this say?")
+    assert report.dropped_messages == 2 and report.truncated_messages == 1
+    assert request_tokens(packed) <= 500
+
+
+def test_system_prompt_that_does_not_fit_raises(encoding):
+    with pytest.raises(ValueError):
+        ContextPacker("gpt-4o", 5).pack(conversation("question"))
+
+
+def test_truncation_encodes_only_what_it_needs(encoding):
+    text = "word " * 100000
+
+    truncated = truncate_text_to_tokens(text, 100, encoding, chunk_chars=1000)
+
+    assert truncated == text[:100]
+    assert encoding.encoded_chars <= 1000
+    assert truncate_text_to_tokens("short", 100, encoding) == "short"
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+from slack_bolt import App, BoltRequest
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.request.async_request import AsyncBoltRequest
+from slack_bolt.authorization import AuthorizeResult
+
+from cache import MemoryCacheBackend, RedisCacheBackend, SQLiteCacheBackend
+from event_dedup import EventDeduplicator, event_key
+
+
+def app_mention(event_id="Ev1", ts="1700000000.000100"):
+    return {"type": "event_callback", "team_id": "T1", "api_app_id": "A1", "event_id": event_id,
+            "event": {"type": "app_mention", "channel": "C1", "user": "U1", "ts": ts, "text": "<@UBOT> hi"}}
+
+
+def authorize(**kwargs):
+    return AuthorizeResult(enterprise_id=None, team_id="T1", bot_user_id="UBOT", bot_id="B1", bot_token="xoxb-test")
+
+
+@pytest.mark.parametrize("backend_name", ["memory", "sqlite", "redis"])
+def test_add_only_stores_absent_keys(tmp_path, backend_name, clock, fake_redis):
+    backend = {
+        "memory": lambda: MemoryCacheBackend(time_func=clock),
+        "sqlite": lambda: SQLiteCacheBackend(str(tmp_path / "events.db"), time_func=clock),
+        "redis": lambda: RedisCacheBackend(fake_redis),
+    }[backend_name]()
+
+    assert backend.add("Ev1", "0", ttl=60)
+    assert not backend.add("Ev1", "1", ttl=60)
+    assert backend.add("Ev2", "0", ttl=60)
+    clock.now += 61
+    assert backend.add("Ev1", "0", ttl=60)
+
+
+def test_redeliveries_are_reported_once():
+    deduplicator = EventDeduplicator(MemoryCacheBackend())
+
+    assert deduplicator.first_delivery(app_mention())
+    assert not deduplicator.first_delivery(app_mention(), retry_num="1", retry_reason="http_timeout")
+    assert deduplicator.first_delivery(app_mention("Ev2"))
+
+    assert deduplicator.stats == {"events": 3, "duplicates": 1, "retries": 1}
+    assert event_key({"event": {"channel": "C1", "ts": "1.0"}}) == "C1:1.0"
+
+
+def test_concurrent_deliveries_pass_once():
+    deduplicator = EventDeduplicator(MemoryCacheBackend())
+    barrier = threading.Barrier(8)
+    passed = []
+
+    def deliver():
+        barrier.wait()
+        passed.append(deduplicator.first_delivery(app_mention()))
+
+    threads = [threading.Thread(target=deliver) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(passed) == [False] * 7 + [True]
+
+
+def test_bolt_acks_retries_without_running_the_listener():
+    handled = []
+    done = threading.Event()
+    app = App(signing_secret="secret", authorize=authorize, request_verification_enabled=False)
+    app.use(EventDeduplicator(MemoryCacheBackend()).bolt_middleware)
+
+    @app.event("app_mention")
+    def handle_app_mentions(body):
+        handled.append(body["event_id"])
+        done.set()
+
+    body = json.dumps(app_mention())
+    first = app.dispatch(BoltRequest(body=body, headers={"content-type": ["application/json"]}))
+    retry = app.dispatch(BoltRequest(body=body, headers={"content-type": ["application/json"],
+                                                         "x-slack-retry-num": ["1"],
+                                                         "x-slack-retry-reason": ["http_timeout"]}))
+
+    assert first.status == 200 and retry.status == 200
+    assert done.wait(5)
+    assert handled == ["Ev1"]
+
+
+
+class SlowBackend(MemoryCacheBackend):
+    def add(self, key, value, ttl=None):
+        time.sleep(0.2)
+        return super().add(key, value, ttl)
+
+
+def test_async_middleware_keeps_the_backend_off_the_event_loop():
+    handled = []
+    async def async_authorize(**kwargs):
+        return authorize()
+
+    app = AsyncApp(signing_secret="secret", authorize=async_authorize, request_verification_enabled=False)
+    app.use(EventDeduplicator(SlowBackend()).async_bolt_middleware)
+
+    @app.event("app_mention")
+    async def handle_app_mentions(body):
+        handled.append(body["event_id"])
+
+    async def run():
+        ticks = 0
+        body = json.dumps(app_mention())
+        deliveries = asyncio.ensure_future(asyncio.gather(*(
+            app.async_dispatch(AsyncBoltRequest(body=body, headers={"content-type": ["application/json"],
+                                                                    "x-slack-retry-num": [str(n)]}))
+            for n in range(2))))
+        while not deliveries.done():
+            await asyncio.sleep(0.01)
+            ticks += 1
+        await asyncio.sleep(0.1)
+        return await deliveries, ticks
+
+    responses, ticks = asyncio.run(run())
+
+    assert [response.status for response in responses] == [200, 200]
+    #-the loop kept running while the backend was slow
+    assert ticks >= 10
+    assert handled == ["Ev1"]
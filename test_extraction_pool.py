@@ -0,0 +1,256 @@
+import os
+import pickle
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from cache import MemoryCacheBackend
+from extraction_pool import (ExtractionCancelled, ExtractionMemoryError, ExtractionProcessPool, ExtractionTimeout,
+                             process_rss)
+from url_cache import ExtractionCache
+from url_fetcher import URLFetcher, extract_document
+
+MB = 1024 * 1024
+RETAINED = []
+
+
+def large_article(paragraphs, marker):
+    '''
+    A news style page: navigation and boilerplate around a long article.
+    '''
+    parts = ["<html><head><title>Report</title></head><body>",
+             "<nav>" + "".join(f"<a href='/s{i}'>Section {i}</a>" for i in range(200)) + "</nav>",
+             f"<article><h1>{marker}</h1>"]
+    for i in range(paragraphs):
+        parts.append(f"<p>Paragraph {i} of the report. " + "The quick brown fox jumps over the lazy dog. " * 12
+                     + "</p>")
+    parts.append("</article><footer>" + "<div>Copyright notice</div>" * 500 + "</footer></body></html>")
+    return "".join(parts).encode()
+
+
+def worker_pid():
+    return os.getpid()
+
+
+def sleep_then(seconds, value):
+    time.sleep(seconds)
+    return value
+
+
+def hog(megabytes, hold):
+    ballast = b"x" * (megabytes * MB)
+    time.sleep(hold)
+    return len(ballast)
+
+
+def grow(megabytes):
+    RETAINED.append(b"x" * (megabytes * MB))
+    return megabytes
+
+
+def stuck_extract(body):
+    return sleep_then(30, body)
+
+
+def fail():
+    raise ValueError("unparseable")
+
+
+@pytest.fixture
+def pool():
+    pools = []
+
+    def build(**kwargs):
+        kwargs.setdefault("max_workers", 1)
+        pools.append(ExtractionProcessPool(**kwargs))
+        return pools[-1]
+
+    yield build
+    for built in pools:
+        built.shutdown(cancel_futures=True)
+
+
+def test_large_documents_are_extracted_in_a_worker(pool):
+    extraction_pool = pool(max_workers=2)
+    documents = [large_article(2000, f"Marker {i}") for i in range(3)]
+    assert len(documents[0]) > MB
+
+    futures = [extraction_pool.submit(extract_document, document) for document in documents]
+
+    for i, future in enumerate(futures):
+        text = future.result(timeout=60)
+        assert text.startswith(f"Marker {i}\n") and "Paragraph 1999 of the report" in text
+        assert "Copyright notice" not in text
+    assert extraction_pool.stats["workers_started"] == 2
+
+
+def test_the_bot_process_stays_responsive(pool):
+    extraction_pool = pool()
+    document = large_article(4000, "Marker")
+    ticks = []
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.is_set():
+            ticks.append(time.monotonic())
+            time.sleep(0.01)
+
+    extraction_pool.submit(worker_pid).result(timeout=30)
+    thread = threading.Thread(target=heartbeat)
+    thread.start()
+    try:
+        for _ in range(2):
+            extraction_pool.submit(extract_document, document).result(timeout=60)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.25
+
+
+def test_workers_are_recycled_after_max_jobs(pool):
+    extraction_pool = pool(max_jobs=2)
+
+    pids = [extraction_pool.submit(worker_pid).result(timeout=30) for _ in range(5)]
+
+    assert pids[0] == pids[1] != pids[2] == pids[3] != pids[4]
+    assert os.getpid() not in pids
+    assert extraction_pool.stats["recycled"] == 2
+
+
+def test_slow_jobs_are_killed_at_the_timeout(pool):
+    extraction_pool = pool(timeout=0.5)
+    first_pid = extraction_pool.submit(worker_pid).result(timeout=30)
+
+    started = time.monotonic()
+    with pytest.raises(ExtractionTimeout):
+        extraction_pool.submit(sleep_then, 30, "late").result(timeout=30)
+
+    assert time.monotonic() - started < 5
+    assert extraction_pool.submit(worker_pid).result(timeout=30) != first_pid
+    assert extraction_pool.stats["timeouts"] == 1
+
+
+@pytest.mark.skipif(process_rss(os.getpid()) is None, reason="needs /proc")
+def test_memory_hungry_jobs_are_killed(pool):
+    extraction_pool = pool(max_rss=64 * MB)
+
+    with pytest.raises(ExtractionMemoryError):
+        extraction_pool.submit(hog, 256, 30).result(timeout=30)
+
+    assert extraction_pool.submit(sleep_then, 0, "next").result(timeout=30) == "next"
+    assert extraction_pool.stats["memory_kills"] == 1
+
+
+@pytest.mark.skipif(process_rss(os.getpid()) is None, reason="needs /proc")
+def test_workers_that_grew_are_replaced_after_the_job(pool):
+    extraction_pool = pool(max_rss=64 * MB)
+    first_pid = extraction_pool.submit(worker_pid).result(timeout=30)
+
+    #-whether the pool notices while the job runs or only after it, the worker goes
+    try:
+        extraction_pool.submit(grow, 128).result(timeout=30)
+    except ExtractionMemoryError:
+        pass
+
+    assert extraction_pool.submit(worker_pid).result(timeout=30) != first_pid
+    stats = extraction_pool.stats
+    assert stats["memory_kills"] + stats["recycled"] == 1
+
+
+def test_running_jobs_can_be_cancelled(pool):
+    extraction_pool = pool()
+    future = extraction_pool.submit(sleep_then, 30, "late")
+    while not future.running():
+        time.sleep(0.01)
+
+    started = time.monotonic()
+    future.cancel()
+
+    with pytest.raises(ExtractionCancelled):
+        future.result(timeout=10)
+    assert time.monotonic() - started < 5
+
+
+def test_queued_jobs_are_cancelled_without_running(pool):
+    extraction_pool = pool()
+    running = extraction_pool.submit(sleep_then, 0.5, "first")
+    queued = extraction_pool.submit(worker_pid)
+
+    assert queued.cancel()
+    assert running.result(timeout=30) == "first"
+    assert extraction_pool.stats["jobs"] == 1
+
+
+def test_job_errors_reach_the_caller(pool):
+    extraction_pool = pool()
+
+    with pytest.raises(ValueError, match="unparseable"):
+        extraction_pool.submit(fail).result(timeout=30)
+    with pytest.raises((AttributeError, TypeError, pickle.PicklingError)):
+        extraction_pool.submit(lambda: None).result(timeout=30)
+
+    assert extraction_pool.submit(sleep_then, 0, "ok").result(timeout=30) == "ok"
+
+
+def test_fetcher_extracts_on_the_pool(stub_server, pool):
+    stub_server.routes["/article"] = {"body": large_article(1000, "Fetched")}
+    stub_server.routes["/stuck"] = {"body": b"<html><body><p>stuck</p></body></html>"}
+    extraction_pool = pool(max_workers=2)
+    fetcher = URLFetcher(ExtractionCache(MemoryCacheBackend()), extraction_executor=extraction_pool)
+
+    contents = fetcher.fetch_all([stub_server.url("/article")])
+
+    assert contents[stub_server.url("/article")].startswith("Fetched\nParagraph 0 of the report")
+    assert fetcher.cache.get(stub_server.url("/article")) is not None
+
+    fetcher.extract_func = stuck_extract
+    started = time.monotonic()
+    contents = fetcher.fetch_all([stub_server.url("/stuck")], deadline=0.5)
+
+    assert "timed out" in contents[stub_server.url("/stuck")]
+    assert time.monotonic() - started < 2
+    deadline = time.monotonic() + 5
+    while extraction_pool.stats["cancelled"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert extraction_pool.stats["cancelled"] == 1
+
+
+
+
+ENTRY_POINT = """
+import os
+import sys
+
+sys.path.insert(0, {repo!r})
+from extraction_pool import ExtractionProcessPool
+
+#-stands in for the App(token=...) and bot wiring of main_*.py
+with open({imports!r}, "a") as imports:
+    imports.write(f"{{os.getpid()}}\\n")
+
+if __name__ == "__main__":
+    pool = ExtractionProcessPool(max_workers=1, max_jobs=1)
+    pids = {{pool.submit(os.getpid).result(timeout=30) for _ in range(3)}}
+    pool.shutdown()
+    print(os.getpid(), len(pids))
+"""
+
+
+def test_workers_do_not_import_the_entry_point_again(tmp_path):
+    imports = tmp_path / "imports"
+    script = tmp_path / "main_entry.py"
+    script.write_text(ENTRY_POINT.format(repo=os.path.dirname(os.path.abspath(__file__)), imports=str(imports)))
+
+    env = {key: value for key, value in os.environ.items() if key != "URL_EXTRACTION_START_METHOD"}
+
+    result = subprocess.run([sys.executable, str(script)], capture_output=True, text=True, timeout=60, env=env)
+
+    assert result.returncode == 0, result.stderr
+    parent_pid, workers = result.stdout.split()
+    #-three workers were started (max_jobs=1) and the module ran once, in the parent
+    assert workers == "3"
+    assert imports.read_text().split() == [parent_pid]
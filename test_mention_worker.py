@@ -0,0 +1,174 @@
+import multiprocessing
+import time
+from types import SimpleNamespace
+
+from openai import OpenAI
+from slack_sdk import WebClient
+
+import slack_gpt_bot
+from benchmarks.fake_services import FakeOpenAI, FakeSlack
+from cache import MemoryCacheBackend, build_cache_backend
+from mention_worker import MentionWorker
+from slack_gpt_bot import SlackGPTBot
+from thread_state import ThreadLeases, build_thread_leases, build_thread_state_store
+from user_cache import UserProfileCache
+from work_queue import SQLiteWorkQueue, enqueue_mention, mention_job
+
+WORKERS = 3
+THREADS = 4
+MENTIONS_PER_THREAD = 3
+
+
+class RecordingBot:
+    def __init__(self, on_mention=None):
+        self.mentions = []
+        self.on_mention = on_mention
+
+    def handle_app_mentions(self, body, context):
+        self.mentions.append((body, context))
+        if self.on_mention is not None:
+            self.on_mention()
+
+
+def app_mention(n, thread_ts="1700000000.000100", ts=None):
+    return ({"event_id": f"Ev{n}", "event": {"type": "app_mention", "channel": "C1", "user": "U1",
+                                             "text": "<@UBOT> hi", "ts": ts or thread_ts, "thread_ts": thread_ts}},
+            {"bot_user_id": "UBOT", "user_id": "U1"})
+
+
+def build_worker(tmp_path, bot, clock, **kwargs):
+    queue = SQLiteWorkQueue(str(tmp_path / "queue.db"), time_func=clock)
+    leases = ThreadLeases(MemoryCacheBackend(time_func=clock), ttl=60)
+    return MentionWorker(bot, queue, leases, worker_id="w1", job_lease=60, **kwargs)
+
+
+def test_mention_of_a_busy_thread_waits_for_it(tmp_path, clock):
+    bot = RecordingBot()
+    worker = build_worker(tmp_path, bot, clock, busy_delay=1)
+    enqueue_mention(worker.queue, *app_mention(1))
+    worker.leases.acquire("C1", "1700000000.000100", "w2")
+
+    assert worker.run_once() == "deferred"
+    assert worker.run_once() is None
+    worker.leases.release("C1", "1700000000.000100", "w2")
+    clock.now += 1
+    assert worker.run_once() == "answered"
+
+    assert bot.mentions == [tuple(mention_job(*app_mention(1)).values())]
+    assert len(worker.queue) == 0
+    assert worker.leases.owner("C1", "1700000000.000100") is None
+    assert worker.stats == {"answered": 1, "deferred": 1, "dropped": 0, "lost_leases": 0, "active": 0}
+
+
+def test_leases_are_renewed_while_the_mention_is_answered(tmp_path, clock):
+    taken_over = []
+
+    def slow_answer():
+        for _ in range(3):
+            clock.now += 45
+            worker.heartbeat()
+            taken_over.append(worker.queue.get("w2") or worker.leases.acquire("C1", "1700000000.000100", "w2"))
+
+    worker = build_worker(tmp_path, RecordingBot(slow_answer), clock)
+    enqueue_mention(worker.queue, *app_mention(1))
+
+    assert worker.run_once() == "answered"
+    assert taken_over == [False] * 3
+    assert worker.stats["lost_leases"] == 0
+
+
+def test_mention_of_a_dead_worker_is_picked_up_and_eventually_dropped(tmp_path, clock):
+    bot = RecordingBot()
+    worker = build_worker(tmp_path, bot, clock, max_attempts=2)
+    enqueue_mention(worker.queue, *app_mention(1))
+    enqueue_mention(worker.queue, *app_mention(2, "1700000000.000200"))
+
+    worker.queue.get("dead", lease=10)
+    worker.queue.get("dead", lease=10)
+    clock.now += 11
+    assert worker.run_once() == "answered"
+    worker.queue.get("dead", lease=10)
+    clock.now += 11
+
+    assert worker.run_once() == "dropped"
+    assert len(worker.queue) == 0
+    assert [body["event_id"] for body, _ in bot.mentions] == ["Ev1"]
+
+
+def count_message_tokens(messages, model):
+    return [len(message["content"].split()) for message in messages]
+
+
+def run_worker(worker_id, slack_url, openai_url, db_path, stop, results):
+    '''
+    One worker process of the integration test below, sharing the queue,
+    thread state, user profiles and leases through one SQLite file.
+    '''
+    slack_gpt_bot.num_tokens_per_message = count_message_tokens
+    slack_gpt_bot.num_tokens_from_thread_state = (
+        lambda state, model: sum(message["tokens"] for message in state["messages"]))
+    shared = f"sqlite:///{db_path}"
+    bot = SlackGPTBot(SimpleNamespace(client=WebClient(token="xoxb-test", base_url=slack_url)),
+                      openai_client=OpenAI(api_key="test", base_url=openai_url, max_retries=0),
+                      thread_state_store=build_thread_state_store(shared),
+                      user_cache=UserProfileCache(build_cache_backend(shared, "users")))
+    worker = MentionWorker(bot, SQLiteWorkQueue(db_path), build_thread_leases(shared), worker_id=worker_id,
+                           concurrency=2, busy_delay=0.1, poll_interval=0.05).start()
+    stop.wait()
+    worker.stop()
+    results.put((worker_id, worker.stats))
+
+
+def test_workers_share_the_queue_and_take_turns_in_a_thread(tmp_path):
+    slack = FakeSlack(latency=0.01).start()
+    openai = FakeOpenAI(chunks=10, chunk_delay=0.01, first_token_delay=0.05).start()
+    db_path = str(tmp_path / "shared.db")
+    queue = SQLiteWorkQueue(db_path)
+    context = multiprocessing.get_context("spawn")
+    stop, results = context.Event(), context.Queue()
+    workers = [context.Process(target=run_worker, args=(f"w{i}", slack.base_url, openai.base_url, db_path,
+                                                        stop, results))
+               for i in range(WORKERS)]
+    try:
+        for process in workers:
+            process.start()
+        threads = []
+        for t in range(THREADS):
+            thread_ts = slack.add_thread("C1", [("U1", f"<@UBOT> question {t}.0")])
+            threads.append(thread_ts)
+            mentions = [thread_ts] + [slack.post("C1", thread_ts, "U1", f"<@UBOT> question {t}.{k}")["ts"]
+                                      for k in range(1, MENTIONS_PER_THREAD)]
+            for k, ts in enumerate(mentions):
+                body = {"event_id": f"Ev{t}.{k}", "event": {"type": "app_mention", "channel": "C1", "user": "U1",
+                                                              "text": f"<@UBOT> question {t}.{k}", "ts": ts,
+                                                              "thread_ts": thread_ts}}
+                enqueue_mention(queue, body, {"bot_user_id": "UBOT", "user_id": "U1"})
+
+        deadline = time.monotonic() + 120
+        while len(queue) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert len(queue) == 0
+        stop.set()
+        stats = dict(results.get(timeout=60) for _ in workers)
+        for process in workers:
+            process.join(30)
+    finally:
+        stop.set()
+        for process in workers:
+            if process.is_alive():
+                process.terminate()
+        slack.stop()
+        openai.stop()
+
+    assert sum(worker["answered"] for worker in stats.values()) == THREADS * MENTIONS_PER_THREAD
+    assert sum(1 for worker in stats.values() if worker["answered"]) > 1
+    assert len(openai.requests) == THREADS * MENTIONS_PER_THREAD
+    for thread_ts in threads:
+        replies = sorted((times[0], times[-1], slack.messages[key]["text"])
+                         for key, times in slack.message_times.items()
+                         if slack.messages[key]["thread_ts"] == thread_ts)
+        assert len(replies) == MENTIONS_PER_THREAD
+        assert all(text.startswith("token token") for _, _, text in replies)
+        #-each reply was finished before the next one in the thread was posted
+        for (_, finished, _), (posted, _, _) in zip(replies, replies[1:]):
+            assert finished <= posted
@@ -0,0 +1,118 @@
+import asyncio
+import os
+import signal
+import threading
+import time
+
+import pytest
+from prometheus_client import REGISTRY
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+
+from admission import AdmissionController
+from benchmarks.fake_services import FakeSlack
+from metrics import instrument_slack_client, metrics_response, observe_timings
+from profiler import SamplingProfiler, install_profiler_signal, thread_group
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.fixture
+def fake_slack():
+    slack = FakeSlack(latency=0.01, rate_limit_every=3).start()
+    yield slack
+    slack.stop()
+
+
+def test_slack_calls_are_timed_per_method(fake_slack):
+    client = instrument_slack_client(WebClient(token="xoxb-test", base_url=fake_slack.base_url))
+    instrument_slack_client(client)
+    before_ok = sample("slack_gpt_bot_slack_api_seconds_count", method="chat.update", outcome="ok")
+    before_limited = sample("slack_gpt_bot_slack_api_seconds_count", method="chat.update", outcome="ratelimited")
+
+    ts = client.chat_postMessage(channel="C1", text="hi")["ts"]
+    client.chat_update(channel="C1", ts=ts, text="hi there")
+    client.chat_update(channel="C1", ts=ts, text="hi there!")
+    with pytest.raises(SlackApiError):
+        client.chat_update(channel="C1", ts=ts, text="hi there!!")
+
+    assert sample("slack_gpt_bot_slack_api_seconds_count", method="chat.update", outcome="ok") - before_ok == 2
+    assert sample("slack_gpt_bot_slack_api_seconds_count", method="chat.update", outcome="ratelimited") \
+        - before_limited == 1
+    assert sample("slack_gpt_bot_slack_api_seconds_sum", method="chat.postMessage", outcome="ok") >= 0.01
+
+
+def test_async_slack_calls_are_timed(fake_slack):
+    client = instrument_slack_client(AsyncWebClient(token="xoxb-test", base_url=fake_slack.base_url))
+    before = sample("slack_gpt_bot_slack_api_seconds_count", method="users.info", outcome="ok")
+
+    response = asyncio.run(client.users_info(user="U1"))
+
+    assert response["user"]["id"] == "U1"
+    assert sample("slack_gpt_bot_slack_api_seconds_count", method="users.info", outcome="ok") - before == 1
+
+
+def test_metrics_are_exported_in_the_text_format():
+    observe_timings({"openai_request": 250.0, "total": 1200.0})
+
+    body, content_type = metrics_response()
+    text = body.decode()
+    assert content_type.startswith("text/plain")
+    assert 'slack_gpt_bot_stage_seconds_bucket{le="0.25",stage="openai_request"}' in text
+    assert 'slack_gpt_bot_chat_updates_total{event="updates_coalesced"}' in text
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_admission_gauges(clock):
+    names = ("slack_gpt_bot_admission_queue_depth", "slack_gpt_bot_admission_in_flight",
+             "slack_gpt_bot_tokens_last_minute", "slack_gpt_bot_tokens_per_minute_budget")
+    before = [sample(name) for name in names]
+    admission = AdmissionController(max_in_flight=1, tokens_per_minute=1000, time_func=clock)
+
+    running = admission.admit(admission.enqueue("U1", "C1"), 300)
+    admission.enqueue("U2", "C1")
+    assert [sample(name) - value for name, value in zip(names, before)] == [1, 1, 300, 1000]
+
+    admission.finish(running)
+    clock.now += 61
+    assert [sample(name) - value for name, value in zip(names, before)] == [1, 0, 0, 1000]
+
+
+def test_sampling_profiler_writes_folded_stacks(tmp_path):
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_loop, args=(stop,), name="mention_7")
+    worker.start()
+    try:
+        path = SamplingProfiler(interval=0.005, duration=0.2, directory=str(tmp_path)).run()
+    finally:
+        stop.set()
+        worker.join()
+
+    lines = open(path).read().splitlines()
+    busy = [line for line in lines if line.startswith("mention;") and "busy_loop (test_metrics.py" in line]
+    assert busy and int(busy[0].rsplit(" ", 1)[1]) > 5
+    assert thread_group("url-fetch_12") == "url-fetch" and thread_group("Thread-3 (run)") == "Thread"
+
+
+def test_signal_starts_a_profile(tmp_path):
+    profiler = install_profiler_signal("SIGUSR2", SamplingProfiler(interval=0.01, duration=0.1,
+                                                                   directory=str(tmp_path)))
+    previous = signal.getsignal(signal.SIGUSR2)
+    try:
+        os.kill(os.getpid(), signal.SIGUSR2)
+        deadline = time.monotonic() + 5
+        while not list(tmp_path.iterdir()) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert [p.suffix for p in tmp_path.iterdir()] == [".folded"]
+        assert profiler.samples > 0
+    finally:
+        signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+    assert previous is not signal.SIG_DFL
+    assert install_profiler_signal("") is None
@@ -0,0 +1,160 @@
+import asyncio
+import re
+import threading
+
+from cache import MemoryCacheBackend, SQLiteCacheBackend
+from response_cache import CachedResponse, ResponseCache, VectorIndex
+
+SYSTEM = {"role": "system", "content": "You are an AI assistant."}
+WORDS = ["how", "do", "i", "request", "a", "laptop", "vpn", "set", "up", "the", "get", "new"]
+
+
+def ask(question, *earlier):
+    return [SYSTEM, *earlier, {"role": "user", "content": question}]
+
+
+def bag_of_words(text):
+    words = re.findall(r"\w+", text.lower())
+    return [float(words.count(word)) for word in WORDS]
+
+
+def replay(cache_lookup):
+    return "".join(chunk.choices[0].delta.content or "" for chunk in cache_lookup.replay())
+
+
+def test_exact_hits_ignore_whitespace_and_case():
+    cache = ResponseCache(MemoryCacheBackend())
+    lookup = cache.lookup("C1", "gpt-4o", ask("How do I set up the VPN?"))
+    assert lookup.hit is None
+    cache.store(lookup, "Install the client.", "gpt-4o")
+
+    hit = cache.lookup("C2", "gpt-4o", ask("  how do i set up   the vpn?\n"))
+    assert hit.hit == "exact" and replay(hit) == "Install the client."
+    assert cache.lookup("C2", "gpt-4o-mini", ask("How do I set up the VPN?")).hit is None
+    assert cache.lookup("C2", "gpt-4o", ask("How do I set up the VPN?", {"role": "user", "content": "hi"})).hit is None
+    stats = cache.stats
+    assert (stats["exact_hits"], stats["misses"], stats["stored"], stats["entries"]) == (1, 3, 1, 1)
+
+
+def test_entries_expire_and_are_evicted(clock):
+    cache = ResponseCache(MemoryCacheBackend(max_entries=2, time_func=clock), ttl=60)
+    for question in ("one", "two", "three"):
+        cache.store(cache.lookup("C1", "gpt-4o", ask(question)), f"answer {question}", "gpt-4o")
+
+    assert cache.lookup("C1", "gpt-4o", ask("one")).hit is None
+    assert cache.lookup("C1", "gpt-4o", ask("three")).hit == "exact"
+    clock.now += 61
+    assert cache.lookup("C1", "gpt-4o", ask("three")).hit is None
+
+
+def test_answers_survive_a_restart_on_disk(tmp_path):
+    path = str(tmp_path / "responses.db")
+    cache = ResponseCache(SQLiteCacheBackend(path, table="responses"))
+    cache.store(cache.lookup("C1", "gpt-4o", ask("How do I get a laptop?")), "Ask IT.", "gpt-4o")
+    cache.backend.close()
+
+    restarted = ResponseCache(SQLiteCacheBackend(path, table="responses"))
+    assert replay(restarted.lookup("C1", "gpt-4o", ask("how do I get a laptop?"))) == "Ask IT."
+
+
+def test_excluded_channels_neither_read_nor_store():
+    cache = ResponseCache(MemoryCacheBackend(), excluded_channels="C2, C3")
+    assert cache.lookup("C2", "gpt-4o", ask("How do I get a laptop?")) is None
+    cache.store(None, "Ask IT.", "gpt-4o")
+
+    cache.store(cache.lookup("C1", "gpt-4o", ask("How do I get a laptop?")), "Ask IT.", "gpt-4o")
+    assert cache.lookup("C3", "gpt-4o", ask("How do I get a laptop?")) is None
+    assert cache.stats["excluded"] == 2 and len(cache.backend) == 1
+
+
+def test_similar_questions_hit_after_the_same_context():
+    embedded = []
+
+    def embed(text):
+        embedded.append(text)
+        return bag_of_words(text)
+
+    cache = ResponseCache(MemoryCacheBackend(), similarity=0.9, embed_func=embed)
+    cache.store(cache.lookup("C1", "gpt-4o", ask("How do I set up the VPN?")), "Install the client.", "gpt-4o")
+
+    hit = cache.lookup("C1", "gpt-4o", ask("how do I set up VPN"))
+    assert hit.hit == "similar" and hit.similarity >= 0.9 and replay(hit) == "Install the client."
+    assert cache.lookup("C1", "gpt-4o", ask("How do I request a laptop?")).hit is None
+    #-the same question after a different conversation is not reused
+    earlier = {"role": "user", "content": "I am on a Mac"}
+    assert cache.lookup("C1", "gpt-4o", ask("How do I set up the VPN", earlier)).hit is None
+    assert embedded[0] == "how do i set up the vpn?"
+
+
+def test_similarity_tier_survives_embedding_failures():
+    def embed(text):
+        raise RuntimeError("embeddings unavailable")
+
+    cache = ResponseCache(MemoryCacheBackend(), similarity=0.9, embed_func=embed)
+    lookup = cache.lookup("C1", "gpt-4o", ask("How do I set up the VPN?"))
+    cache.store(lookup, "Install the client.", "gpt-4o")
+
+    assert lookup.hit is None and cache.stats["embedding_errors"] == 1
+    assert cache.lookup("C1", "gpt-4o", ask("How do I set up the VPN?")).hit == "exact"
+
+
+def test_async_lookup_and_replay():
+    async def embed(text):
+        return bag_of_words(text)
+
+    cache = ResponseCache(MemoryCacheBackend(), similarity=0.9, embed_func=embed)
+
+    async def run():
+        cache.store(await cache.lookup_async("C1", "gpt-4o", ask("How do I set up the VPN?")), "x" * 1000, "gpt-4o")
+        hit = await cache.lookup_async("C1", "gpt-4o", ask("how do I set up VPN"))
+        return [chunk async for chunk in hit.replay()]
+
+    chunks = asyncio.run(run())
+    assert "".join(chunk.choices[0].delta.content or "" for chunk in chunks) == "x" * 1000
+    assert chunks[-1].choices[0].finish_reason == "stop"
+
+
+
+class ThreadRecordingBackend(MemoryCacheBackend):
+    def __init__(self):
+        super().__init__()
+        self.get_threads = []
+
+    def get(self, key):
+        self.get_threads.append(threading.get_ident())
+        return super().get(key)
+
+
+def test_async_lookup_reads_the_backend_off_the_event_loop():
+    embed_threads = []
+
+    async def embed(text):
+        embed_threads.append(threading.get_ident())
+        return bag_of_words(text)
+
+    backend = ThreadRecordingBackend()
+    cache = ResponseCache(backend, similarity=0.9, embed_func=embed)
+
+    async def run():
+        cache.store(await cache.lookup_async("C1", "gpt-4o", ask("How do I set up the VPN?")), "answer", "gpt-4o")
+        return await cache.lookup_async("C1", "gpt-4o", ask("how do I set up VPN"))
+
+    assert asyncio.run(run()).hit == "similar"
+    loop_thread = threading.get_ident()
+    #-exact miss, exact miss and the similar hit's read, none on the loop
+    assert len(backend.get_threads) == 3 and loop_thread not in backend.get_threads
+    assert embed_threads == [loop_thread, loop_thread]
+
+def test_vector_index_keeps_the_latest_vectors():
+    index = VectorIndex(max_vectors=2)
+    index.add("a", "g", [1.0, 0.0])
+    index.add("b", "g", [0.0, 1.0])
+    index.add("c", "h", [1.0, 0.0])
+
+    assert len(index) == 2
+    #-"a" was dropped, the closest one left is "b"
+    assert index.search("g", [1.0, 0.1])[0] == "b"
+    key, similarity = index.search("h", [2.0, 0.0])
+    assert key == "c" and abs(similarity - 1.0) < 1e-9
+    assert index.search("x", [1.0, 0.0]) == (None, 0.0)
+    assert list(CachedResponse("", "gpt-4o"))[-1].choices[0].finish_reason == "stop"
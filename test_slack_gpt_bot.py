@@ -0,0 +1,249 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import slack_gpt_bot
+from admission import AdmissionController
+from cache import MemoryCacheBackend
+from completion_router import CompletionRouter, ModelRoute
+from response_cache import ResponseCache
+from slack_gpt_bot import SlackGPTBot
+from slack_updater import ChatUpdateCoalescer, UpdateMetrics
+from thread_state import ThreadStateStore, ts_key
+
+SLACK_LATENCY = 0.2
+
+
+class SlowSlackClient:
+    '''
+    users.info, chat.postMessage, chat.update and conversations.replies,
+    each taking SLACK_LATENCY seconds.
+    '''
+    def __init__(self, thread):
+        self.thread = thread
+        self.lock = threading.Lock()
+        self.posted = []
+        self.updates = []
+        self.replies_oldest = []
+        self.ts_counter = len(thread)
+
+    def next_ts(self):
+        with self.lock:
+            self.ts_counter += 1
+            return f"1700000000.{self.ts_counter:06d}"
+
+    def users_info(self, user):
+        time.sleep(SLACK_LATENCY)
+        return {"user": {"name": "jdoe", "profile": {"first_name": "Jane", "email": "jdoe@example.com"}}}
+
+    def chat_postMessage(self, channel, thread_ts, text):
+        time.sleep(SLACK_LATENCY)
+        ts = self.next_ts()
+        with self.lock:
+            self.posted.append(text)
+            self.thread.append({"ts": ts, "user": "BOT", "text": text})
+        return {"message": {"ts": ts}}
+
+    def chat_update(self, channel, ts, text):
+        with self.lock:
+            self.updates.append(text)
+            for message in self.thread:
+                if message["ts"] == ts:
+                    message["text"] = text
+
+    def conversations_replies(self, channel, ts, limit, inclusive, oldest=None, cursor=None):
+        self.replies_oldest.append(oldest)
+        time.sleep(SLACK_LATENCY)
+        with self.lock:
+            replies = [m for m in self.thread if oldest is None or ts_key(m["ts"]) > ts_key(oldest)]
+        return {"messages": replies, "response_metadata": {"next_cursor": ""}}
+
+
+class FakeOpenAI:
+    def __init__(self, pieces, finish_reason="stop"):
+        self.pieces = pieces
+        self.finish_reason = finish_reason
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece), finish_reason=None)])
+                  for piece in self.pieces]
+        chunks.append(SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=None), finish_reason=self.finish_reason)]))
+        return iter(chunks)
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    monkeypatch.setattr(slack_gpt_bot, "num_tokens_per_message",
+                        lambda messages, model: [len(m["content"]) for m in messages])
+    monkeypatch.setattr(slack_gpt_bot, "num_tokens_from_thread_state",
+                        lambda state, model: sum(m["tokens"] for m in state["messages"]))
+    thread = [{"ts": "1700000000.000000", "user": "U1", "text": "<@BOT> why is the sky blue?"}]
+    bot = SlackGPTBot(SimpleNamespace(client=SlowSlackClient(thread)),
+                      thread_state_store=ThreadStateStore(MemoryCacheBackend()),
+                      openai_client=FakeOpenAI(["Rayleigh ", "scattering."]))
+    bot.build_chat_updater = lambda writer: ChatUpdateCoalescer(writer, min_interval=0.0, metrics=UpdateMetrics())
+    bot.logs = []
+    bot.logging_wrapper = lambda message, severity=None, **kwargs: bot.logs.append((message, kwargs))
+    return bot
+
+
+def mention(ts="1700000000.000000", thread_ts=None):
+    return ({"event": {"channel": "C1", "ts": ts, "thread_ts": thread_ts or ts}},
+            {"bot_user_id": "BOT", "user_id": "U1"})
+
+
+def test_wait_message_is_posted_while_the_thread_is_read(bot):
+    started = time.monotonic()
+    bot.handle_app_mentions(*mention())
+    elapsed = time.monotonic() - started
+
+    #-users.info + chat.postMessage run next to conversations.replies, not after them
+    assert elapsed < 3 * SLACK_LATENCY
+    assert bot.app.client.posted == ["Hi Jane! I got your request, please wait while I ask the wizard..."]
+    assert bot.app.client.updates[-1] == "Rayleigh scattering."
+    assert bot.openai_client.requests[0]["messages"][-1] == {"role": "user", "content": "why is the sky blue?"}
+
+    (_, logged), = [(message, kwargs) for message, kwargs in bot.logs if message == "RequestResponse"]
+    timings = logged["timings_ms"]
+    for stage in ("users_info", "wait_message", "conversation_history", "thread_processing",
+                  "context_packing", "openai_request", "first_token", "total"):
+        assert stage in timings
+    assert logged["email"] == "jdoe@example.com"
+
+
+def test_wait_message_is_left_for_the_next_turn(bot):
+    bot.handle_app_mentions(*mention())
+    ts = bot.app.client.next_ts()
+    bot.app.client.thread.append({"ts": ts, "user": "U1", "text": "<@BOT> and at sunset?"})
+
+    bot.handle_app_mentions(*mention(ts))
+
+    contents = [m["content"] for m in bot.openai_client.requests[-1]["messages"][1:]]
+    assert contents == ["why is the sky blue?", "Rayleigh scattering.", "and at sunset?"]
+
+
+def test_follow_up_during_streaming_keeps_the_final_answer(bot):
+    root = bot.app.client.thread[0]["ts"]
+    streaming, release = threading.Event(), threading.Event()
+    create = bot.openai_client.create
+
+    def slow_first_answer(**kwargs):
+        chunks = list(create(**kwargs))
+        if len(bot.openai_client.requests) > 1:
+            return iter(chunks)
+
+        def stream():
+            yield chunks[0]
+            streaming.set()
+            release.wait(5)
+            yield from chunks[1:]
+        return stream()
+
+    bot.openai_client.chat.completions.create = slow_first_answer
+    first = threading.Thread(target=bot.handle_app_mentions, args=mention(root))
+    first.start()
+    assert streaming.wait(5)
+    while not bot.app.client.updates:
+        time.sleep(0.01)
+    ts = bot.app.client.next_ts()
+    bot.app.client.thread.append({"ts": ts, "user": "U1", "text": "<@BOT> and at sunset?"})
+    bot.handle_app_mentions(*mention(ts, root))
+    release.set()
+    first.join()
+    ts = bot.app.client.next_ts()
+    bot.app.client.thread.append({"ts": ts, "user": "U1", "text": "<@BOT> and at night?"})
+
+    bot.handle_app_mentions(*mention(ts, root))
+
+    #-the follow-up saw the first answer unfinished, the state was not left with it
+    assert bot.openai_client.requests[1]["messages"][-1]["content"] == "and at sunset?"
+    contents = [m["content"] for m in bot.openai_client.requests[-1]["messages"][1:]]
+    assert contents == ["why is the sky blue?", "Rayleigh scattering.", "and at sunset?", "Rayleigh scattering.",
+                        "and at night?"]
+
+
+def test_failed_user_lookup_is_reported(bot):
+    def users_info(user):
+        raise RuntimeError("user_not_found")
+
+    bot.app.client.users_info = users_info
+    bot.handle_app_mentions(*mention())
+
+    assert "user_not_found" in bot.app.client.posted[-1]
+    assert [message for message, _ in bot.logs if message == "Exception"] == ["Exception"]
+
+
+def test_mentions_of_one_thread_read_it_once(bot):
+    root = bot.app.client.thread[0]["ts"]
+    ts = bot.app.client.next_ts()
+    bot.app.client.thread.append({"ts": ts, "user": "U1", "text": "<@BOT> and at sunset?"})
+
+    first = threading.Thread(target=bot.handle_app_mentions, args=mention(root))
+    first.start()
+    time.sleep(SLACK_LATENCY / 4)
+    bot.handle_app_mentions(*mention(ts, root))
+    first.join()
+
+    #-the second mention waited for the first and only read what came after it
+    assert bot.app.client.replies_oldest == [None, root]
+    assert bot.thread_locks.waits == 1
+    assert [r["messages"][-1]["content"] for r in bot.openai_client.requests] == ["why is the sky blue?",
+                                                                                  "and at sunset?"]
+
+
+def test_queued_mentions_show_their_position(bot):
+    bot.admission = AdmissionController(max_in_flight=1, max_queue=1)
+    bot.app.client.thread.append({"ts": "1700000000.000001", "user": "U1", "text": "<@BOT> and the sea?"})
+
+    first = threading.Thread(target=bot.handle_app_mentions, args=mention())
+    first.start()
+    time.sleep(SLACK_LATENCY / 4)
+    second = threading.Thread(target=bot.handle_app_mentions, args=mention("1700000000.000001"))
+    second.start()
+    time.sleep(SLACK_LATENCY / 4)
+    bot.handle_app_mentions(*mention("1700000000.000002"))
+    first.join()
+    second.join()
+
+    assert sorted(bot.app.client.posted) == [
+        "Hi Jane! I got your request, please wait while I ask the wizard...",
+        "Hi Jane! I got your request, you are number 1 in the queue, please wait while I ask the wizard...",
+        slack_gpt_bot.BUSY_MESSAGE,
+    ]
+    stats = bot.admission.stats
+    assert (stats["admitted"], stats["rejected"], stats["in_flight"]) == (2, 1, 0)
+
+
+def test_repeated_questions_are_answered_from_the_response_cache(bot):
+    bot.response_cache = ResponseCache(MemoryCacheBackend())
+    bot.handle_app_mentions(*mention())
+
+    #-the same question in another thread, spaced and cased differently
+    thread = [{"ts": "1699999999.000000", "user": "U2", "text": "<@BOT> Why is the  sky blue?"}]
+    bot.app = SimpleNamespace(client=SlowSlackClient(thread))
+    bot.handle_app_mentions(*mention("1699999999.000000"))
+
+    assert len(bot.openai_client.requests) == 1
+    assert bot.app.client.updates[-1] == "Rayleigh scattering."
+    responses = [kwargs for message, kwargs in bot.logs if message == "RequestResponse"]
+    assert [logged["response_cache"] for logged in responses] == [None, "exact"]
+    assert "openai_request" not in responses[-1]["timings_ms"]
+
+
+@pytest.mark.parametrize("answered_by", ["fallback", "length"])
+def test_fallback_and_truncated_answers_are_not_cached(bot, answered_by):
+    bot.response_cache = ResponseCache(MemoryCacheBackend())
+    if answered_by == "fallback":
+        bot.completion_router = CompletionRouter(bot.openai_client, [ModelRoute("gpt-4o-mini", 128000)])
+    else:
+        bot.openai_client.finish_reason = "length"
+
+    bot.handle_app_mentions(*mention())
+
+    assert bot.app.client.updates[-1] == "Rayleigh scattering."
+    assert bot.response_cache.stats["stored"] == bot.response_cache.stats["entries"] == 0
@@ -0,0 +1,102 @@
+import random
+import re
+import time
+
+import pytest
+
+from slack_links import SlackLink, extract_urls, tokenize_links, unescape
+
+#-what a link is, stated as a regex: <, anything but < and >, then >
+REFERENCE_PATTERN = re.compile(r"<([^<>]*)>")
+FUZZ_ALPHABET = ["<", ">", "|", "@", "#", "!", "&amp;", "&lt;", "&gt;", " ", "\n", "a", "Z", "0", "/", ":", ".",
+                 "http://", "https://", "mailto:", "U123", "%20"]
+
+
+def fuzz_texts(count, seed=1234):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield "".join(rng.choice(FUZZ_ALPHABET) for _ in range(rng.randint(0, 60)))
+
+
+def test_all_kinds_of_markup():
+    text = ("hi <@U123> and <@U456|jdoe>, see <#C789|general> <!here> <!subteam^S1|@team> "
+            "<https://example.com/a?b=1&amp;c=2> <https://example.com/doc|the doc> <mailto:a@b.c|mail>")
+
+    links = list(tokenize_links(text))
+
+    assert [(link.kind, link.target, link.label) for link in links] == [
+        ("user", "U123", None),
+        ("user", "U456", "jdoe"),
+        ("channel", "C789", "general"),
+        ("special", "here", None),
+        ("special", "subteam^S1", "@team"),
+        ("url", "https://example.com/a?b=1&c=2", None),
+        ("url", "https://example.com/doc", "the doc"),
+        ("link", "mailto:a@b.c", "mail"),
+    ]
+    for link in links:
+        assert text[link.start] == "<" and text[link.end - 1] == ">"
+
+
+def test_unbalanced_brackets():
+    assert list(tokenize_links("a <<https://x.io> b")) == [SlackLink("url", "https://x.io", None, 3, 17)]
+    assert list(tokenize_links("<https://x.io")) == []
+    assert list(tokenize_links("> <https://x.io>")) == [SlackLink("url", "https://x.io", None, 2, 16)]
+    assert list(tokenize_links("<not a link>")) == []
+
+
+def test_extract_urls_dedupes_and_keeps_order():
+    text = "<https://b.io> <https://a.io|a> <https://b.io|again> <HTTPS://C.IO>"
+    assert extract_urls(text) == ["https://b.io", "https://a.io", "HTTPS://C.IO"]
+
+
+def test_fuzz_matches_the_reference_grammar():
+    for text in fuzz_texts(5000):
+        links = list(tokenize_links(text))
+        expected = []
+        for match in REFERENCE_PATTERN.finditer(text):
+            target = match.group(1).partition("|")[0]
+            if target.startswith(("@", "#", "!")) or (target and not re.search(r"\s", target)):
+                expected.append(match)
+
+        assert [(link.start, link.end) for link in links] == [m.span() for m in expected], text
+        for link, match in zip(links, expected):
+            if link.kind in ("url", "link"):
+                assert link.target == unescape(match.group(1).partition("|")[0])
+        #-links never overlap and come in order
+        assert all(a.end <= b.start for a, b in zip(links, links[1:]))
+
+
+def test_fuzz_urls_are_linked_http_targets():
+    for text in fuzz_texts(5000, seed=99):
+        for url in extract_urls(text):
+            assert url.lower().startswith(("http://", "https://"))
+            escaped = url.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+            assert "<" + escaped in text
+
+
+ADVERSARIAL = {
+    "long_labelled_link": lambda n: "<https://" + "A" * n + "|label",
+    "only_opens": lambda n: "<" * n + ">",
+    "only_closes": lambda n: ">" * n,
+    "alternating": lambda n: "<>" * (n // 2),
+    "open_then_text": lambda n: "<" + "a|" * (n // 2),
+    "many_links": lambda n: "<https://x.io/a|b> " * (n // 19),
+}
+
+
+@pytest.mark.parametrize("name", sorted(ADVERSARIAL))
+def test_adversarial_inputs_take_linear_time(name):
+    make = ADVERSARIAL[name]
+
+    def run(n):
+        text = make(n)
+        started = time.perf_counter()
+        list(tokenize_links(text))
+        return time.perf_counter() - started
+
+    small, large = run(100000), run(800000)
+
+    assert large < 1.0
+    #-8x the input, allow generous noise but nothing like quadratic (64x)
+    assert large < 25 * small + 0.05
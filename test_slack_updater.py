@@ -0,0 +1,281 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from slack_updater import (AsyncChatUpdateCoalescer, AsyncSplitMessageWriter,
+                           ChatUpdateCoalescer, SplitMessageWriter,
+                           UpdateMetrics, rate_limit_delay, split_point)
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__("ratelimited")
+        self.response = SimpleNamespace(status_code=429, headers={"Retry-After": str(retry_after)})
+
+
+class FakeSlackUpdates:
+    '''
+    chat.update stand-in taking latency seconds per call; the calls listed
+    in rate_limited (1-based) fail with a 429.
+    '''
+    def __init__(self, latency=0.0, rate_limited=(), retry_after=0.1):
+        self.latency = latency
+        self.rate_limited = set(rate_limited)
+        self.retry_after = retry_after
+        self.calls = []
+        self.delivered = []
+        self.lock = threading.Lock()
+
+    def __call__(self, text):
+        with self.lock:
+            self.calls.append((time.monotonic(), text))
+            call = len(self.calls)
+        time.sleep(self.latency)
+        if call in self.rate_limited:
+            raise RateLimited(self.retry_after)
+        with self.lock:
+            self.delivered.append(text)
+
+    async def async_update(self, text):
+        self.calls.append((time.monotonic(), text))
+        call = len(self.calls)
+        await asyncio.sleep(self.latency)
+        if call in self.rate_limited:
+            raise RateLimited(self.retry_after)
+        self.delivered.append(text)
+
+
+def stream(updater, chunks, delay):
+    text = ""
+    for i in range(chunks):
+        text += f"{i} "
+        updater.submit(text)
+        time.sleep(delay)
+    return text
+
+
+def test_updates_are_spaced_by_the_min_interval():
+    slack = FakeSlackUpdates(latency=0.01)
+    updater = ChatUpdateCoalescer(slack, min_interval=0.1, metrics=UpdateMetrics())
+
+    text = stream(updater, 50, 0.01)
+    updater.finish(text)
+
+    times = [at for at, _ in slack.calls]
+    assert all(b - a >= 0.095 for a, b in zip(times, times[1:]))
+    assert len(slack.calls) <= 8
+    assert slack.delivered[-1] == text
+    stats = updater.stats
+    assert stats["updates_sent"] == len(slack.delivered)
+    assert stats["updates_sent"] + stats["updates_coalesced"] == 51
+
+
+def test_text_submitted_during_a_slow_update_is_merged():
+    slack = FakeSlackUpdates(latency=0.3)
+    updater = ChatUpdateCoalescer(slack, min_interval=0.0, metrics=UpdateMetrics())
+
+    text = stream(updater, 20, 0.01)
+    updater.finish(text)
+
+    #-the first update was in flight the whole stream, everything after it is one update
+    assert slack.delivered == ["0 ", text]
+
+
+def test_rate_limit_backs_off_for_retry_after():
+    slack = FakeSlackUpdates(rate_limited=[1], retry_after=0.3)
+    metrics = UpdateMetrics()
+    updater = ChatUpdateCoalescer(slack, min_interval=0.0, metrics=metrics)
+
+    updater.submit("partial")
+    time.sleep(0.05)
+    updater.submit("partial answer")
+    updater.finish("partial answer, done")
+
+    (limited_at, _), (retried_at, retried_text) = slack.calls
+    assert retried_at - limited_at >= 0.29
+    assert retried_text == "partial answer, done"
+    assert slack.delivered == ["partial answer, done"]
+    assert metrics.snapshot()["rate_limited"] == 1
+
+
+def test_final_text_is_retried_until_delivered_once():
+    slack = FakeSlackUpdates(rate_limited=[2, 3], retry_after=0.05)
+    updater = ChatUpdateCoalescer(slack, min_interval=0.0, metrics=UpdateMetrics())
+
+    updater.submit("draft")
+    time.sleep(0.05)
+    updater.finish("final")
+    updater.submit("late text is ignored")
+    time.sleep(0.1)
+
+    assert slack.delivered == ["draft", "final"]
+    assert updater.stats["rate_limited"] == 2
+
+
+def test_final_delivery_failure_is_raised():
+    slack = FakeSlackUpdates(rate_limited=range(1, 100), retry_after=0.0)
+    updater = ChatUpdateCoalescer(slack, min_interval=0.0, metrics=UpdateMetrics())
+
+    with pytest.raises(RateLimited):
+        updater.finish("final")
+
+
+def test_close_drops_pending_text():
+    slack = FakeSlackUpdates(latency=0.1)
+    updater = ChatUpdateCoalescer(slack, min_interval=0.0, metrics=UpdateMetrics())
+
+    updater.submit("one")
+    time.sleep(0.02)
+    updater.submit("two")
+    updater.close()
+    time.sleep(0.2)
+
+    assert slack.delivered == ["one"]
+
+
+def test_rate_limit_delay():
+    assert rate_limit_delay(RateLimited(7)) == 7
+    assert rate_limit_delay(ValueError("boom")) is None
+
+
+def test_async_coalescer_spaces_updates_and_delivers_final():
+    slack = FakeSlackUpdates(latency=0.01, rate_limited=[2], retry_after=0.1)
+
+    async def run():
+        updater = AsyncChatUpdateCoalescer(slack.async_update, min_interval=0.05, metrics=UpdateMetrics())
+        text = ""
+        for i in range(40):
+            text += f"{i} "
+            updater.submit(text)
+            await asyncio.sleep(0.005)
+        await updater.finish(text)
+        return updater, text
+
+    updater, text = asyncio.run(run())
+
+    times = [at for at, _ in slack.calls]
+    assert all(b - a >= 0.045 for a, b in zip(times, times[1:]))
+    assert slack.delivered[-1] == text
+    assert updater.stats["rate_limited"] == 1
+
+
+class FakeSlackThread:
+    def __init__(self, fail_posts=0):
+        self.messages = {"1.0": "Please wait..."}
+        self.order = ["1.0"]
+        self.update_sizes = []
+        self.fail_posts = fail_posts
+
+    def update(self, ts, text):
+        self.update_sizes.append(len(text))
+        self.messages[ts] = text
+
+    def post(self, text):
+        if self.fail_posts:
+            self.fail_posts -= 1
+            raise RateLimited(0)
+        ts = f"{len(self.order) + 1}.0"
+        self.order.append(ts)
+        self.messages[ts] = text
+        return ts
+
+    def texts(self):
+        return [self.messages[ts] for ts in self.order]
+
+
+def paragraphs(count):
+    return "".join(f"Paragraph {i}: " + "lorem ipsum " * 8 + "\n\n" for i in range(count))
+
+
+def stream_into(writer, text, step=7):
+    for end in range(step, len(text), step):
+        writer(text[:end])
+    writer(text)
+
+
+def test_split_point_prefers_paragraphs_then_lines_then_spaces():
+    assert split_point("short", 100) == 5
+    assert split_point("a" * 60 + "\n\n" + "b" * 60 + "\nccc", 100) == 62
+    assert split_point("a" * 70 + "\n" + "b" * 60, 100) == 71
+    assert split_point("a" * 70 + " " + "b" * 60, 100) == 71
+    assert split_point("a" * 200, 100) == 100
+
+
+def test_long_answer_rolls_over_into_new_replies():
+    slack = FakeSlackThread()
+    writer = SplitMessageWriter(slack.update, slack.post, "1.0", max_chars=300)
+    text = paragraphs(12)
+
+    stream_into(writer, text)
+
+    texts = slack.texts()
+    assert len(texts) > 3 and writer.message_ts == slack.order
+    assert all(len(t) <= 300 for t in texts)
+    assert max(slack.update_sizes) <= 300
+    assert all(t.startswith("Paragraph") and t.endswith("lorem ipsum") for t in texts[:-1])
+    assert "\n\n".join(texts).split() == text.split()
+
+
+def test_short_answer_stays_in_one_message():
+    slack = FakeSlackThread()
+    writer = SplitMessageWriter(slack.update, slack.post, "1.0", max_chars=300)
+
+    stream_into(writer, "A short answer.")
+
+    assert slack.texts() == ["A short answer."]
+
+
+def test_code_block_cut_in_two_is_closed_and_reopened():
+    slack = FakeSlackThread()
+    writer = SplitMessageWriter(slack.update, slack.post, "1.0", max_chars=200)
+    code = "".join(f"print({i})\n" for i in range(40))
+    text = "Here you go:\n\n```python\n" + code + "```\nDone."
+
+    stream_into(writer, text)
+
+    texts = slack.texts()
+    assert len(texts) > 1
+    assert texts[0].endswith("\n```")
+    assert all(t.startswith("```python\n") for t in texts[1:])
+    assert all(t.count("```") % 2 == 0 for t in texts)
+    assert texts[-1].endswith("```\nDone.")
+
+
+def test_failed_post_is_retried_without_losing_text():
+    slack = FakeSlackThread(fail_posts=1)
+    writer = SplitMessageWriter(slack.update, slack.post, "1.0", max_chars=300)
+    text = paragraphs(6)
+
+    with pytest.raises(RateLimited):
+        writer(text)
+    writer(text)
+
+    assert "\n\n".join(slack.texts()).split() == text.split()
+
+
+def test_async_writer_through_the_coalescer():
+    slack = FakeSlackThread()
+
+    async def update(ts, text):
+        slack.update(ts, text)
+
+    async def post(text):
+        return slack.post(text)
+
+    async def run():
+        writer = AsyncSplitMessageWriter(update, post, "1.0", max_chars=300)
+        updater = AsyncChatUpdateCoalescer(writer, min_interval=0.0, metrics=UpdateMetrics())
+        text = paragraphs(10)
+        for end in range(50, len(text), 50):
+            updater.submit(text[:end])
+            await asyncio.sleep(0)
+        await updater.finish(text)
+        return text
+
+    text = asyncio.run(run())
+
+    assert len(slack.texts()) > 1
+    assert "\n\n".join(slack.texts()).split() == text.split()
@@ -0,0 +1,115 @@
+import logging
+import threading
+
+import pytest
+from json_logger_stdout import json_std_logger
+
+import structured_logging
+from structured_logging import (DeferredQueueHandler, enable_queue_logging, lazy, logging_wrapper,
+                                reset_log_context, run_in_log_context, set_log_context)
+
+
+class CapturingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((threading.current_thread().name, record.levelno, dict(record.msg)))
+
+
+@pytest.fixture
+def captured():
+    logger = json_std_logger.logger
+    level = logger.level
+    handler = CapturingHandler()
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    yield handler
+    logger.removeHandler(handler)
+    logger.setLevel(level)
+
+
+def test_disabled_levels_build_nothing(captured):
+    calls = []
+
+    logging_wrapper("Milestone", logging.DEBUG, stats=lazy(lambda: calls.append("debug")))
+    logging_wrapper("Milestone", logging.INFO, stats=lazy(lambda: calls.append("info") or {"hits": 1}))
+
+    assert calls == ["info"]
+    (_, level, fields), = captured.records
+    assert level == logging.INFO
+    assert fields == {"stats": {"hits": 1}, "message": "Milestone"}
+
+
+def test_fields_do_not_leak_between_lines(captured):
+    logging_wrapper("First", logging.INFO, email="jdoe@example.com")
+    logging_wrapper("Second", logging.WARNING)
+
+    assert captured.records[1][2] == {"message": "Second"}
+    assert captured.records[1][1] == logging.WARNING
+
+
+def test_context_is_per_thread(captured):
+    barrier = threading.Barrier(8)
+
+    def handle(i):
+        token = set_log_context(channel_id=f"C{i}")
+        try:
+            barrier.wait()
+            logging_wrapper("Milestone", logging.INFO, step=i)
+        finally:
+            reset_log_context(token)
+
+    threads = [threading.Thread(target=handle, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted((f["channel_id"], f["step"]) for _, _, f in captured.records) == [(f"C{i}", i) for i in range(8)]
+    assert structured_logging.log_context() == {}
+
+
+def test_context_follows_work_into_executors(captured):
+    token = set_log_context(thread_ts="1.0")
+    try:
+        task = run_in_log_context(logging_wrapper, "Worker", logging.INFO)
+    finally:
+        reset_log_context(token)
+    thread = threading.Thread(target=task)
+    thread.start()
+    thread.join()
+
+    assert captured.records[0][2] == {"thread_ts": "1.0", "message": "Worker"}
+
+
+def test_queue_handler_formats_on_the_listener_thread():
+    logger = logging.getLogger("test_structured_logging.queue")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = CapturingHandler()
+    logger.addHandler(handler)
+
+    listener = enable_queue_logging(logger, maxsize=100)
+    try:
+        assert enable_queue_logging(logger) is None
+        logger.info({"message": "queued"})
+    finally:
+        listener.stop()
+        logger.handlers.clear()
+
+    (thread_name, _, fields), = handler.records
+    assert fields == {"message": "queued"}
+    assert thread_name != threading.current_thread().name
+
+
+def test_full_queue_drops_instead_of_blocking():
+    import queue
+
+    handler = DeferredQueueHandler(queue.Queue(2))
+    record = logging.LogRecord("x", logging.INFO, __file__, 1, {"message": "m"}, None, None)
+    for _ in range(5):
+        handler.handle(record)
+
+    assert handler.queue.qsize() == 2 and handler.dropped == 3
@@ -0,0 +1,232 @@
+import asyncio
+
+import pytest
+
+import slack_gpt_bot
+import thread_state
+from cache import MemoryCacheBackend, RedisCacheBackend, SQLiteCacheBackend
+from slack_gpt_bot import SlackGPTBot
+from thread_state import (AsyncThreadLocks, ThreadLeases, ThreadStateStore, build_thread_state_store, new_thread_state,
+                          ts_key)
+from utils import num_tokens_from_thread_state, thread_state_messages, update_thread_state
+
+
+def count_tokens(messages):
+    return [len(message["content"]) for message in messages]
+
+
+class FakeSlackClient:
+    '''
+    conversations.replies over an in-memory thread, honouring oldest,
+    inclusive, limit and cursor like the Web API does.  With repeat_parent,
+    every page starts with the thread's parent message, as Slack's can.
+    '''
+    def __init__(self, messages, repeat_parent=False):
+        self.messages = messages
+        self.repeat_parent = repeat_parent
+        self.calls = []
+
+    def conversations_replies(self, channel, ts, limit, inclusive, oldest=None, cursor=None):
+        self.calls.append({"oldest": oldest, "cursor": cursor})
+        replies = [m for m in self.messages
+                   if oldest is None or ts_key(m["ts"]) > ts_key(oldest)
+                   or (inclusive and m["ts"] == oldest)]
+        start = int(cursor or 0)
+        page = replies[start:start + limit]
+        if self.repeat_parent and start:
+            page = [self.messages[0]] + page
+        next_cursor = str(start + limit) if start + limit < len(replies) else ""
+        return {"messages": page, "response_metadata": {"next_cursor": next_cursor}}
+
+
+class FakeApp:
+    def __init__(self, messages, repeat_parent=False):
+        self.client = FakeSlackClient(messages, repeat_parent)
+
+
+def thread(n_turns):
+    messages = []
+    for turn in range(n_turns):
+        messages.append({"ts": f"1700000000.{2 * turn:06d}", "user": "U1", "text": f"<@BOT> question {turn}"})
+        messages.append({"ts": f"1700000000.{2 * turn + 1:06d}", "user": "BOT", "text": f"answer {turn}"})
+    return messages
+
+
+def build_bot(monkeypatch, messages, store=None, repeat_parent=False):
+    monkeypatch.setattr(slack_gpt_bot, "OPENAI_API_KEY", "test")
+    monkeypatch.setattr(slack_gpt_bot, "num_tokens_per_message", lambda messages, model: count_tokens(messages))
+    return SlackGPTBot(FakeApp(messages, repeat_parent), thread_state_store=store or ThreadStateStore(MemoryCacheBackend()))
+
+
+def test_ts_key_orders_exactly():
+    assert ts_key("1700000000.000010") > ts_key("1700000000.000009")
+    assert ts_key("1700000001") > ts_key("1700000000.999999")
+
+
+def test_update_thread_state_processes_only_new_replies(monkeypatch):
+    import utils
+    processed = []
+    original = utils.process_message
+    monkeypatch.setattr(utils, "process_message",
+                        lambda message, *args: processed.append(message["ts"]) or original(message, *args))
+    messages = thread(2)
+
+    state = update_thread_state(new_thread_state(), {"messages": messages[:3]}, "BOT", count_tokens,
+                                reply_message_ts=messages[3]["ts"])
+    assert state["last_ts"] == messages[2]["ts"]
+    assert [m["content"] for m in state["messages"]] == ["question 0", "answer 0", "question 1"]
+
+    #-the previous wait message now holds the answer, followed by a new question and wait message
+    messages.append({"ts": "1700000000.000004", "user": "U1", "text": "<@BOT> question 2"})
+    messages.append({"ts": "1700000000.000005", "user": "BOT", "text": "Please wait"})
+    processed.clear()
+    state = update_thread_state(state, {"messages": messages}, "BOT", count_tokens,
+                                reply_message_ts=messages[-1]["ts"])
+
+    assert processed == [messages[3]["ts"], messages[4]["ts"]]
+    assert [m["content"] for m in state["messages"]][-2:] == ["answer 1", "question 2"]
+    assert state["messages"][-1]["tokens"] == len("question 2")
+
+
+def test_replies_after_the_wait_message_wait_for_the_next_turn():
+    messages = thread(1) + [{"ts": "1700000000.000002", "user": "U2", "text": "<@BOT> too late"}]
+
+    state = update_thread_state(new_thread_state(), {"messages": messages}, "BOT", count_tokens,
+                                reply_message_ts=messages[1]["ts"])
+
+    assert [m["content"] for m in state["messages"]] == ["question 0"]
+    assert state["last_ts"] == messages[0]["ts"]
+
+
+def test_thread_state_messages_and_token_count(monkeypatch):
+    import utils
+
+    class LengthEncoding:
+        name = "length"
+
+        def encode(self, text):
+            return text
+
+    monkeypatch.setattr(utils, "message_token_parameters", lambda model: (LengthEncoding(), 3, 1))
+    state = update_thread_state(new_thread_state(), {"messages": thread(2)}, "BOT",
+                                lambda messages: utils.num_tokens_per_message(messages, "gpt-4o"))
+    messages = thread_state_messages(state)
+
+    assert messages[0]["role"] == "system"
+    assert [m["role"] for m in messages[1:]] == ["user", "assistant", "user"]
+    assert num_tokens_from_thread_state(state, "gpt-4o") == sum(utils.num_tokens_per_message(messages, "gpt-4o")) + 3
+
+
+def test_bot_fetches_only_the_delta_with_pagination(monkeypatch):
+    messages = thread(150)
+    bot = build_bot(monkeypatch, messages)
+    wait_ts = messages[-1]["ts"]
+
+    state = bot.get_thread_state("C1", messages[0]["ts"], "BOT", wait_ts)
+    assert len(state["messages"]) == 299
+    assert [call["cursor"] for call in bot.app.client.calls] == [None, "200"]
+
+    messages.append({"ts": "1700000000.000300", "user": "U1", "text": "<@BOT> follow up"})
+    messages.append({"ts": "1700000000.000301", "user": "BOT", "text": "Please wait"})
+    bot.app.client.calls.clear()
+    state = bot.get_thread_state("C1", messages[0]["ts"], "BOT", messages[-1]["ts"])
+
+    assert bot.app.client.calls == [{"oldest": messages[-4]["ts"], "cursor": None}]
+    assert len(state["messages"]) == 301
+    assert state["messages"][-2]["content"] == "answer 149"
+
+
+
+def test_parent_repeated_on_every_page_is_kept_once(monkeypatch):
+    messages = thread(150)
+    bot = build_bot(monkeypatch, messages, repeat_parent=True)
+
+    history = bot.get_conversation_history("C1", messages[0]["ts"])
+    assert [call["cursor"] for call in bot.app.client.calls] == [None, "200"]
+    assert [m["ts"] for m in history["messages"]] == [m["ts"] for m in messages]
+
+    state = bot.get_thread_state("C1", messages[0]["ts"], "BOT", messages[-1]["ts"])
+    assert len(state["messages"]) == 299
+    assert [m["content"] for m in state["messages"]].count("question 0") == 1
+
+
+def test_memory_store_is_capped_by_size(monkeypatch):
+    monkeypatch.setattr(thread_state, "THREAD_STATE_MAX_BYTES", 20000)
+    store = build_thread_state_store("memory")
+    state = update_thread_state(new_thread_state(), {"messages": thread(40)}, "BOT", count_tokens)
+
+    for thread_ts in ("1", "2", "3"):
+        store.save("C1", thread_ts, state)
+
+    assert store.backend.current_bytes <= 20000
+    assert store.load("C1", "1") == new_thread_state()
+    assert store.load("C1", "3") == state
+
+@pytest.mark.parametrize("backend_name", ["memory", "sqlite", "redis"])
+def test_store_backends(tmp_path, backend_name, fake_redis):
+    backend = {
+        "memory": lambda: MemoryCacheBackend(max_entries=2),
+        "sqlite": lambda: SQLiteCacheBackend(str(tmp_path / "state.db"), max_entries=2),
+        "redis": lambda: RedisCacheBackend(fake_redis),
+    }[backend_name]()
+    store = ThreadStateStore(backend)
+    state = update_thread_state(new_thread_state(), {"messages": thread(1)}, "BOT", count_tokens)
+
+    store.save("C1", "1.0", state)
+    assert store.load("C1", "1.0") == state
+    assert store.load("C1", "2.0") == new_thread_state()
+    store.clear("C1", "1.0")
+    assert store.load("C1", "1.0") == new_thread_state()
+
+
+@pytest.mark.parametrize("backend_name", ["memory", "sqlite", "redis"])
+def test_thread_leases(tmp_path, backend_name, clock, fake_redis):
+    backend = {
+        "memory": lambda: MemoryCacheBackend(time_func=clock),
+        "sqlite": lambda: SQLiteCacheBackend(str(tmp_path / "leases.db"), time_func=clock),
+        "redis": lambda: RedisCacheBackend(fake_redis),
+    }[backend_name]()
+    leases = ThreadLeases(backend, ttl=60)
+
+    assert leases.acquire("C1", "1.0", "w1")
+    assert not leases.acquire("C1", "1.0", "w2")
+    assert leases.acquire("C1", "2.0", "w2")
+    assert not leases.renew("C1", "1.0", "w2")
+    leases.release("C1", "1.0", "w2")
+    assert leases.owner("C1", "1.0") == "w1"
+
+    clock.now += 50
+    assert leases.renew("C1", "1.0", "w1")
+    clock.now += 50
+    assert not leases.acquire("C1", "1.0", "w2")
+    leases.release("C1", "1.0", "w1")
+    assert leases.acquire("C1", "1.0", "w2")
+
+    #-a worker that stops renewing loses the thread, and neither renewing
+    #-nor releasing late takes it from the new owner
+    clock.now += 61
+    assert not leases.renew("C1", "1.0", "w2")
+    assert leases.acquire("C1", "1.0", "w3")
+    assert not leases.renew("C1", "1.0", "w2")
+    leases.release("C1", "1.0", "w2")
+    assert leases.owner("C1", "1.0") == "w3"
+
+
+def test_async_thread_locks_take_turns():
+    locks = AsyncThreadLocks()
+    order = []
+
+    async def prepare(name, thread_ts):
+        async with locks.hold("C1", thread_ts):
+            order.append(f"{name} start")
+            await asyncio.sleep(0.05)
+            order.append(f"{name} end")
+
+    async def main():
+        await asyncio.gather(prepare("a", "1.0"), prepare("b", "1.0"), prepare("other", "2.0"))
+
+    asyncio.run(main())
+
+    assert order.index("a end") < order.index("b start")
+    assert order.index("other start") < order.index("a end")
+    assert locks.waits == 1 and locks._locks == {}
@@ -0,0 +1,197 @@
+import pytest
+
+from cache import MemoryCacheBackend, SQLiteCacheBackend
+from url_cache import ExtractionCache, normalize_url
+from url_fetcher import URLFetcher
+
+fetch_document = URLFetcher(None).fetch_document
+
+PAGE = b"<html><body><article><p>The Doom Book is a manuscript record.</p></article></body></html>"
+
+
+def upper_extract(body):
+    return body.decode("utf-8").upper()
+
+
+def test_normalize_url():
+    assert normalize_url("HTTPS://Example.COM:443/a?b=2&amp;a=1#frag") == "https://example.com/a?a=1&b=2"
+    assert normalize_url("http://example.com") == "http://example.com/"
+    assert normalize_url("http://example.com:8080/x") == "http://example.com:8080/x"
+
+
+def test_repeated_url_is_served_from_cache(stub_server):
+    stub_server.routes["/doc"] = {"body": PAGE}
+    cache = ExtractionCache(MemoryCacheBackend())
+
+    first = cache.get_or_fetch(stub_server.url("/doc"), fetch_document, upper_extract)
+    second = cache.get_or_fetch(stub_server.url("/doc#section"), fetch_document, upper_extract)
+
+    assert first == second == PAGE.decode().upper()
+    assert stub_server.hits("/doc") == 1
+    assert cache.stats["misses"] == 1
+    assert cache.stats["hits"] == 1
+    assert cache.stats["bytes_fetched"] == len(PAGE)
+    assert cache.stats["bytes_served"] == len(first)
+
+
+def test_stale_entry_is_revalidated_with_etag(stub_server, clock):
+    stub_server.routes["/doc"] = {"body": PAGE, "etag": '"v1"'}
+    cache = ExtractionCache(MemoryCacheBackend(), ttl=60, time_func=clock)
+
+    cache.get_or_fetch(stub_server.url("/doc"), fetch_document, upper_extract)
+    clock.now += 120
+    content = cache.get_or_fetch(stub_server.url("/doc"), fetch_document, upper_extract)
+
+    assert content == PAGE.decode().upper()
+    assert stub_server.hits("/doc") == 2
+    assert stub_server.requests[-1][1].get("If-None-Match") == '"v1"'
+    assert cache.stats["revalidations"] == 1
+    assert cache.stats["not_modified"] == 1
+    assert cache.stats["bytes_fetched"] == len(PAGE)
+
+
+def test_stale_entry_is_revalidated_with_last_modified(stub_server, clock):
+    last_modified = "Wed, 21 Oct 2015 07:28:00 GMT"
+    stub_server.routes["/doc"] = {"body": PAGE, "last_modified": last_modified}
+    cache = ExtractionCache(MemoryCacheBackend(), ttl=60, time_func=clock)
+
+    cache.get_or_fetch(stub_server.url("/doc"), fetch_document, upper_extract)
+    clock.now += 120
+    cache.get_or_fetch(stub_server.url("/doc"), fetch_document, upper_extract)
+
+    assert stub_server.requests[-1][1].get("If-Modified-Since") == last_modified
+    assert cache.stats["not_modified"] == 1
+
+
+def test_changed_document_is_refetched(stub_server, clock):
+    stub_server.routes["/doc"] = {"body": PAGE, "etag": '"v1"'}
+    cache = ExtractionCache(MemoryCacheBackend(), ttl=60, time_func=clock)
+
+    cache.get_or_fetch(stub_server.url("/doc"), fetch_document, upper_extract)
+    stub_server.routes["/doc"] = {"body": b"new version", "etag": '"v2"'}
+    clock.now += 120
+
+    assert cache.get_or_fetch(stub_server.url("/doc"), fetch_document, upper_extract) == "NEW VERSION"
+    assert cache.get(stub_server.url("/doc"))["etag"] == '"v2"'
+
+
+def test_unreachable_origin_serves_stale_entry(stub_server, clock):
+    stub_server.routes["/doc"] = {"body": PAGE, "etag": '"v1"'}
+    cache = ExtractionCache(MemoryCacheBackend(), ttl=60, time_func=clock)
+
+    cache.get_or_fetch(stub_server.url("/doc"), fetch_document, upper_extract)
+    stub_server.routes["/doc"] = {"body": b"", "status": 503, "etag": '"v2"'}
+    clock.now += 120
+
+    assert cache.get_or_fetch(stub_server.url("/doc"), fetch_document, upper_extract) == PAGE.decode().upper()
+
+
+def test_missing_document_is_not_cached(stub_server):
+    cache = ExtractionCache(MemoryCacheBackend())
+
+    assert cache.get_or_fetch(stub_server.url("/missing"), fetch_document, upper_extract) is None
+    assert cache.get_or_fetch(stub_server.url("/missing"), fetch_document, upper_extract) is None
+    assert stub_server.hits("/missing") == 2
+
+
+def test_memory_backend_lru_eviction():
+    backend = MemoryCacheBackend(max_entries=2)
+    backend.set("a", 1)
+    backend.set("b", 2)
+    backend.get("a")
+    backend.set("c", 3)
+
+    assert backend.get("a") == 1
+    assert backend.get("b") is None
+    assert backend.get("c") == 3
+    assert backend.evictions == 1
+
+
+def test_memory_backend_size_bound_and_ttl(clock):
+    backend = MemoryCacheBackend(max_entries=10, max_bytes=10, ttl=5, size_func=len, time_func=clock)
+    backend.set("a", "xxxxxx")
+    backend.set("b", "yyyyyy")
+    assert backend.get("a") is None
+    assert backend.get("b") == "yyyyyy"
+    assert backend.current_bytes == 6
+
+    backend.set("huge", "z" * 11)
+    assert backend.get("huge") is None
+
+    clock.now += 6
+    assert backend.get("b") is None
+    assert len(backend) == 0
+
+
+@pytest.mark.parametrize("mmap_size", [0, 1024 * 1024])
+def test_sqlite_backend_survives_restart(tmp_path, stub_server, mmap_size):
+    path = str(tmp_path / "urls.db")
+    stub_server.routes["/doc"] = {"body": PAGE, "etag": '"v1"'}
+
+    cache = ExtractionCache(SQLiteCacheBackend(path, mmap_size=mmap_size))
+    cache.get_or_fetch(stub_server.url("/doc"), fetch_document, upper_extract)
+    cache.backend.close()
+
+    restarted = ExtractionCache(SQLiteCacheBackend(path, mmap_size=mmap_size))
+    content = restarted.get_or_fetch(stub_server.url("/doc"), fetch_document, upper_extract)
+
+    assert content == PAGE.decode().upper()
+    assert restarted.stats["hits"] == 1
+    assert restarted.get(stub_server.url("/doc"))["etag"] == '"v1"'
+    assert stub_server.hits("/doc") == 1
+
+
+def test_sqlite_backend_lru_and_ttl(tmp_path, clock):
+    backend = SQLiteCacheBackend(str(tmp_path / "c.db"), max_entries=2, ttl=5, time_func=clock)
+    backend.set("a", {"v": 1})
+    clock.now += 1
+    backend.set("b", {"v": 2})
+    clock.now += 1
+    backend.get("a")
+    clock.now += 1
+    backend.set("c", {"v": 3})
+
+    assert backend.get("b") is None
+    assert backend.get("a") == {"v": 1}
+    assert len(backend) == 2
+
+    clock.now += 10
+    assert backend.get("a") is None
+
+
+def test_sqlite_backend_keeps_its_totals_without_scanning(tmp_path):
+    path = str(tmp_path / "c.db")
+    backend = SQLiteCacheBackend(path, max_entries=3, max_bytes=40)
+    other = SQLiteCacheBackend(path, max_entries=3, max_bytes=40)
+    statements = []
+    backend._conn.set_trace_callback(statements.append)
+
+    backend.set("a", "x" * 10)
+    other.set("b", "y" * 10)
+    backend.set("a", "x" * 5)
+    assert backend.add("c", "z" * 10)
+    backend.delete("b")
+    backend.set("d", "w" * 20)
+
+    #-writes of either connection are counted, and a is evicted for the byte bound
+    assert len(backend) == len(other) == 2
+    assert backend.get("a") is None
+    assert backend._conn.execute("SELECT entries, bytes FROM cache_meta").fetchone() == (2, 12 + 22)
+    assert not [sql for sql in statements if "COUNT(" in sql or "SUM(" in sql]
+
+    #-a table written before the totals existed is counted once on open
+    backend._conn.execute("DROP TABLE cache_meta")
+    assert len(SQLiteCacheBackend(path)) == 2
+
+
+def test_augment_user_message_uses_cache(stub_server, monkeypatch):
+    import utils
+    stub_server.routes["/doc"] = {"body": PAGE}
+    monkeypatch.setattr(utils, "url_fetcher", URLFetcher(ExtractionCache(MemoryCacheBackend())))
+    url = stub_server.url("/doc")
+
+    for _ in range(3):
+        message = utils.augment_user_message(f"summarize <{url}>", [url])
+
+    assert "Doom Book" in message
+    assert stub_server.hits("/doc") == 1
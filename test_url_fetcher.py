@@ -0,0 +1,117 @@
+import threading
+import time
+
+from cache import MemoryCacheBackend
+from thread_state import new_thread_state
+from url_cache import ExtractionCache
+from url_fetcher import URLFetcher
+
+
+def build_fetcher(**kwargs):
+    return URLFetcher(ExtractionCache(MemoryCacheBackend()), **kwargs)
+
+
+def decode(body):
+    return body.decode("utf-8")
+
+
+def test_urls_are_fetched_in_parallel(stub_server):
+    for i in range(4):
+        stub_server.routes[f"/slow{i}"] = {"body": f"page {i}".encode(), "delay": 0.5}
+    fetcher = build_fetcher(extract_func=decode)
+    urls = [stub_server.url(f"/slow{i}") for i in range(4)]
+
+    started = time.monotonic()
+    contents = fetcher.fetch_all(urls)
+    elapsed = time.monotonic() - started
+
+    assert [contents[url] for url in urls] == ["page 0", "page 1", "page 2", "page 3"]
+    assert elapsed < 1.5
+
+
+def test_duplicate_urls_are_fetched_once(stub_server):
+    stub_server.routes["/doc"] = {"body": b"doc"}
+    fetcher = build_fetcher(extract_func=decode)
+
+    contents = fetcher.fetch_all([stub_server.url("/doc")] * 3)
+
+    assert contents == {stub_server.url("/doc"): "doc"}
+    assert stub_server.hits("/doc") == 1
+
+
+def test_deadline_replaces_slow_urls_with_placeholder(stub_server):
+    stub_server.routes["/fast"] = {"body": b"fast"}
+    stub_server.routes["/stalled"] = {"body": b"stalled", "delay": 2}
+    fetcher = build_fetcher(extract_func=decode)
+
+    started = time.monotonic()
+    contents = fetcher.fetch_all([stub_server.url("/fast"), stub_server.url("/stalled")], deadline=0.5)
+
+    assert time.monotonic() - started < 1.5
+    assert contents[stub_server.url("/fast")] == "fast"
+    assert "could not be retrieved (timed out)" in contents[stub_server.url("/stalled")]
+
+
+def test_request_timeout_and_http_errors_become_placeholders(stub_server):
+    stub_server.routes["/stalled"] = {"body": b"stalled", "delay": 1}
+    fetcher = build_fetcher(extract_func=decode, request_timeout=0.2)
+
+    contents = fetcher.fetch_all([stub_server.url("/stalled"), stub_server.url("/missing")])
+
+    assert "could not be retrieved" in contents[stub_server.url("/stalled")]
+    assert "HTTP 404" in contents[stub_server.url("/missing")]
+
+
+def test_oversized_documents_are_cut_off(stub_server):
+    stub_server.routes["/big"] = {"body": b"x" * 500000}
+    fetcher = build_fetcher(extract_func=decode, max_bytes=1000, max_chars=100)
+
+    content, result = fetcher.cache.fetch_stage(stub_server.url("/big"), fetcher.fetch_document)
+    assert len(result.body) == 1000
+
+    assert fetcher.fetch_all([stub_server.url("/big")])[stub_server.url("/big")] == "x" * 100
+
+
+def test_extraction_runs_off_the_io_threads(stub_server):
+    stub_server.routes["/doc"] = {"body": b"doc"}
+    threads = []
+
+    def recording_extract(body):
+        threads.append(threading.current_thread().name)
+        return decode(body)
+
+    fetcher = build_fetcher(extract_func=recording_extract)
+    fetcher.fetch_all([stub_server.url("/doc")])
+
+    assert threads and threads[0].startswith("url-extract")
+
+
+def test_extractions_are_cached(stub_server):
+    stub_server.routes["/doc"] = {"body": b"doc"}
+    fetcher = build_fetcher(extract_func=decode)
+
+    fetcher.fetch_all([stub_server.url("/doc")])
+    fetcher.fetch_all([stub_server.url("/doc")])
+
+    assert stub_server.hits("/doc") == 1
+    assert fetcher.cache.stats["hits"] == 1
+
+
+def test_thread_urls_are_fetched_only_for_kept_messages(stub_server, monkeypatch):
+    import utils
+    stub_server.routes["/kept"] = {"body": b"kept"}
+    stub_server.routes["/ignored"] = {"body": b"ignored"}
+    monkeypatch.setattr(utils, "url_fetcher", build_fetcher(extract_func=decode))
+    history = {"messages": [
+        {"ts": "1700000000.000000", "user": "U1", "text": f"<@BOT> summarize <{stub_server.url('/kept')}>"},
+        {"ts": "1700000000.000001", "user": "U2", "text": f"side chatter <{stub_server.url('/ignored')}>"},
+        {"ts": "1700000000.000002", "user": "BOT", "text": "Summary"},
+        {"ts": "1700000000.000003", "user": "BOT", "text": "Please wait"},
+    ]}
+
+    state = utils.update_thread_state(new_thread_state(), history, "BOT", lambda messages: [0] * len(messages))
+    messages = utils.thread_state_messages(state)
+
+    assert len(messages) == 3
+    assert 'Contents of ' + stub_server.url('/kept') + ' : \n """ kept """' in messages[1]["content"]
+    assert stub_server.hits("/ignored") == 0
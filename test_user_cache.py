@@ -0,0 +1,224 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from cache import MemoryCacheBackend
+from user_cache import UserProfileCache
+
+
+def slack_user(user_id, first_name="Jane"):
+    return {"id": user_id, "name": f"user-{user_id}", "real_name": f"{first_name} Doe",
+            "profile": {"first_name": first_name, "email": f"{user_id}@example.com", "image_512": "x" * 100}}
+
+
+class FakeUsersAPI:
+    def __init__(self, latency=0.0, members=0, rate_limited_pages=()):
+        self.latency = latency
+        self.info_calls = []
+        self.list_calls = []
+        self.members = [slack_user(f"U{i}") for i in range(members)]
+        self.rate_limited_pages = set(rate_limited_pages)
+        self.lock = threading.Lock()
+
+    def users_info(self, user_id):
+        with self.lock:
+            self.info_calls.append(user_id)
+        time.sleep(self.latency)
+        return {"ok": True, "user": slack_user(user_id)}
+
+    def users_list(self, limit, cursor=None):
+        self.list_calls.append(cursor)
+        start = int(cursor or 0)
+        if len(self.list_calls) in self.rate_limited_pages:
+            error = Exception("ratelimited")
+            error.response = SimpleNamespace(status_code=429, headers={"Retry-After": "0"})
+            raise error
+        members = self.members[start:start + limit]
+        if start == 0:
+            members = members + [{"id": "UGONE", "deleted": True}]
+        next_cursor = str(start + limit) if start + limit < len(self.members) else ""
+        return {"members": members, "response_metadata": {"next_cursor": next_cursor}}
+
+
+def test_profiles_are_cached_until_they_expire(clock):
+    cache = UserProfileCache(MemoryCacheBackend(ttl=60, time_func=clock), ttl=60)
+    api = FakeUsersAPI()
+
+    first = cache.lookup("U1", api.users_info)
+    second = cache.lookup("U1", api.users_info)
+    clock.now += 61
+    cache.lookup("U1", api.users_info)
+
+    assert first == second
+    assert first["user"]["profile"] == {"first_name": "Jane", "email": "U1@example.com"}
+    assert api.info_calls == ["U1", "U1"]
+    assert cache.stats["hits"] == 1 and cache.stats["misses"] == 2
+
+
+def test_concurrent_lookups_share_one_call():
+    cache = UserProfileCache()
+    api = FakeUsersAPI(latency=0.2)
+    results = []
+
+    threads = [threading.Thread(target=lambda: results.append(cache.lookup("U1", api.users_info)))
+               for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert api.info_calls == ["U1"]
+    assert len(results) == 10 and all(result == results[0] for result in results)
+    assert cache.stats["misses"] == 1 and cache.stats["coalesced"] + cache.stats["hits"] == 9
+
+
+def test_failed_lookup_is_not_cached():
+    cache = UserProfileCache()
+
+    def failing(user_id):
+        raise RuntimeError("user_not_found")
+
+    with pytest.raises(RuntimeError):
+        cache.lookup("U1", failing)
+    assert cache.lookup("U1", FakeUsersAPI().users_info)["user"]["name"] == "user-U1"
+    assert cache.stats["errors"] == 1
+
+
+
+class SlowRecheckBackend(MemoryCacheBackend):
+    '''
+    Blocks the second read of one key, the leader's re-check in lookup().
+    '''
+    def __init__(self, slow_key):
+        super().__init__()
+        self.slow_key = slow_key
+        self.reads = 0
+        self.rechecking = threading.Event()
+        self.release = threading.Event()
+
+    def get(self, key):
+        if key == self.slow_key:
+            self.reads += 1
+            if self.reads == 2:
+                self.rechecking.set()
+                self.release.wait(5)
+        return super().get(key)
+
+
+def test_a_slow_recheck_does_not_block_other_users():
+    backend = SlowRecheckBackend("USLOW")
+    cache = UserProfileCache(backend)
+    api = FakeUsersAPI()
+    slow = threading.Thread(target=cache.lookup, args=("USLOW", api.users_info))
+    slow.start()
+    assert backend.rechecking.wait(5)
+
+    fast = threading.Thread(target=cache.lookup, args=("UFAST", api.users_info))
+    fast.start()
+    fast.join(2)
+    finished = not fast.is_alive()
+    backend.release.set()
+    slow.join()
+
+    assert finished
+    assert sorted(api.info_calls) == ["UFAST", "USLOW"]
+
+
+class ThreadRecordingBackend(MemoryCacheBackend):
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+
+    def get(self, key):
+        self.threads.append(threading.get_ident())
+        return super().get(key)
+
+    def set(self, key, value, ttl=None):
+        self.threads.append(threading.get_ident())
+        super().set(key, value, ttl=ttl)
+
+
+def test_async_lookup_uses_the_backend_off_the_event_loop():
+    backend = ThreadRecordingBackend()
+    cache = UserProfileCache(backend)
+    api = FakeUsersAPI()
+
+    async def users_info(user_id):
+        return api.users_info(user_id)
+
+    async def run():
+        await cache.lookup_async("U1", users_info)
+        return await cache.lookup_async("U1", users_info)
+
+    assert asyncio.run(run())["user"]["name"] == "user-U1"
+    #-miss, store and hit
+    assert len(backend.threads) == 3 and threading.get_ident() not in backend.threads
+
+def test_async_lookups_share_one_call():
+    cache = UserProfileCache()
+    api = FakeUsersAPI()
+
+    async def users_info(user_id):
+        await asyncio.sleep(0.05)
+        return api.users_info(user_id)
+
+    async def run():
+        return await asyncio.gather(*(cache.lookup_async("U1", users_info) for _ in range(10)))
+
+    results = asyncio.run(run())
+
+    assert api.info_calls == ["U1"]
+    assert all(result == results[0] for result in results)
+    assert cache.stats["coalesced"] == 9
+
+
+def test_cancelled_async_lookup_does_not_strand_the_others():
+    cache = UserProfileCache()
+    api = FakeUsersAPI()
+
+    async def users_info(user_id):
+        await asyncio.sleep(0.05)
+        return api.users_info(user_id)
+
+    async def run():
+        first = asyncio.ensure_future(cache.lookup_async("U1", users_info))
+        await asyncio.sleep(0)
+        joined = asyncio.ensure_future(cache.lookup_async("U1", users_info))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await asyncio.wait_for(joined, 1), first
+
+    result, first = asyncio.run(run())
+
+    assert first.cancelled()
+    assert result["user"]["name"] == "user-U1"
+    assert api.info_calls == ["U1"]
+    assert cache.stats["coalesced"] == 1
+
+
+def test_warm_up_pages_through_users_list():
+    cache = UserProfileCache()
+    api = FakeUsersAPI(members=450, rate_limited_pages=[2])
+
+    pages = cache.warm(api.users_list, page_size=200, sleep=lambda seconds: None)
+
+    assert pages == 3
+    assert api.list_calls == [None, "200", "200", "400"]
+    assert cache.stats["warmed"] == 450 and len(cache.backend) == 450
+    assert cache.get("UGONE") is None
+    cache.lookup("U449", api.users_info)
+    assert api.info_calls == []
+
+
+def test_async_warm_up():
+    cache = UserProfileCache()
+    api = FakeUsersAPI(members=250)
+
+    async def users_list(**kwargs):
+        return api.users_list(**kwargs)
+
+    assert asyncio.run(cache.warm_async(users_list, page_size=100)) == 3
+    assert cache.stats["warmed"] == 250
@@ -9,15 +9,13 @@ def test_extract_url_list_simple_link():
     assert url_list != None
     assert len(url_list) == 1
 
-# def test_extract_url_list_hyperlink():
-#     '''
-#     FAILURE: this parser is not able to see the link within a slack-style syntax
-#     '''
-#     text = "<@U05AHRCAXTL> can you summarize this <https://en.wikipedia.org/wiki/Doom_book|wikipedia page>"
+def test_extract_url_list_hyperlink():
+    text = "<@U05AHRCAXTL> can you summarize this <https://en.wikipedia.org/wiki/Doom_book|wikipedia page>"
 
-#     url_list = extract_url_list(text)
-#     assert url_list != None
-#     assert len(url_list) == 1
+    url_list = extract_url_list(text)
+    assert url_list != None
+    assert len(url_list) == 1
+    assert url_list[0] == "https://en.wikipedia.org/wiki/Doom_book"
 
 def test_extract_url_list_pdf_link():
     text = "<@U05AHRCAXTL> are you able to access this <https://hartfordhealthcare.org/file%20library/chna/chna-hartford-hospital-2022.pdf?_ga=2.248866113.710713768.1687980028-1118602651.1687980028&amp;_gl=1*depsgg*_ga*MTExODYwMjY1MS4xNjg3OTgwMDI4*_ga_4604MZZMMD*MTY4Nzk4MDAyOC4xLjAuMTY4Nzk4MDA0My40NS4wLjA>."
@@ -34,17 +32,120 @@ def test_extract_url_list_pdf_hyperlink():
     assert len(url_list) == 1    
 
 
-# def test_extract_url_list():
-#     '''
-#     the extract_url_list function does not return when given this text
-#     '''
-#     text = "<@U05AHRCAXTL> please identify opportunities that a patient engagement software company, specifically, <https://cipherhealth.com/|CipherHealth> has to support Hartford Healthcare, based on their <https://hartfordhealthcare.org/file%20library/chna/chna-hartford-hospital-2022.pdf?_ga=2.248866113.710713768.1687980028-1118602651.1687980028&amp;_gl=1*depsgg*_ga*MTExODYwMjY1MS4xNjg3OTgwMDI4*_ga_4604MZZMMD*MTY4Nzk4MDAyOC4xLjAuMTY4Nzk4MDA0My40NS4wLjA.|2022 Community Health Needs Assessment> which outlines their plans to improve the lives of their community."
+def test_extract_url_list():
+    '''
+    the old regex never returned when given this text
+    '''
+    text = "<@U05AHRCAXTL> please identify opportunities that a patient engagement software company, specifically, <https://cipherhealth.com/|CipherHealth> has to support Hartford Healthcare, based on their <https://hartfordhealthcare.org/file%20library/chna/chna-hartford-hospital-2022.pdf?_ga=2.248866113.710713768.1687980028-1118602651.1687980028&amp;_gl=1*depsgg*_ga*MTExODYwMjY1MS4xNjg3OTgwMDI4*_ga_4604MZZMMD*MTY4Nzk4MDAyOC4xLjAuMTY4Nzk4MDA0My40NS4wLjA.|2022 Community Health Needs Assessment> which outlines their plans to improve the lives of their community."
+
+    url_list = extract_url_list(text)
+
+    assert url_list[0] == "https://cipherhealth.com/"
+    assert url_list[1].startswith("https://hartfordhealthcare.org/file%20library/")
+    assert "1118602651.1687980028&_gl=1*depsgg" in url_list[1]
+    assert len(url_list) == 2
+
+
+def test_extract_url_list_without_links():
+    assert extract_url_list("<@U05AHRCAXTL> what is 2 &lt; 3? <#C123|general> <!here>") == None
+
+
+def test_augment_user_message_removes_escaped_links():
+    from utils import augment_user_message
+    url = "https://example.com/a?b=1&c=2"
+    text = "<@U05AHRCAXTL> summarize <https://example.com/a?b=1&amp;c=2> please"
+
+    message = augment_user_message(text, [url], {url: "page"})
+
+    assert message.startswith("<@U05AHRCAXTL> summarize  please\n")
+    assert "&amp;" not in message
+    assert f'Contents of {url} : \n """ page """' in message
+
+
+def test_augment_user_message_removes_labelled_links():
+    from utils import augment_user_message
+    url = "https://cipherhealth.com/"
+    text = "<@U05AHRCAXTL> what does <https://cipherhealth.com/|CipherHealth> do? <#C123|general>"
+
+    message = augment_user_message(text, [url], {url: "page"})
+
+    assert message.startswith("<@U05AHRCAXTL> what does  do? <#C123|general>\n")
+    assert "|CipherHealth>" not in message
+
+
+class CountingEncoding:
+    '''
+    Stand-in for a tiktoken Encoding (one token per word) that records how
+    much text it was asked to encode.
+    '''
+    name = "counting"
+
+    def __init__(self):
+        self.encoded = []
+        self.batches = []
+
+    def encode(self, text):
+        self.encoded.append(text)
+        return text.split()
+
+    def encode_batch(self, texts, num_threads=8):
+        self.batches.append(list(texts))
+        return [text.split() for text in texts]
+
+
+@pytest.fixture
+def counting_encoding(monkeypatch):
+    import utils
+    from cache import MemoryCacheBackend
+    encoding = CountingEncoding()
+    monkeypatch.setattr(utils, "get_encoding", lambda model: encoding)
+    monkeypatch.setattr(utils, "token_count_cache", MemoryCacheBackend(max_entries=1000))
+    utils.message_token_parameters.cache_clear()
+    yield encoding
+    utils.message_token_parameters.cache_clear()
+
+
+def test_num_tokens_per_message_memoizes_per_text(counting_encoding):
+    from utils import num_tokens_per_message
+    messages = [{"role": "system", "content": "be helpful"},
+                {"role": "user", "content": "why is the sky blue"}]
+
+    assert num_tokens_per_message(messages, "gpt-4o") == [3 + 1 + 2, 3 + 1 + 5]
+    counting_encoding.encoded.clear()
+
+    messages.append({"role": "assistant", "content": "scattering", "name": "bot"})
+    assert num_tokens_per_message(messages, "gpt-4o")[-1] == 3 + 1 + 1 + 1 + 1
+    assert sorted(counting_encoding.encoded) == ["assistant", "bot", "scattering"]
+
 
-#     url_list = extract_url_list(text)
-#     #NEVER RETURNS
+def test_thread_state_update_batches_cold_threads(counting_encoding, monkeypatch):
+    import utils
+    from thread_state import new_thread_state
+    monkeypatch.setattr(utils, "fetch_thread_urls", lambda messages, bot_user_id: {})
+    history = {"messages": [{"ts": f"1700000000.{i:06d}", "user": "U1", "text": f"<@BOT> message number {i}"}
+                            for i in range(51)]}
 
-#     assert url_list == None
+    state = utils.update_thread_state(new_thread_state(), history, "BOT",
+                                      lambda messages: utils.num_tokens_per_message(messages, "gpt-4o"))
 
+    assert len(counting_encoding.batches) == 1
+    assert len(counting_encoding.batches[0]) == 51   # "user" plus 50 distinct contents
+    assert [m["tokens"] for m in state["messages"]] == [
+        utils.num_tokens_from_message({"role": "user", "content": f"message number {i}"}, "gpt-4o")
+        for i in range(50)]
+    assert len(counting_encoding.batches) == 1
 
 
+def test_encoding_is_resolved_once_per_model(monkeypatch):
+    import tiktoken
+    import utils
+    calls = []
+    monkeypatch.setattr(tiktoken, "encoding_for_model", lambda model: calls.append(model) or CountingEncoding())
+    utils.get_encoding.cache_clear()
+    try:
+        utils.get_encoding("gpt-4o")
+        utils.get_encoding("gpt-4o")
+    finally:
+        utils.get_encoding.cache_clear()
 
+    assert calls == ["gpt-4o"]
@@ -0,0 +1,112 @@
+import os
+import uuid
+
+import pytest
+
+from work_queue import RedisWorkQueue, SQLiteWorkQueue, build_work_queue, mention_job
+
+
+@pytest.fixture(params=["sqlite", "redis", "redis-server"])
+def queue(request, tmp_path, clock):
+    '''
+    Every backend; "redis-server" runs the Lua scripts on the server at
+    TEST_REDIS_URL and is skipped without one.
+    '''
+    if request.param == "sqlite":
+        queue = SQLiteWorkQueue(str(tmp_path / "queue.db"), time_func=clock)
+        yield queue
+        queue.close()
+    elif request.param == "redis":
+        yield RedisWorkQueue(request.getfixturevalue("fake_redis"), time_func=clock)
+    else:
+        if not os.getenv("TEST_REDIS_URL"):
+            pytest.skip("TEST_REDIS_URL is not set")
+        redis = pytest.importorskip("redis")
+        client = redis.Redis.from_url(os.environ["TEST_REDIS_URL"], decode_responses=True)
+        queue = RedisWorkQueue(client, prefix=f"test:{uuid.uuid4().hex}:", time_func=clock)
+        yield queue
+        client.delete(*queue.keys.values())
+
+
+def test_jobs_are_leased_once_in_order(queue):
+    queue.put({"n": 1})
+    queue.put({"n": 2})
+
+    first, second = queue.get("w1"), queue.get("w2")
+
+    assert (first.payload, first.attempts) == ({"n": 1}, 1)
+    assert second.payload == {"n": 2}
+    assert queue.get("w3") is None
+    assert not queue.ack(first, "w2")
+    assert queue.ack(first, "w1")
+    assert len(queue) == 1
+
+
+def test_expired_lease_is_delivered_again(queue, clock):
+    queue.put({"n": 1})
+    job = queue.get("w1", lease=10)
+
+    clock.now += 8
+    assert queue.get("w2", lease=10) is None
+    assert queue.extend(job, "w1", lease=10)
+    clock.now += 8
+    assert queue.get("w2", lease=10) is None
+
+    clock.now += 3
+    again = queue.get("w2", lease=10)
+    assert (again.id, again.attempts) == (job.id, 2)
+    #-w1 lost it, and finishing late does not remove w2's delivery
+    assert not queue.extend(job, "w1")
+    assert not queue.ack(job, "w1")
+    assert len(queue) == 1
+
+
+def test_release_does_not_count_the_delivery(queue, clock):
+    queue.put({"n": 1})
+    job = queue.get("w1")
+
+    queue.release(job, "w1", delay=5)
+    assert queue.get("w2") is None
+    clock.now += 5
+    assert queue.get("w2").attempts == 1
+
+
+def test_acked_jobs_leave_nothing_behind(queue):
+    queue.put({"n": 1})
+    queue.put({"n": 2}, delay=5)
+    first = queue.get("w1")
+    queue.release(first, "w1")
+
+    assert queue.ack(queue.get("w2"), "w2")
+    assert len(queue) == 1
+    if isinstance(queue, RedisWorkQueue):
+        #-the delayed job's entries are all that is left
+        keys = queue.keys
+        assert queue.client.zscore(keys["ready"], 2) is not None
+        assert queue.client.hget(keys["attempts"], 1) is None
+        assert not queue.client.exists(keys["leased"], keys["workers"])
+
+
+def test_the_queue_is_shared_through_the_file(tmp_path):
+    path = str(tmp_path / "queue.db")
+    intake, worker = SQLiteWorkQueue(path), build_work_queue(f"sqlite:///{path}")
+
+    intake.put({"n": 1})
+
+    assert worker.get("w1").payload == {"n": 1}
+    assert build_work_queue("") is None
+    with pytest.raises(ValueError):
+        build_work_queue("postgres://localhost/queue")
+
+
+def test_mention_job_keeps_what_the_bot_reads():
+    body = {"event_id": "Ev1", "token": "secret", "authorizations": [{"user_id": "UBOT"}],
+            "event": {"type": "app_mention", "channel": "C1", "user": "U1", "text": "<@UBOT> hi",
+                      "ts": "1700000000.000200", "thread_ts": "1700000000.000100", "blocks": [{"type": "rich_text"}]}}
+    context = {"bot_user_id": "UBOT", "user_id": "U1", "client": object()}
+
+    assert mention_job(body, context) == {
+        "body": {"event_id": "Ev1",
+                 "event": {"type": "app_mention", "channel": "C1", "user": "U1", "text": "<@UBOT> hi",
+                           "ts": "1700000000.000200", "thread_ts": "1700000000.000100"}},
+        "context": {"bot_user_id": "UBOT", "user_id": "U1"}}
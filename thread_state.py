@@ -0,0 +1,194 @@
+'''
+Per-thread conversation state.
+
+Rebuilding the message list from conversations.replies on every mention makes
+each turn of a long thread slower than the last.  The store keeps the messages
+of a (channel, thread_ts) that were already processed, with their token counts
+and the ts of the newest one, so a new mention only fetches and processes the
+replies posted since.
+
+Edits to messages that were already processed are not picked up until the
+state expires (THREAD_STATE_TTL).
+
+Mentions of the same thread are prepared one at a time (ThreadLocks): a
+second mention that arrives while the first is still reading the thread
+waits for its state and then only reads what was posted after it, instead
+of fetching and processing the same replies twice.
+
+While a mention is answered its wait message holds the wait text and then
+a partial answer, so bot replies after a mention still being answered
+(OpenTurns) are not stored: a follow-up asked meanwhile reads them for its
+own turn only, and the next mention reads their final text.  Across bot instances
+(distributed mode) a worker holds a lease on the thread (ThreadLeases) in a
+store they share, for as long as it answers in it.
+'''
+import asyncio
+import contextlib
+import os
+import threading
+
+from cache import SHARED_CACHE_BACKEND, build_cache_backend
+
+THREAD_STATE_BACKEND = os.getenv("THREAD_STATE_BACKEND", SHARED_CACHE_BACKEND or "memory")
+THREAD_STATE_TTL = int(os.getenv("THREAD_STATE_TTL", str(24 * 3600)))
+THREAD_STATE_MAX_THREADS = int(os.getenv("THREAD_STATE_MAX_THREADS", "1000"))
+#total JSON size of the stored states, memory and sqlite backends
+THREAD_STATE_MAX_BYTES = int(os.getenv("THREAD_STATE_MAX_BYTES", str(256 * 1024 * 1024)))
+THREAD_LEASE_BACKEND = os.getenv("THREAD_LEASE_BACKEND", SHARED_CACHE_BACKEND)
+THREAD_LEASE_TTL = int(os.getenv("THREAD_LEASE_TTL", "60"))     #renewed while the worker is alive
+
+
+def ts_key(ts):
+    '''
+    Slack timestamps ("1687980028.123456") compared exactly, without going
+    through a float.
+    '''
+    seconds, _, micros = ts.partition(".")
+    return int(seconds), int(micros or 0)
+
+
+def new_thread_state():
+    # messages: [{"ts", "role", "content", "tokens"}] in thread order
+    return {"last_ts": None, "messages": []}
+
+
+class ThreadStateStore:
+    def __init__(self, backend, ttl=THREAD_STATE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+
+    @staticmethod
+    def key(channel_id, thread_ts):
+        return f"{channel_id}:{thread_ts}"
+
+    def load(self, channel_id, thread_ts):
+        return self.backend.get(self.key(channel_id, thread_ts)) or new_thread_state()
+
+    def save(self, channel_id, thread_ts, state):
+        self.backend.set(self.key(channel_id, thread_ts), state, ttl=self.ttl)
+
+    def clear(self, channel_id, thread_ts):
+        self.backend.delete(self.key(channel_id, thread_ts))
+
+
+class ThreadLocks:
+    '''
+    One lock per (channel, thread_ts) while anyone holds or waits for it.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}    # key -> [lock, holders and waiters]
+        self.waits = 0
+
+    @contextlib.contextmanager
+    def hold(self, channel_id, thread_ts):
+        key = ThreadStateStore.key(channel_id, thread_ts)
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        if not entry[0].acquire(blocking=False):
+            with self._lock:
+                self.waits += 1
+            entry[0].acquire()
+        try:
+            yield
+        finally:
+            entry[0].release()
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+class OpenTurns:
+    '''
+    The mentions of each thread being answered in this process, by ts.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._turns = {}    # key -> [mention ts]
+
+    def open(self, channel_id, thread_ts, mention_ts):
+        key = ThreadStateStore.key(channel_id, thread_ts)
+        with self._lock:
+            self._turns.setdefault(key, []).append(mention_ts)
+        return key, mention_ts
+
+    def close(self, turn):
+        key, mention_ts = turn
+        with self._lock:
+            turns = self._turns[key]
+            turns.remove(mention_ts)
+            if not turns:
+                del self._turns[key]
+
+    def oldest(self, channel_id, thread_ts):
+        '''
+        ts of the oldest mention of the thread still being answered, or None.
+        '''
+        with self._lock:
+            turns = list(self._turns.get(ThreadStateStore.key(channel_id, thread_ts), ()))
+        return min(turns, key=ts_key) if turns else None
+
+
+class AsyncThreadLocks:
+    '''
+    ThreadLocks for coroutines on one event loop.
+    '''
+    def __init__(self):
+        self._locks = {}
+        self.waits = 0
+
+    @contextlib.asynccontextmanager
+    async def hold(self, channel_id, thread_ts):
+        key = ThreadStateStore.key(channel_id, thread_ts)
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        if entry[0].locked():
+            self.waits += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+
+class ThreadLeases:
+    '''
+    Ownership of a thread by one worker among several, so only one of them
+    reads its state and streams a reply into it at a time.  A lease runs out
+    after ttl seconds unless renewed, which frees the thread of a worker that
+    died.
+    '''
+    def __init__(self, backend, ttl=THREAD_LEASE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+
+    def acquire(self, channel_id, thread_ts, owner):
+        return self.backend.add(ThreadStateStore.key(channel_id, thread_ts), owner, ttl=self.ttl)
+
+    def owner(self, channel_id, thread_ts):
+        return self.backend.get(ThreadStateStore.key(channel_id, thread_ts))
+
+    def renew(self, channel_id, thread_ts, owner):
+        '''
+        Extends the lease when owner still holds it; returns whether it did.
+        '''
+        #-check and extend in one step, a lease taken over meanwhile is left alone
+        return self.backend.extend(ThreadStateStore.key(channel_id, thread_ts), owner, ttl=self.ttl)
+
+    def release(self, channel_id, thread_ts, owner):
+        self.backend.discard(ThreadStateStore.key(channel_id, thread_ts), owner)
+
+
+def build_thread_state_store(url=THREAD_STATE_BACKEND):
+    return ThreadStateStore(build_cache_backend(url, "thread_state",
+                                                max_entries=THREAD_STATE_MAX_THREADS,
+                                                max_bytes=THREAD_STATE_MAX_BYTES, ttl=THREAD_STATE_TTL))
+
+
+def build_thread_leases(url=THREAD_LEASE_BACKEND):
+    return ThreadLeases(build_cache_backend(url, "thread_leases", max_entries=THREAD_STATE_MAX_THREADS,
+                                            ttl=THREAD_LEASE_TTL))
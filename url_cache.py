@@ -0,0 +1,150 @@
+'''
+Content-addressed cache for URL extractions.
+
+Every mention re-processes the whole thread, so without a cache each earlier
+link is downloaded and parsed by trafilatura again on every follow-up question.
+Entries are keyed by the normalized URL and hold the extracted text together
+with the ETag/Last-Modified validators, so stale entries can be revalidated
+with a cheap conditional request instead of a full download.
+'''
+import hashlib
+import os
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from cache import SHARED_CACHE_BACKEND, build_cache_backend
+
+URL_CACHE_PATH = os.getenv("URL_CACHE_PATH")    #a SQLite file, shorthand for URL_CACHE_BACKEND=sqlite:///<path>
+URL_CACHE_BACKEND = os.getenv("URL_CACHE_BACKEND", f"sqlite:///{URL_CACHE_PATH}" if URL_CACHE_PATH else SHARED_CACHE_BACKEND)
+URL_CACHE_TTL = int(os.getenv("URL_CACHE_TTL", "3600"))
+URL_CACHE_MAX_AGE = int(os.getenv("URL_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+URL_CACHE_MAX_ENTRIES = int(os.getenv("URL_CACHE_MAX_ENTRIES", "512"))
+URL_CACHE_MAX_BYTES = int(os.getenv("URL_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+'''
+Result of fetching a URL.  status 304 means the cached copy is still valid
+and body is None.
+'''
+FetchResult = namedtuple('FetchResult', ('status', 'body', 'etag', 'last_modified'))
+
+
+def normalize_url(url):
+    # Slack HTML-escapes ampersands inside links
+    url = url.strip().replace("&amp;", "&")
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    path = parts.path or "/"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, path, query, ""))
+
+
+def url_cache_key(url):
+    return hashlib.sha256(normalize_url(url).encode("utf-8")).hexdigest()
+
+
+class ExtractionCache:
+    '''
+    Entries younger than ttl are served as-is.  Older entries are revalidated
+    with their validators, and entries older than max_age are dropped by the
+    backend.
+    '''
+    def __init__(self, backend, ttl=URL_CACHE_TTL, time_func=time.time):
+        self.backend = backend
+        self.ttl = ttl
+        self.time_func = time_func
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "revalidations": 0,
+            "not_modified": 0,
+            "bytes_fetched": 0,
+            "bytes_served": 0,
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def get(self, url):
+        return self.backend.get(url_cache_key(url))
+
+    def put(self, url, content, etag=None, last_modified=None):
+        entry = {
+            "url": normalize_url(url),
+            "content": content,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": self.time_func(),
+        }
+        self.backend.set(url_cache_key(url), entry)
+        return entry
+
+    def store(self, url, content, result):
+        self.put(url, content, result.etag, result.last_modified)
+
+    def fetch_stage(self, url, fetch_func):
+        '''
+        fetch_func(url, etag, last_modified) -> FetchResult
+
+        Returns (content, None) when the cache can answer, otherwise
+        (None, FetchResult) whose body still has to be extracted and stored.
+        '''
+        entry = self.get(url)
+        if entry is not None and self.time_func() - entry["fetched_at"] < self.ttl:
+            self._count("hits")
+            self._count("bytes_served", len(entry["content"] or ""))
+            return entry["content"], None
+
+        try:
+            if entry is not None and (entry["etag"] or entry["last_modified"]):
+                self._count("revalidations")
+                result = fetch_func(url, entry["etag"], entry["last_modified"])
+                if result.status == 304:
+                    self._count("not_modified")
+                    self._count("bytes_served", len(entry["content"] or ""))
+                    self.put(url, entry["content"],
+                             result.etag or entry["etag"],
+                             result.last_modified or entry["last_modified"])
+                    return entry["content"], None
+            else:
+                self._count("misses")
+                result = fetch_func(url, None, None)
+        except Exception:
+            if entry is None:
+                raise
+            result = FetchResult(None, None, None, None)
+
+        if not result.body and entry is not None:
+            #-origin is unreachable, a stale extraction beats no extraction
+            return entry["content"], None
+
+        self._count("bytes_fetched", len(result.body or b""))
+        return None, result
+
+    def get_or_fetch(self, url, fetch_func, extract_func):
+        '''
+        extract_func(body) -> extracted text
+        '''
+        content, result = self.fetch_stage(url, fetch_func)
+        if result is None:
+            return content
+        content = extract_func(result.body) if result.body else None
+        if content is not None:
+            self.store(url, content, result)
+        return content
+
+
+def build_extraction_cache(url=URL_CACHE_BACKEND):
+    '''
+    Empty url keeps the cache in memory.
+    '''
+    return ExtractionCache(build_cache_backend(url, "url_extractions", max_entries=URL_CACHE_MAX_ENTRIES,
+                                               max_bytes=URL_CACHE_MAX_BYTES, ttl=URL_CACHE_MAX_AGE))
@@ -0,0 +1,176 @@
+'''
+Concurrent URL fetch pipeline.
+
+All URLs found in a thread are fetched in parallel on a bounded I/O pool that
+shares keep-alive connections per host.  As soon as a download finishes its
+extraction is handed to a separate extraction pool, so parsing never holds up
+the I/O threads.  Every request has its own timeout and the whole batch has a
+deadline; URLs that fail or miss the deadline are replaced by a short
+placeholder so the answer is never blocked on a slow host.
+
+The extraction pool is any concurrent.futures.Executor; by default a thread
+pool, or an extraction_pool.ExtractionProcessPool so that parsing does not
+hold this process's GIL or memory.
+'''
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+import requests
+from requests.adapters import HTTPAdapter
+from trafilatura import extract
+from trafilatura.settings import use_config
+
+from metrics import URL_EXTRACT_SECONDS, URL_FETCH_SECONDS
+from url_cache import FetchResult
+
+URL_FETCH_WORKERS = int(os.getenv("URL_FETCH_WORKERS", "8"))
+URL_FETCH_CONNECTIONS_PER_HOST = int(os.getenv("URL_FETCH_CONNECTIONS_PER_HOST", "4"))
+URL_EXTRACTION_WORKERS = int(os.getenv("URL_EXTRACTION_WORKERS", "2"))
+URL_FETCH_TIMEOUT = float(os.getenv("URL_FETCH_TIMEOUT", "10"))     #per request, seconds
+URL_FETCH_DEADLINE = float(os.getenv("URL_FETCH_DEADLINE", "20"))   #per mention, seconds
+URL_FETCH_MAX_BYTES = int(os.getenv("URL_FETCH_MAX_BYTES", str(5 * 1024 * 1024)))
+URL_CONTENT_MAX_CHARS = int(os.getenv("URL_CONTENT_MAX_CHARS", "50000"))
+USER_AGENT = "slack-gpt-bot"
+CHUNK_SIZE = 64 * 1024
+
+extraction_config = use_config()
+extraction_config.set("DEFAULT", "EXTRACTION_TIMEOUT", "0")
+
+
+def extract_document(body):
+    return extract(body, config=extraction_config)
+
+
+def url_placeholder(url, reason):
+    return f"[The contents of {url} could not be retrieved ({reason}).]"
+
+
+class URLFetcher:
+    def __init__(self, cache, extract_func=extract_document,
+                 max_workers=URL_FETCH_WORKERS,
+                 connections_per_host=URL_FETCH_CONNECTIONS_PER_HOST,
+                 extraction_workers=URL_EXTRACTION_WORKERS,
+                 request_timeout=URL_FETCH_TIMEOUT,
+                 deadline=URL_FETCH_DEADLINE,
+                 max_bytes=URL_FETCH_MAX_BYTES,
+                 max_chars=URL_CONTENT_MAX_CHARS,
+                 extraction_executor=None):
+        self.cache = cache
+        self.extract_func = extract_func
+        self.request_timeout = request_timeout
+        self.deadline = deadline
+        self.max_bytes = max_bytes
+        self.max_chars = max_chars
+
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        #-pool_block caps the number of simultaneous connections to any one host
+        adapter = HTTPAdapter(pool_connections=max_workers,
+                              pool_maxsize=connections_per_host,
+                              pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.io_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="url-fetch")
+        if extraction_executor is None:
+            extraction_executor = ThreadPoolExecutor(max_workers=extraction_workers, thread_name_prefix="url-extract")
+        self.extraction_pool = extraction_executor
+
+    def fetch_document(self, url, etag=None, last_modified=None):
+        '''
+        Conditional, streamed GET.  The body is cut off at max_bytes and the
+        download is abandoned once request_timeout has elapsed in total.
+        '''
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = self._fetch_document(url, etag, last_modified)
+            outcome = str(result.status)
+            return result
+        finally:
+            URL_FETCH_SECONDS.labels(outcome).observe(time.perf_counter() - started)
+
+    def _fetch_document(self, url, etag, last_modified):
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        started = time.monotonic()
+        with self.session.get(url.replace("&amp;", "&"), headers=headers, stream=True,
+                              timeout=self.request_timeout) as response:
+            result_headers = (response.headers.get("ETag"), response.headers.get("Last-Modified"))
+            if response.status_code != 200:
+                return FetchResult(response.status_code, None, *result_headers)
+            body = bytearray()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                body.extend(chunk)
+                if len(body) >= self.max_bytes:
+                    del body[self.max_bytes:]
+                    break
+                if time.monotonic() - started > self.request_timeout:
+                    raise requests.Timeout(f"download exceeded {self.request_timeout}s")
+        return FetchResult(200, bytes(body), *result_headers)
+
+    @staticmethod
+    def _timer(histogram):
+        '''
+        A future callback observing the time since it was created.
+        '''
+        started = time.perf_counter()
+        return lambda future: histogram.observe(time.perf_counter() - started)
+
+    def _store(self, url, result, content):
+        if content is not None:
+            content = content[:self.max_chars]
+            self.cache.store(url, content, result)
+        return content
+
+    def fetch_all(self, urls, deadline=None):
+        '''
+        Returns a dict mapping each URL to its extracted text, or to a
+        placeholder when it could not be retrieved before the deadline.
+        '''
+        deadline = time.monotonic() + (self.deadline if deadline is None else deadline)
+        urls = list(dict.fromkeys(urls))
+        contents = {}
+        fetches = {self.io_pool.submit(self.cache.fetch_stage, url, self.fetch_document): url
+                   for url in urls}
+        extractions = {}
+        try:
+            for future in as_completed(fetches, timeout=max(deadline - time.monotonic(), 0)):
+                url = fetches[future]
+                try:
+                    content, result = future.result()
+                except Exception as e:
+                    contents[url] = url_placeholder(url, type(e).__name__)
+                    continue
+                if result is None:
+                    contents[url] = content
+                elif not result.body:
+                    contents[url] = url_placeholder(url, f"HTTP {result.status}")
+                else:
+                    #-only the body goes to the pool, it may be another process
+                    extraction = self.extraction_pool.submit(self.extract_func, result.body)
+                    extraction.add_done_callback(self._timer(URL_EXTRACT_SECONDS))
+                    extractions[url] = (extraction, result)
+        except FuturesTimeoutError:
+            pass
+
+        for url, (future, result) in extractions.items():
+            try:
+                content = self._store(url, result, future.result(timeout=max(deadline - time.monotonic(), 0)))
+                contents[url] = content if content is not None else url_placeholder(url, "no extractable text")
+            except FuturesTimeoutError:
+                future.cancel()
+                contents[url] = url_placeholder(url, "timed out")
+            except Exception as e:
+                contents[url] = url_placeholder(url, type(e).__name__)
+
+        for future, url in fetches.items():
+            if url not in contents:
+                future.cancel()
+                contents[url] = url_placeholder(url, "timed out")
+        return contents
@@ -0,0 +1,213 @@
+'''
+Slack user profiles (users.info) are only needed for the greeting and the
+logs, but were fetched on every mention.  UserProfileCache keeps them for
+USER_CACHE_TTL seconds, makes concurrent lookups of the same user share one
+users.info call, and can be warmed up from users.list at startup.
+'''
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from cache import SHARED_CACHE_BACKEND, build_cache_backend
+from slack_updater import rate_limit_delay
+
+USER_CACHE_BACKEND = os.getenv("USER_CACHE_BACKEND", SHARED_CACHE_BACKEND or "memory")
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "3600"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "5000"))
+USER_CACHE_WARM = os.getenv("USER_CACHE_WARM", "").lower() in ("1", "true", "yes")
+#users.list page size, Slack recommends no more than 200
+USERS_LIST_PAGE_SIZE = 200
+
+PROFILE_FIELDS = ("first_name", "last_name", "real_name", "display_name", "email")
+
+
+def trim_user(user):
+    '''
+    The parts of a users.info / users.list member the bot uses.
+    '''
+    trimmed = {key: user[key] for key in ("id", "name", "real_name") if key in user}
+    profile = user.get("profile") or {}
+    trimmed["profile"] = {key: profile[key] for key in PROFILE_FIELDS if key in profile}
+    return trimmed
+
+
+class UserProfileCache:
+    def __init__(self, backend=None, ttl=USER_CACHE_TTL, max_entries=USER_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        #-an empty backend is falsy (__len__), so no `backend or ...`
+        self.backend = backend if backend is not None else build_cache_backend(USER_CACHE_BACKEND, "users",
+                                                                                max_entries=max_entries, ttl=ttl)
+        self._lock = threading.Lock()
+        self._in_flight = {}        # user_id -> concurrent.futures.Future
+        self._async_in_flight = {}  # user_id -> asyncio.Future
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "errors": 0, "warmed": 0}
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    @property
+    def stats(self):
+        '''
+        Counters only, logged with every mention: no entry count, which is a
+        SCAN on the Redis backend.
+        '''
+        with self._lock:
+            stats = dict(self.counters)
+        stats["evictions"] = getattr(self.backend, "evictions", None)
+        return stats
+
+    def get(self, user_id):
+        '''
+        Returns the cached profile as a users.info response ({"user": ...}),
+        or None.
+        '''
+        user = self.backend.get(user_id)
+        return None if user is None else {"user": user}
+
+    def put(self, user_id, user):
+        self.backend.set(user_id, trim_user(user), ttl=self.ttl)
+
+    def lookup(self, user_id, fetch_func):
+        '''
+        Returns users.info for user_id, calling fetch_func(user_id) on a miss.
+        Threads looking up the same user meanwhile wait for that call instead
+        of making their own.
+        '''
+        user_info = self.get(user_id)
+        if user_info is not None:
+            self.count("hits")
+            return user_info
+
+        with self._lock:
+            future = self._in_flight.get(user_id)
+            leader = future is None
+            if leader:
+                future = self._in_flight[user_id] = Future()
+            else:
+                self.counters["coalesced"] += 1
+        if not leader:
+            return future.result()
+
+        try:
+            #-another thread may have stored it since the check above
+            user_info = self.get(user_id)
+            if user_info is not None:
+                self.count("hits")
+            else:
+                self.count("misses")
+                user = fetch_func(user_id)["user"]
+                self.put(user_id, user)
+                user_info = {"user": trim_user(user)}
+            future.set_result(user_info)
+            return user_info
+        except Exception as e:
+            self.count("errors")
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(user_id, None)
+
+    async def lookup_async(self, user_id, fetch_func):
+        '''
+        lookup() for a coroutine fetch_func, deduplicating within the event loop.
+        The backend may be a file or a server, so it is read and written on
+        the default executor.
+        '''
+        loop = asyncio.get_running_loop()
+        user_info = await loop.run_in_executor(None, self.get, user_id)
+        if user_info is not None:
+            self.count("hits")
+            return user_info
+
+        future = self._async_in_flight.get(user_id)
+        if future is not None:
+            self.count("coalesced")
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+            #-the lookup this one joined was cancelled, not this one
+            return await self.lookup_async(user_id, fetch_func)
+
+        future = self._async_in_flight[user_id] = loop.create_future()
+        self.count("misses")
+        try:
+            user = (await fetch_func(user_id))["user"]
+            await loop.run_in_executor(None, self.put, user_id, user)
+            user_info = {"user": trim_user(user)}
+            future.set_result(user_info)
+            return user_info
+        except Exception as e:
+            self.count("errors")
+            future.set_exception(e)
+            #-retrieved here so a lookup nobody else joined doesn't log "never retrieved"
+            future.exception()
+            raise
+        finally:
+            #-cancelled: the lookups that joined this one try again
+            if not future.done():
+                future.cancel()
+            self._async_in_flight.pop(user_id, None)
+
+    def store_page(self, response):
+        '''
+        Caches the members of one users.list page, returns the next cursor.
+        '''
+        warmed = 0
+        for member in response["members"]:
+            if not member.get("deleted") and "id" in member:
+                self.put(member["id"], member)
+                warmed += 1
+        self.count("warmed", warmed)
+        return (response.get("response_metadata") or {}).get("next_cursor")
+
+    def warm(self, list_func, page_size=USERS_LIST_PAGE_SIZE, max_pages=None, sleep=time.sleep):
+        '''
+        Loads the workspace's users with list_func (users.list), following
+        the pagination cursor and waiting out 429s.  Returns the pages read.
+        '''
+        cursor = None
+        pages = 0
+        while max_pages is None or pages < max_pages:
+            kwargs = {"limit": page_size}
+            if cursor:
+                kwargs["cursor"] = cursor
+            try:
+                response = list_func(**kwargs)
+            except Exception as e:
+                delay = rate_limit_delay(e)
+                if delay is None:
+                    raise
+                sleep(delay)
+                continue
+            pages += 1
+            cursor = self.store_page(response)
+            if not cursor:
+                break
+        return pages
+
+    async def warm_async(self, list_func, page_size=USERS_LIST_PAGE_SIZE, max_pages=None, sleep=asyncio.sleep):
+        cursor = None
+        pages = 0
+        while max_pages is None or pages < max_pages:
+            kwargs = {"limit": page_size}
+            if cursor:
+                kwargs["cursor"] = cursor
+            try:
+                response = await list_func(**kwargs)
+            except Exception as e:
+                delay = rate_limit_delay(e)
+                if delay is None:
+                    raise
+                await sleep(delay)
+                continue
+            pages += 1
+            cursor = self.store_page(response)
+            if not cursor:
+                break
+        return pages
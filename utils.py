@@ -1,9 +1,19 @@
+import contextlib
+import functools
+import hashlib
 import os
-import re
+import time
 
 import tiktoken
-from trafilatura import extract, fetch_url
-from trafilatura.settings import use_config
+
+from cache import MemoryCacheBackend
+from slack_links import extract_urls, tokenize_links
+from thread_state import ts_key
+from url_cache import build_extraction_cache
+from url_fetcher import URL_EXTRACTION_WORKERS, URLFetcher
+from extraction_pool import build_extraction_executor
+import structured_logging
+from metrics import TOKEN_COUNT_SECONDS
 
 import logging
 from json_logger_stdout import json_std_logger
@@ -11,9 +21,6 @@ from json_logger_stdout import json_std_logger
 logging.basicConfig(level=logging.INFO)
 json_std_logger.setLevel (logging.INFO)
 
-newconfig = use_config()
-newconfig.set("DEFAULT", "EXTRACTION_TIMEOUT", "0")
-
 SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
 SLACK_APP_TOKEN = os.getenv("SLACK_APP_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -24,60 +31,107 @@ You will answer the question as truthfully as possible.
 If you're unsure of the answer, say Sorry, I don't know.
 '''
 WAIT_MESSAGE = "Got your request. Please wait."
-N_CHUNKS_TO_CONCAT_BEFORE_UPDATING = 20
 MAX_TOKENS = 8192
 
-def logging_wrapper(message, severity=logging.INFO, **kwargs):
-    json_std_logger._setParams(**kwargs)
+#memoized token counts, keyed by encoding and content hash
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "20000"))
+#cold texts are encoded with encode_batch once there are this many
+TOKEN_BATCH_THRESHOLD = 8
+TOKEN_BATCH_THREADS = 4
 
-    log = {
-        logging.DEBUG: json_std_logger.debug,
-        logging.ERROR: json_std_logger.error,
-        logging.CRITICAL: json_std_logger.critical,
-        logging.WARNING: json_std_logger.warning
-    }
-    func = log.get(severity, json_std_logger.info)
-    func(message)
+url_extraction_cache = build_extraction_cache()
+url_fetcher = URLFetcher(url_extraction_cache,
+                         extraction_executor=build_extraction_executor(max_workers=URL_EXTRACTION_WORKERS))
+token_count_cache = MemoryCacheBackend(max_entries=TOKEN_COUNT_CACHE_SIZE)
+
+def logging_wrapper(message, severity=logging.INFO, **kwargs):
+    structured_logging.logging_wrapper(message, severity, **kwargs)
 
 def extract_url_list(text):
     logging_wrapper("Milestone", logging.DEBUG, function="extract_url_list", text=text)
-    
-    #prone to catastrophic backtracking
-    #also expensive as it is compiled each time
-    url_pattern = re.compile(
-        r'<(http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+)>'
-    )
-    url_list = url_pattern.findall(text)
+    url_list = extract_urls(text)
     logging_wrapper("Milestone", logging.DEBUG, function="extract_url_list", msg="extraction complete", url_list=url_list)
     return url_list if len(url_list)>0 else None
 
 
-def augment_user_message(user_message, url_list):
+def fetch_thread_urls(messages, bot_user_id, fetcher=None):
+    '''
+    Fetch every URL the thread's kept user messages link to in one parallel
+    batch, before the messages are assembled.
+    '''
+    urls = []
+    for message in messages:
+        if message.get('user') != bot_user_id and f'<@{bot_user_id}>' in message.get('text', ''):
+            urls.extend(extract_url_list(message['text']) or [])
+    if not urls:
+        return {}
+    fetcher = fetcher or url_fetcher
+    url_contents = fetcher.fetch_all(urls)
+    logging_wrapper("Milestone", logging.DEBUG, function="fetch_thread_urls",
+                    url_cache=structured_logging.lazy(lambda: dict(fetcher.cache.stats)))
+    return url_contents
+
+
+def augment_user_message(user_message, url_list, url_contents=None):
     logging_wrapper("Milestone", logging.DEBUG, function="augment_user_message", url_list=url_list)
+    if url_contents is None:
+        url_contents = url_fetcher.fetch_all(url_list)
+    #-cut the links by their spans, the markup may be escaped or labelled
+    spans = [(link.start, link.end) for link in tokenize_links(user_message)
+             if link.kind == "url" and link.target in url_list]
+    for start, end in reversed(spans):
+        user_message = user_message[:start] + user_message[end:]
     all_url_content = ''
     for url in url_list:
-        logging_wrapper("Milestone", logging.DEBUG, function="augment_user_message", msg='fetching url', url=url)
-        downloaded = fetch_url(url)
-        url_content = extract(downloaded, config=newconfig)
-        user_message = user_message.replace(f'<{url}>', '')
+        url_content = url_contents.get(url)
         all_url_content = all_url_content + f' Contents of {url} : \n """ {url_content} """'
     user_message = user_message + "\n" + all_url_content
     return user_message
 
-# From https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-def num_tokens_from_messages(messages, model="gpt-4"):
-    """Returns the number of tokens used by a list of messages."""
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """Resolves the tiktoken encoding of a model once; loading the BPE ranks is expensive."""
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
         print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
+
+def num_tokens_from_texts(texts, encoding):
+    """
+    Returns the token count of each text.  Counts are memoized by content
+    hash, so only text that was never seen is encoded; large batches of new
+    text (a cold thread) go through tiktoken's multi-threaded encode_batch.
+    """
+    keys = [encoding.name + ":" + hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+            for text in texts]
+    counts = [token_count_cache.get(key) for key in keys]
+    missing = {}
+    for key, text, count in zip(keys, texts, counts):
+        if count is None:
+            missing[key] = text
+    if missing:
+        if len(missing) >= TOKEN_BATCH_THRESHOLD:
+            encoded = encoding.encode_batch(list(missing.values()), num_threads=TOKEN_BATCH_THREADS)
+            lengths = [len(tokens) for tokens in encoded]
+        else:
+            lengths = [len(encoding.encode(text)) for text in missing.values()]
+        fresh = dict(zip(missing, lengths))
+        for key, length in fresh.items():
+            token_count_cache.set(key, length)
+        counts = [fresh[key] if count is None else count for key, count in zip(keys, counts)]
+    return counts
+
+# From https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+@functools.lru_cache(maxsize=None)
+def message_token_parameters(model):
+    """Returns the encoding, tokens_per_message and tokens_per_name used to count tokens for a model."""
     if model == "gpt-3.5-turbo" or model == "gpt-3.5-turbo-16k":
         print("Warning: gpt-3.5-turbo may change over time. Returning num tokens assuming gpt-3.5-turbo-0301.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301")
+        return message_token_parameters("gpt-3.5-turbo-0301")
     elif model == "gpt-4":
         print("Warning: gpt-4 may change over time. Returning num tokens assuming gpt-4-0314.")
-        return num_tokens_from_messages(messages, model="gpt-4-0314")
+        return message_token_parameters("gpt-4-0314")
     elif model == "gpt-3.5-turbo-0301":
         tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
         tokens_per_name = -1  # if there's a name, the role is omitted
@@ -85,31 +139,94 @@ def num_tokens_from_messages(messages, model="gpt-4"):
         tokens_per_message = 3
         tokens_per_name = 1
     else:
-        raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+        raise NotImplementedError(f"""num_tokens_per_message() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
+    return get_encoding(model), tokens_per_message, tokens_per_name
+
+def count_message_tokens(message, encoding, tokens_per_message, tokens_per_name):
+    num_tokens = tokens_per_message + sum(num_tokens_from_texts(list(message.values()), encoding))
+    if "name" in message:
+        num_tokens += tokens_per_name
     return num_tokens
 
-def process_conversation_history(conversation_history, bot_user_id):
-    logging_wrapper("Milestone", logging.DEBUG, function="process_conversation_history")
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    for message in conversation_history['messages'][:-1]:
-        logging_wrapper("Milestone", logging.DEBUG, function="process_conversation_history", msg=message)
+def num_tokens_per_message(messages, model="gpt-4"):
+    """Returns the number of tokens each message adds to a request; the text of all messages is counted in one batch."""
+    encoding, tokens_per_message, tokens_per_name = message_token_parameters(model)
+    texts = [value for message in messages for value in message.values()]
+    counts = iter(num_tokens_from_texts(texts, encoding))
+    return [tokens_per_message + sum(next(counts) for _ in message) + (tokens_per_name if "name" in message else 0)
+            for message in messages]
+
+def num_tokens_from_message(message, model="gpt-4"):
+    """Returns the number of tokens a single message adds to a request."""
+    return num_tokens_per_message([message], model)[0]
+
+
+def update_thread_state(state, conversation_history, bot_user_id, count_tokens, reply_message_ts=None,
+                        until_ts=None, open_since=None):
+    '''
+    Returns a new thread state with the replies newer than state["last_ts"]
+    processed and appended.  Replies from reply_message_ts on (the bot's wait
+    message and anything posted after it), or after until_ts (the mention,
+    when the wait message is posted concurrently) are left for the next turn,
+    by which time the wait message holds the answer.  count_tokens returns
+    the token counts of a list of messages, and is called once per update.
+
+    open_since is the ts of an earlier mention whose answer is still being
+    written: bot replies after it are skipped, and the user messages after
+    it are kept for this turn only (past last_ts), to be read again next time.
+    '''
+    logging_wrapper("Milestone", logging.DEBUG, function="update_thread_state", last_ts=state["last_ts"])
+    new_messages = conversation_history['messages']
+    if until_ts is not None:
+        new_messages = [m for m in new_messages if ts_key(m['ts']) <= ts_key(until_ts)]
+    elif reply_message_ts is None:
+        new_messages = new_messages[:-1]
+    else:
+        new_messages = [m for m in new_messages if ts_key(m['ts']) < ts_key(reply_message_ts)]
+    if state["last_ts"] is not None:
+        new_messages = [m for m in new_messages if ts_key(m['ts']) > ts_key(state["last_ts"])]
+    settled = new_messages
+    if open_since is not None:
+        settled = [m for m in new_messages if ts_key(m['ts']) <= ts_key(open_since)]
+        new_messages = settled + [m for m in new_messages[len(settled):] if m['user'] != bot_user_id]
+
+    url_contents = fetch_thread_urls(new_messages, bot_user_id)
+    #-entries past last_ts were kept for one turn only and are read again
+    processed = [m for m in state["messages"]
+                 if state["last_ts"] is not None and ts_key(m['ts']) <= ts_key(state["last_ts"])]
+    entries = []
+    for message in new_messages:
         role = "assistant" if message['user'] == bot_user_id else "user"
-        message_text = process_message(message, bot_user_id)
-        logging_wrapper("Milestone", logging.DEBUG, function="process_conversation_history", message_text=message_text)
+        message_text = process_message(message, bot_user_id, url_contents)
         if message_text:
-            messages.append({"role": role, "content": message_text})
+            entries.append((message['ts'], {"role": role, "content": message_text}))
+    if entries:
+        started = time.perf_counter()
+        counts = count_tokens([entry for _, entry in entries])
+        TOKEN_COUNT_SECONDS.observe(time.perf_counter() - started)
+        for (ts, entry), tokens in zip(entries, counts):
+            processed.append({"ts": ts, **entry, "tokens": tokens})
+    last_ts = settled[-1]['ts'] if settled else state["last_ts"]
+    return {"last_ts": last_ts, "messages": processed}
+
+
+def thread_state_messages(state):
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    for message in state["messages"]:
+        messages.append({"role": message["role"], "content": message["content"]})
     return messages
 
 
-def process_message(message, bot_user_id):
+def num_tokens_from_thread_state(state, model="gpt-4"):
+    """Returns the token count of a request with thread_state_messages(state), without re-encoding the thread."""
+    num_tokens = num_tokens_from_message({"role": "system", "content": SYSTEM_PROMPT}, model)
+    for message in state["messages"]:
+        num_tokens += message["tokens"]
+    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+    return num_tokens
+
+
+def process_message(message, bot_user_id, url_contents=None):
     logging_wrapper("Milestone", logging.DEBUG, function="process_message", msg=message)
     #is it possible for this field to not be there?
     if 'text' not in message:
@@ -118,10 +235,10 @@ def process_message(message, bot_user_id):
     message_text = message['text']
     role = "assistant" if message['user'] == bot_user_id else "user"
     logging_wrapper("Milestone", logging.DEBUG, function="process_message", role=role)
-    if role == "user":
+    if role == "user" and f'<@{bot_user_id}>' in message_text:
         url_list = extract_url_list(message_text)
         if url_list:
-            message_text = augment_user_message(message_text, url_list)
+            message_text = augment_user_message(message_text, url_list, url_contents)
     message_text = clean_message_text(message_text, role, bot_user_id)
     return message_text
 
@@ -141,3 +258,38 @@ def update_chat(app, channel_id, reply_message_ts, response_text):
         text=response_text
     )
 
+
+def post_chat(app, channel_id, thread_ts, text):
+    slack_resp = app.client.chat_postMessage(
+        channel=channel_id,
+        thread_ts=thread_ts,
+        text=text
+    )
+    return slack_resp['message']['ts']
+
+
+class StageTimer:
+    '''
+    Wall clock milliseconds per stage of handling a mention:
+
+        with timer.stage("conversation_history"):
+            ...
+        timer.mark("first_token")   # milliseconds since the timer started
+
+    Stages may run on different threads at the same time.
+    '''
+    def __init__(self, time_func=time.perf_counter):
+        self.time_func = time_func
+        self.started = time_func()
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = self.time_func()
+        try:
+            yield
+        finally:
+            self.timings[name] = round((self.time_func() - started) * 1000, 1)
+
+    def mark(self, name):
+        self.timings[name] = round((self.time_func() - self.started) * 1000, 1)
@@ -0,0 +1,265 @@
+'''
+Work queue between event intake and completion workers.
+
+In distributed mode (WORK_QUEUE_BACKEND set) the process receiving Slack's
+events (main_flask.py, main_websocket.py or their asyncio variants) only
+acknowledges each mention and queues it; any number of workers
+(main_worker.py, on one machine or many) take mentions off the queue and
+answer them.
+
+A worker leases the job it takes for lease seconds and keeps extending the
+lease while it works.  A job whose worker died becomes available again once
+its lease runs out, and is dropped after JOB_MAX_ATTEMPTS such deliveries.
+Two backends, like the caches:
+
+- sqlite:///path/to/queue.db: a table in a local file (WAL), for workers on
+  one machine
+- redis://host:port/db: a sorted set of ready jobs and one of leased jobs on
+  a Redis compatible server, for workers on several machines (requires the
+  redis package)
+'''
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from structured_logging import logging_wrapper
+
+WORK_QUEUE_BACKEND = os.getenv("WORK_QUEUE_BACKEND", "")     #empty answers mentions in the intake process
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+'''
+A job taken off the queue.  attempts counts the deliveries of the job,
+this one included.
+'''
+Job = namedtuple('Job', ('id', 'payload', 'attempts'))
+
+
+def mention_job(body, context):
+    '''
+    The parts of an app_mention event and its Bolt context the bot reads.
+    '''
+    event = body["event"]
+    return {
+        "body": {"event_id": body.get("event_id"),
+                 "event": {key: event[key] for key in ("type", "channel", "user", "text", "ts", "thread_ts")
+                           if key in event}},
+        "context": {"bot_user_id": context["bot_user_id"], "user_id": context["user_id"]},
+    }
+
+
+def enqueue_mention(queue, body, context):
+    job_id = queue.put(mention_job(body, context))
+    logging_wrapper("MentionQueued", logging.DEBUG,
+                    job_id=job_id,
+                    event_id=body.get("event_id"))
+    return job_id
+
+
+class SQLiteWorkQueue:
+    def __init__(self, path, table="work_queue", time_func=time.time):
+        self.path = path
+        self.table = table
+        self.time_func = time_func
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, available_at REAL NOT NULL, "
+            "leased_until REAL, worker TEXT, attempts INTEGER NOT NULL DEFAULT 0)")
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_available ON {table}(available_at)")
+
+    def put(self, payload, delay=0):
+        with self._lock:
+            cur = self._conn.execute(f"INSERT INTO {self.table} (payload, available_at) VALUES (?, ?)",
+                                     (json.dumps(payload), self.time_func() + delay))
+        return cur.lastrowid
+
+    def get(self, worker, lease=JOB_LEASE_SECONDS):
+        '''
+        Leases the oldest available job to worker, None when there is none.
+        '''
+        now = self.time_func()
+        with self._lock:
+            #-BEGIN IMMEDIATE takes the write lock first, so two processes
+            #-never lease the same row
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    f"SELECT id, payload, attempts FROM {self.table} "
+                    "WHERE available_at <= ? AND (leased_until IS NULL OR leased_until <= ?) "
+                    "ORDER BY available_at, id LIMIT 1", (now, now)).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        f"UPDATE {self.table} SET leased_until=?, worker=?, attempts=attempts+1 WHERE id=?",
+                        (now + lease, worker, row[0]))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return Job(row[0], json.loads(row[1]), row[2] + 1)
+
+    def extend(self, job, worker, lease=JOB_LEASE_SECONDS):
+        '''
+        Extends the lease of a job worker still holds; returns whether it did.
+        '''
+        with self._lock:
+            cur = self._conn.execute(f"UPDATE {self.table} SET leased_until=? WHERE id=? AND worker=?",
+                                     (self.time_func() + lease, job.id, worker))
+        return cur.rowcount == 1
+
+    def release(self, job, worker, delay=0):
+        '''
+        Hands a job back without counting the delivery, available again after
+        delay seconds.
+        '''
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE {self.table} SET leased_until=NULL, worker=NULL, available_at=?, attempts=attempts-1 "
+                "WHERE id=? AND worker=?", (self.time_func() + delay, job.id, worker))
+
+    def ack(self, job, worker):
+        '''
+        Removes a job worker still holds; a job whose lease ran out and was
+        taken over is left to its new worker.  Returns whether it did.
+        '''
+        with self._lock:
+            cur = self._conn.execute(f"DELETE FROM {self.table} WHERE id=? AND worker=?", (job.id, worker))
+        return cur.rowcount == 1
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+#KEYS: ready, leased, payloads, attempts, workers   ARGV: now, lease, worker
+_REDIS_LEASE_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, id in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], id)
+    redis.call('ZADD', KEYS[1], ARGV[1], id)
+end
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 1)
+if #ids == 0 then
+    return false
+end
+redis.call('ZREM', KEYS[1], ids[1])
+redis.call('ZADD', KEYS[2], tonumber(ARGV[1]) + tonumber(ARGV[2]), ids[1])
+redis.call('HSET', KEYS[5], ids[1], ARGV[3])
+local attempts = redis.call('HINCRBY', KEYS[4], ids[1], 1)
+return {ids[1], redis.call('HGET', KEYS[3], ids[1]), attempts}
+"""
+
+#KEYS: leased, workers   ARGV: id, worker, score
+_REDIS_EXTEND_SCRIPT = """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] or not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+return 1
+"""
+
+#KEYS: ready, leased, attempts, workers   ARGV: id, worker, available_at
+_REDIS_RELEASE_SCRIPT = """
+if redis.call('HGET', KEYS[4], ARGV[1]) ~= ARGV[2] or redis.call('ZREM', KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HDEL', KEYS[4], ARGV[1])
+redis.call('HINCRBY', KEYS[3], ARGV[1], -1)
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+return 1
+"""
+
+#KEYS: ready, leased, payloads, attempts, workers   ARGV: id, worker
+_REDIS_ACK_SCRIPT = """
+if redis.call('HGET', KEYS[5], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+redis.call('HDEL', KEYS[5], ARGV[1])
+return 1
+"""
+
+
+class RedisWorkQueue:
+    '''
+    Jobs are ids in a "ready" sorted set scored by when they become
+    available and a "leased" one scored by when their lease runs out; the
+    payloads, delivery counts and lease holders are hashes.  Leasing moves
+    expired leases back to ready first, in one script.
+    '''
+    def __init__(self, client, prefix="slack-gpt-bot:work_queue:", time_func=time.time):
+        self.client = client
+        self.prefix = prefix
+        self.time_func = time_func
+        self.keys = {name: prefix + name for name in ("next_id", "ready", "leased", "payloads", "attempts",
+                                                      "workers")}
+        self._lease = client.register_script(_REDIS_LEASE_SCRIPT)
+        self._extend = client.register_script(_REDIS_EXTEND_SCRIPT)
+        self._release = client.register_script(_REDIS_RELEASE_SCRIPT)
+        self._ack = client.register_script(_REDIS_ACK_SCRIPT)
+
+    def put(self, payload, delay=0):
+        job_id = int(self.client.incr(self.keys["next_id"]))
+        pipeline = self.client.pipeline()
+        pipeline.hset(self.keys["payloads"], job_id, json.dumps(payload))
+        pipeline.zadd(self.keys["ready"], {job_id: self.time_func() + delay})
+        pipeline.execute()
+        return job_id
+
+    def get(self, worker, lease=JOB_LEASE_SECONDS):
+        keys = self.keys
+        result = self._lease(keys=[keys["ready"], keys["leased"], keys["payloads"], keys["attempts"],
+                                   keys["workers"]],
+                             args=[self.time_func(), lease, worker])
+        if not result:
+            return None
+        job_id, payload, attempts = result
+        return Job(int(job_id), json.loads(payload), int(attempts))
+
+    def extend(self, job, worker, lease=JOB_LEASE_SECONDS):
+        return bool(self._extend(keys=[self.keys["leased"], self.keys["workers"]],
+                                 args=[job.id, worker, self.time_func() + lease]))
+
+    def release(self, job, worker, delay=0):
+        keys = self.keys
+        self._release(keys=[keys["ready"], keys["leased"], keys["attempts"], keys["workers"]],
+                      args=[job.id, worker, self.time_func() + delay])
+
+    def ack(self, job, worker):
+        keys = self.keys
+        return bool(self._ack(keys=[keys["ready"], keys["leased"], keys["payloads"], keys["attempts"],
+                                    keys["workers"]],
+                              args=[job.id, worker]))
+
+    def __len__(self):
+        return int(self.client.hlen(self.keys["payloads"]))
+
+
+def build_work_queue(url=WORK_QUEUE_BACKEND):
+    '''
+    The configured queue, or None when mentions are answered where they
+    are received.
+    '''
+    if not url:
+        return None
+    if url.startswith("sqlite:///"):
+        return SQLiteWorkQueue(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        import redis
+        return RedisWorkQueue(redis.Redis.from_url(url, decode_responses=True))
+    raise ValueError(f"Unsupported work queue url: {url}")